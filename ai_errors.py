@@ -0,0 +1,34 @@
+"""
+Классификация ошибок AI запросов при пакетной обработке (кластеризация, сопоставление).
+- ответ обрезан, не разобран или промпт не поместился в контекст - помогает деление блока пополам;
+- неверный ключ, нет доступа или исчерпана квота - AI недоступен до конца запуска;
+- лимит запросов, обрыв связи, ошибка сервера - клиент OpenAI уже повторил запрос
+  с нарастающими паузами (max_retries), блок обрабатывается без AI, деление не поможет.
+"""
+
+import openai
+
+
+class TruncatedResponseError(Exception):
+    """Ответ AI обрезан по лимиту токенов"""
+
+
+def check_finish_reason(response):
+    """Проверяет, что ответ AI не обрезан по лимиту токенов"""
+    if response.choices[0].finish_reason == 'length':
+        raise TruncatedResponseError("ответ AI обрезан по лимиту токенов")
+
+
+def is_split_error(error):
+    """Ошибка, которую исправляет уменьшение блока: обрезанный или неразобранный ответ, переполнение контекста"""
+    if isinstance(error, (TruncatedResponseError, ValueError)):
+        # json.JSONDecodeError - подкласс ValueError
+        return True
+    return isinstance(error, openai.BadRequestError) and error.code == 'context_length_exceeded'
+
+
+def is_fatal_error(error):
+    """Ошибка, после которой повторять AI запросы в текущем запуске бессмысленно"""
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return True
+    return isinstance(error, openai.RateLimitError) and error.code == 'insufficient_quota'
@@ -0,0 +1,383 @@
+"""
+Приближенный поиск похожих наименований (IVF) для больших баз знаний.
+Наименования переводятся в разреженные векторы хешированных символьных n-грамм
+(локально, без внешних моделей), векторы распределяются по кластерам сферическим k-means.
+Запрос сравнивается с центрами кластеров, а точно оценивается только по записям
+nprobe ближайших кластеров: nprobe задает баланс между полнотой и скоростью.
+Индекс сохраняется рядом с brain.json; новые записи добавляются без переобучения.
+"""
+
+import logging
+import os
+import pickle
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from brain_index import char_ngrams
+from config import config
+from tfidf_engine import get_tfidf_matcher
+
+logger = logging.getLogger(__name__)
+
+ANN_FORMAT_VERSION = 1
+# Размерность хешированных векторов n-грамм
+HASH_DIMENSION = 1 << 12
+MAX_LISTS = 1024
+# Сколько записей на кластер берется в выборку для обучения центров
+KMEANS_SAMPLE_PER_LIST = 20
+KMEANS_ITERATIONS = 8
+KMEANS_SEED = 20250801
+# Размер блока строк при распределении векторов по кластерам
+ASSIGN_BLOCK_SIZE = 4096
+# Если база выросла во столько раз с момента обучения, центры кластеров обучаются заново
+RETRAIN_GROWTH = 4.0
+
+
+def _hashed_grams(name):
+    """Номера хеш-корзин n-грамм наименования (стабильны между запусками)"""
+    return sorted({zlib.crc32(gram.encode('utf-8')) % HASH_DIMENSION for gram in char_ngrams(name)})
+
+
+def _binary_matrix(names):
+    """Бинарная CSR-матрица хешированных n-грамм (наименования x корзины)"""
+    indptr = [0]
+    indices = []
+    for name in names:
+        indices.extend(_hashed_grams(name))
+        indptr.append(len(indices))
+    indices = np.array(indices, dtype=np.int32)
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, np.array(indptr, dtype=np.int64)),
+                             shape=(len(names), HASH_DIMENSION))
+
+
+def _normalize_rows(matrix):
+    """L2-нормирует строки разреженной матрицы"""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms).dot(matrix).tocsr().astype(np.float32)
+
+
+def _normalize_dense(centroids):
+    norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (centroids / norms).astype(np.float32)
+
+
+class AnnIndex:
+    """
+    IVF-индекс наименований базы знаний. Строки индекса ссылаются на слоты BrainStore;
+    при правке записи ее старая строка помечается неактуальной и добавляется новая.
+    """
+
+    def __init__(self, idf, centroids, trained_size):
+        self.idf = idf
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self._vectors = sparse.csr_matrix((0, HASH_DIMENSION), dtype=np.float32)
+        self._pending = []
+        self._row_slots = np.empty(0, dtype=np.int64)
+        self._row_lists = np.empty(0, dtype=np.int32)
+        self._row_live = np.empty(0, dtype=bool)
+        self._row_names = []
+        self._slot_rows = {}
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(len(centroids))]
+        self._brain_index = None
+        self._synced = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._slot_rows)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def vectorize(self, names):
+        """Векторы наименований: хешированные n-граммы с весами IDF, нормированные по L2"""
+        return _normalize_rows(_binary_matrix(names).multiply(self.idf[None, :]).tocsr())
+
+    @classmethod
+    def train(cls, names):
+        """Обучает центры кластеров сферическим k-means на выборке наименований"""
+        binary = _binary_matrix(names)
+        size = len(names)
+        document_frequency = np.bincount(binary.indices, minlength=HASH_DIMENSION)
+        idf = (np.log((1 + size) / (1 + document_frequency)) + 1.0).astype(np.float32)
+        nlist = max(1, min(MAX_LISTS, int(np.sqrt(size)))) if size else 0
+        if not nlist:
+            return cls(idf, np.zeros((0, HASH_DIMENSION), dtype=np.float32), 0)
+
+        rng = np.random.default_rng(KMEANS_SEED)
+        sample_size = min(size, nlist * KMEANS_SAMPLE_PER_LIST)
+        sample = _normalize_rows(binary[np.sort(rng.choice(size, sample_size, replace=False))].multiply(idf[None, :]).tocsr())
+        centroids = _normalize_dense(sample[rng.choice(sample_size, nlist, replace=False)].toarray())
+
+        index = cls(idf, centroids, size)
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = index._assign(sample)
+            membership = sparse.csr_matrix((np.ones(sample_size, dtype=np.float32), (assignment, np.arange(sample_size))),
+                                           shape=(nlist, sample_size))
+            sums = (membership @ sample).toarray()
+            # Пустые кластеры сохраняют прежний центр
+            empty = np.asarray(membership.sum(axis=1)).ravel() == 0
+            sums[empty] = index.centroids[empty]
+            index.centroids = _normalize_dense(sums)
+        logger.info(f"Обучены центры приближенного поиска: {nlist} кластеров по выборке из {sample_size} записей")
+        return index
+
+    def _assign(self, vectors):
+        """Номер ближайшего центра для каждой строки (по блокам строк)"""
+        assignment = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], ASSIGN_BLOCK_SIZE):
+            scores = vectors[start:start + ASSIGN_BLOCK_SIZE] @ self.centroids.T
+            assignment[start:start + ASSIGN_BLOCK_SIZE] = np.asarray(scores).argmax(axis=1)
+        return assignment
+
+    def _add_rows(self, vectors, slots, names, assignment=None):
+        """Добавляет строки (векторы уже посчитаны) и раскладывает их по кластерам"""
+        if not len(slots):
+            return
+        if assignment is None:
+            assignment = self._assign(vectors)
+        first_row = len(self._row_names)
+        rows = np.arange(first_row, first_row + len(slots), dtype=np.int64)
+        slots = np.asarray(slots, dtype=np.int64)
+
+        # Прежние строки этих слотов больше не участвуют в поиске
+        stale = [self._slot_rows[slot] for slot in slots.tolist() if slot in self._slot_rows]
+        self._row_live[stale] = False
+
+        self._pending.append(vectors)
+        self._row_slots = np.concatenate([self._row_slots, slots])
+        self._row_lists = np.concatenate([self._row_lists, assignment.astype(np.int32)])
+        self._row_live = np.concatenate([self._row_live, np.ones(len(slots), dtype=bool)])
+        self._row_names.extend(names)
+        self._slot_rows.update(zip(slots.tolist(), rows.tolist()))
+
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(self.nlist + 1))
+        for list_id in np.unique(assignment).tolist():
+            added = rows[order[bounds[list_id]:bounds[list_id + 1]]]
+            self._lists[list_id] = np.concatenate([self._lists[list_id], added])
+
+    def add(self, slots, names):
+        """Добавляет (или заменяет) записи слотов без переобучения центров"""
+        with self._lock:
+            self._add_rows(self.vectorize(names), slots, names)
+
+    def remove(self, slot):
+        """Исключает запись слота из поиска"""
+        with self._lock:
+            row = self._slot_rows.pop(slot, None)
+            if row is not None:
+                self._row_live[row] = False
+
+    def _consolidate(self):
+        if self._pending:
+            self._vectors = sparse.vstack([self._vectors] + self._pending, format='csr')
+            self._pending = []
+
+    def sync(self, brain_index):
+        """Догоняет правки индекса базы знаний, сделанные после последней синхронизации"""
+        with self._lock:
+            changed = brain_index.changed_slots[self._synced:]
+            self._synced += len(changed)
+            if not changed:
+                return
+            items = brain_index.items
+            slots = list(dict.fromkeys(changed))
+            for slot in slots:
+                if not items.is_live(slot):
+                    self.remove(slot)
+            live = [slot for slot in slots if items.is_live(slot)]
+            self.add(live, [items.names[slot] for slot in live])
+
+    def matches(self, brain_items):
+        """Проверяет, что строки индекса соответствуют текущим записям базы знаний"""
+        live_slots = list(brain_items.live_slots())
+        if len(live_slots) != len(self._slot_rows):
+            return False
+        for slot in live_slots:
+            row = self._slot_rows.get(slot)
+            if row is None or self._row_names[row] != brain_items.names[slot]:
+                return False
+        return True
+
+    def top_k(self, names, k=10, nprobe=None):
+        """
+        Находит k ближайших записей базы знаний для каждого наименования
+
+        Args:
+            names (list): Наименования запросов
+            k (int): Количество кандидатов на наименование
+            nprobe (int): Сколько ближайших кластеров просматривать (по умолчанию из конфигурации)
+
+        Returns:
+            tuple: (indices, scores) - как у TfidfMatcher.top_k: слоты записей (-1, если
+                кандидатов меньше k) и косинусное сходство, по убыванию сходства
+        """
+        count = len(names)
+        k = max(1, k)
+        indices = np.full((count, k), -1, dtype=np.int64)
+        scores = np.zeros((count, k), dtype=np.float32)
+        if not count or not self.nlist:
+            return indices, scores
+
+        with self._lock:
+            self._consolidate()
+            nprobe = max(1, min(nprobe or config.get_ann_nprobe(), self.nlist))
+            queries = self.vectorize(names)
+            for start in range(0, count, ASSIGN_BLOCK_SIZE):
+                block = queries[start:start + ASSIGN_BLOCK_SIZE]
+                centroid_scores = np.asarray(block @ self.centroids.T)
+                if nprobe < self.nlist:
+                    probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+                else:
+                    probes = np.tile(np.arange(self.nlist), (block.shape[0], 1))
+
+                for row in range(block.shape[0]):
+                    candidates = np.concatenate([self._lists[list_id] for list_id in probes[row]])
+                    candidates = candidates[self._row_live[candidates]]
+                    if not len(candidates):
+                        continue
+                    query = block[row].toarray().ravel()
+                    row_scores = self._vectors[candidates] @ query
+                    positive = row_scores > 0
+                    row_scores, candidates = row_scores[positive], candidates[positive]
+                    if len(row_scores) > k:
+                        top = np.argpartition(-row_scores, k - 1)[:k]
+                        row_scores, candidates = row_scores[top], candidates[top]
+                    slots = self._row_slots[candidates]
+                    order = np.lexsort((slots, -row_scores))
+                    found = len(order)
+                    indices[start + row, :found] = slots[order]
+                    scores[start + row, :found] = row_scores[order]
+        return indices, scores
+
+    @classmethod
+    def build(cls, brain_items, previous=None):
+        """
+        Строит индекс по живым записям базы знаний. Центры кластеров, векторы и
+        распределение по кластерам наименований, уже известных previous, переиспользуются;
+        новые наименования только добавляются.
+        """
+        slots = list(brain_items.live_slots())
+        names = [brain_items.names[slot] for slot in slots]
+        if previous is None or not previous.nlist or len(slots) > previous.trained_size * RETRAIN_GROWTH:
+            index = cls.train(names)
+            index._add_rows(index.vectorize(names), slots, names)
+            return index
+
+        with previous._lock:
+            previous._consolidate()
+            index = cls(previous.idf, previous.centroids, previous.trained_size)
+            known = {previous._row_names[row]: row for row in previous._slot_rows.values()}
+            reused = [(slot, name, known[name]) for slot, name in zip(slots, names) if name in known]
+            added = [(slot, name) for slot, name in zip(slots, names) if name not in known]
+            if reused:
+                rows = np.array([row for _, _, row in reused], dtype=np.int64)
+                index._add_rows(previous._vectors[rows], [slot for slot, _, _ in reused],
+                                [name for _, name, _ in reused], previous._row_lists[rows])
+        if added:
+            index.add([slot for slot, _ in added], [name for _, name in added])
+        logger.info(f"Обновлен индекс приближенного поиска: {len(reused)} записей из прежнего индекса, {len(added)} новых")
+        return index
+
+    def save(self, index_file):
+        """Атомарно сохраняет индекс на диск (только актуальные строки)"""
+        with self._lock:
+            self._consolidate()
+            live_rows = np.array(sorted(self._slot_rows.values()), dtype=np.int64)
+            vectors = self._vectors[live_rows] if len(live_rows) else self._vectors[:0]
+            data = {
+                'version': ANN_FORMAT_VERSION,
+                'params': (HASH_DIMENSION, KMEANS_SEED),
+                'idf': self.idf,
+                'centroids': self.centroids,
+                'trained_size': self.trained_size,
+                'vectors': (vectors.data, vectors.indices, vectors.indptr),
+                'slots': self._row_slots[live_rows],
+                'lists': self._row_lists[live_rows],
+                'names': [self._row_names[row] for row in live_rows.tolist()],
+            }
+        index_file = Path(index_file)
+        tmp_file = index_file.with_name(index_file.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        """Загружает индекс с диска или возвращает None"""
+        try:
+            with open(index_file, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать индекс приближенного поиска {index_file}: {e}")
+            return None
+        if data.get('version') != ANN_FORMAT_VERSION or tuple(data.get('params', ())) != (HASH_DIMENSION, KMEANS_SEED):
+            return None
+
+        index = cls(data['idf'], data['centroids'], data['trained_size'])
+        names = data['names']
+        vectors = sparse.csr_matrix(data['vectors'], shape=(len(names), HASH_DIMENSION), dtype=np.float32)
+        index._add_rows(vectors, data['slots'], names, data['lists'])
+        return index
+
+
+def ann_enabled(brain_size):
+    """Нужен ли приближенный поиск для базы такого размера (по настройке candidate_generator)"""
+    mode = config.get_candidate_generator()
+    if mode == 'ann':
+        return True
+    if mode == 'exact':
+        return False
+    return brain_size >= config.get_ann_min_brain_size()
+
+
+_shared_ann = None
+_shared_ann_lock = threading.Lock()
+
+
+def get_ann_index(brain_index, brain_file="brain.json"):
+    """
+    Возвращает индекс приближенного поиска для индекса базы знаний.
+    Правки записей догоняются точечно; при смене индекса базы знаний (перезагрузка brain.json)
+    индекс читается с диска и дополняется новыми наименованиями, затем сохраняется.
+    """
+    global _shared_ann
+    with _shared_ann_lock:
+        ann = _shared_ann
+        if ann is not None and ann._brain_index is brain_index:
+            ann.sync(brain_index)
+            return ann
+
+        ann_file = Path(str(brain_file) + '.ann')
+        if ann is None and ann_file.exists():
+            ann = AnnIndex.load(ann_file)
+
+        if ann is None or not ann.matches(brain_index.items):
+            ann = AnnIndex.build(brain_index.items, ann)
+            try:
+                ann.save(ann_file)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить индекс приближенного поиска: {e}")
+
+        ann._brain_index = brain_index
+        ann._synced = len(brain_index.changed_slots)
+        _shared_ann = ann
+        return ann
+
+
+def get_candidate_generator(brain_index, brain_file="brain.json"):
+    """
+    Источник кандидатов для пакетного нечеткого поиска: точный TF-IDF по всей базе
+    или приближенный поиск для больших баз. Оба возвращают top_k(names, k) -> (indices, scores).
+    """
+    if ann_enabled(len(brain_index)):
+        return get_ann_index(brain_index, brain_file)
+    return get_tfidf_matcher(brain_index)
@@ -2,12 +2,18 @@ from flask import Flask, render_template, request, jsonify, send_file, Response
 from flask_cors import CORS
 import logging
 from controller import SmetaAIController
+from brain_index import get_brain_index
+from brain_service import BrainService
+from suggest import SUGGEST_LIMIT, get_suggest_index, warm_suggest_index
+from near_duplicates import get_near_duplicate_index
+from attributes import extract_attributes
 from pathlib import Path
 import json
 import pandas as pd
 from datetime import datetime
 from io import BytesIO
 import os
+import time
 
 # --- Настройка ---
 # Настройка Flask
@@ -17,14 +23,40 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Создание необходимых директорий при запуске
-Path("input").mkdir(exist_ok=True)
-Path("calculate").mkdir(exist_ok=True)
-Path("output").mkdir(exist_ok=True)
-logger.info("Проверено наличие директорий input, calculate, output.")
+# Контроллер и сервис базы знаний создаются в create_app(): процессы пула расчета смет
+# заново импортируют главный модуль и не должны запускать свои сервисы
+controller = None
+brain_service = None
 
-# Инициализация контроллера
-controller = SmetaAIController(app)
+
+def create_app():
+    """Создает директории, контроллер и сервис базы знаний; возвращает приложение Flask"""
+    global controller, brain_service
+    if controller is not None:
+        return app
+
+    # Создание необходимых директорий при запуске
+    Path("input").mkdir(exist_ok=True)
+    Path("calculate").mkdir(exist_ok=True)
+    Path("output").mkdir(exist_ok=True)
+    logger.info("Проверено наличие директорий input, calculate, output.")
+
+    # Инициализация контроллера
+    controller = SmetaAIController(app)
+
+    # Сервис базы знаний: индекс в памяти, точечные правки и перезагрузка при изменении brain.json
+    brain_service = BrainService('brain.json')
+    # После перезагрузки или правки базы подсказки и калькулятор готовятся в фоне,
+    # а запросы до их готовности обслуживаются прежними
+    brain_service.add_warmup(warm_suggest_index)
+    brain_service.add_warmup(lambda index: controller.warm_matcher())
+    brain_service.start()
+    return app
+
+# Ограничение размера синхронного запроса сопоставления
+MATCH_API_MAX_ITEMS = 500
+# Максимум подсказок за запрос
+SUGGEST_API_MAX_LIMIT = 200
 
 # --- Маршруты (Routes) ---
 
@@ -54,22 +86,80 @@ def start_ingest():
 
 @app.route('/api/optimize', methods=['POST'])
 def start_optimize():
-    """Запускает процесс оптимизации."""
+    """
+    Запускает процесс оптимизации.
+    По умолчанию инкрементально (только новые сырые записи); JSON {"full": true} пересобирает базу полностью.
+    Поле "clustering" ("ai", "local" - без AI, "auto") переопределяет способ кластеризации из конфигурации.
+    """
     try:
-        message = controller.start_optimize_async()
+        data = request.get_json(silent=True) or {}
+        clustering = data.get('clustering')
+        if clustering is not None and clustering not in ('auto', 'ai', 'local'):
+            return jsonify({"error": "Поле clustering должно быть auto, ai или local"}), 400
+        # Оптимизация читает brain.json с диска - отложенные правки редактора записываются до нее
+        brain_service.flush()
+        message = controller.start_optimize_async(bool(data.get('full', False)), clustering)
         return jsonify({"message": message}), 202
     except RuntimeError as e:
         return jsonify({"error": str(e)}), 409
 
 @app.route('/api/calculate', methods=['POST'])
 def start_calculate():
-    """Запускает процесс расчета для ВСЕХ смет в папке 'calculate'."""
+    """
+    Запускает процесс расчета смет.
+    Принимает JSON {"files": [...], "skip_unchanged": true} или загрузку файлов (поле files);
+    без списка файлов рассчитываются все сметы в папке 'calculate'.
+    """
     try:
-        message = controller.start_calculate_async()
+        # Проверка до сохранения загрузок: иначе файлы запущенного расчета были бы перезаписаны
+        if controller.is_task_running():
+            return jsonify({"error": "Другая задача уже выполняется."}), 409
+        
+        uploads = request.files.getlist('files') + request.files.getlist('file')
+        if uploads:
+            file_names = controller.save_calculate_uploads(uploads)
+            skip_unchanged = request.form.get('skip_unchanged', '').lower() in ('1', 'true', 'yes', 'on')
+        else:
+            data = request.get_json(silent=True) or {}
+            file_names = data.get('files') or None
+            skip_unchanged = bool(data.get('skip_unchanged', False))
+        
+        if file_names is not None and (not isinstance(file_names, list)
+                                       or not all(isinstance(name, str) and name.strip() for name in file_names)):
+            return jsonify({"error": "Поле files должно быть списком имен файлов"}), 400
+        
+        # Версия кэша сопоставлений считается по brain.json - записываем отложенные правки
+        brain_service.flush()
+        message = controller.start_calculate_async(file_names, skip_unchanged)
         return jsonify({"message": message}), 202
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except RuntimeError as e:
         return jsonify({"error": str(e)}), 409
 
+@app.route('/api/match', methods=['POST'])
+def match_items():
+    """
+    Синхронно сопоставляет позиции с базой знаний и возвращает цены.
+    Принимает JSON {"items": ["наименование" или {"name": ..., "unit": ...}], "allow_ai": false};
+    без allow_ai используется только локальный индекс (точное, кэш, нечеткое совпадение).
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list):
+        return jsonify({"error": "Поле items должно быть списком позиций"}), 400
+    if len(items) > MATCH_API_MAX_ITEMS:
+        return jsonify({"error": f"Слишком много позиций: максимум {MATCH_API_MAX_ITEMS} за запрос"}), 400
+
+    try:
+        started = time.perf_counter()
+        results = controller.match_items(items, allow_ai=bool(data.get('allow_ai', False)))
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        return jsonify({"results": results, "elapsed_ms": elapsed_ms})
+    except Exception as e:
+        app.logger.error(f"Error matching items: {e}")
+        return jsonify({"error": "Failed to match items"}), 500
+
 @app.route('/api/files', methods=['GET'])
 def get_files():
     """Возвращает списки файлов."""
@@ -94,24 +184,48 @@ def get_ai_logs():
 def get_brain_data():
     """Возвращает данные базы знаний для отображения в UI."""
     try:
-        brain_file = Path("brain.json")
-        if not brain_file.exists():
-            return jsonify([])
-        
-        with open(brain_file, 'r', encoding='utf-8') as f:
-            brain_data = json.load(f)
-        
-        # Убеждаемся, что возвращаем массив
-        if isinstance(brain_data, list):
-            return jsonify(brain_data)
-        else:
-            # Обратная совместимость со старым форматом
-            return jsonify(brain_data.get('items', []))
+        # Отдаем записи из общего индекса, без повторного разбора brain.json
+        return jsonify(get_brain_index().items.to_dicts())
     
     except Exception as e:
         app.logger.error(f"Error reading brain data: {e}")
         return jsonify({"error": "Failed to load brain data"}), 500
 
+@app.route('/api/brain/suggest', methods=['GET'])
+def suggest_brain():
+    """
+    Подсказки по базе знаний для набираемого наименования: ?q=<текст>&limit=<N>&price=material|work.
+    Без q возвращает первые записи базы. Каждая запись содержит index - позицию в brain.json.
+    """
+    try:
+        started = time.perf_counter()
+        query = request.args.get('q', '').strip()
+        limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int), SUGGEST_API_MAX_LIMIT))
+        price = request.args.get('price') or None
+
+        brain_index = get_brain_index()
+        items = brain_index.items
+        if query:
+            # Дерево подсказок может еще относиться к прежнему индексу - записи берутся из него
+            suggest_index = get_suggest_index(brain_index)
+            items = suggest_index.brain_index.items
+            slots = suggest_index.suggest(query, limit, price)
+        else:
+            price_field = {'material': 'material_price', 'work': 'work_price'}.get(price)
+            slots = []
+            for slot in items.live_slots():
+                if not price_field or items.get_field(slot, price_field) > 0:
+                    slots.append(slot)
+                    if len(slots) >= limit:
+                        break
+
+        results = [dict(items.to_dict(slot), index=items.position_of(slot)) for slot in slots]
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        return jsonify({"query": query, "total": len(items), "results": results, "elapsed_ms": elapsed_ms})
+    except Exception as e:
+        app.logger.error(f"Error suggesting brain items: {e}")
+        return jsonify({"error": "Failed to suggest brain items"}), 500
+
 @app.route('/api/brain/edit', methods=['POST'])
 def edit_brain():
     """Редактирование записи в базе знаний"""
@@ -129,29 +243,25 @@ def edit_brain():
         if not name:
             return jsonify({"error": "Наименование обязательно"}), 400
         
-        # Читаем текущую базу знаний
         brain_file = 'brain.json'
         if not os.path.exists(brain_file):
             return jsonify({"error": "База знаний не найдена"}), 404
         
-        with open(brain_file, 'r', encoding='utf-8') as f:
-            brain_data = json.load(f)
-        
-        if index >= len(brain_data):
+        if index >= len(brain_service.index):
             return jsonify({"error": "Запись не найдена"}), 404
         
         # Обновляем запись
-        brain_data[index]['name'] = name
-        brain_data[index]['unit'] = data.get('unit', '').strip()
-        brain_data[index]['material_price'] = float(data.get('material_price', 0))
-        brain_data[index]['work_price'] = float(data.get('work_price', 0))
-        brain_data[index]['material_price_approved'] = bool(data.get('material_price_approved', False))
-        brain_data[index]['work_price_approved'] = bool(data.get('work_price_approved', False))
-        brain_data[index]['updated_at'] = datetime.now().isoformat()
-        
-        # Сохраняем обновленную базу знаний
-        with open(brain_file, 'w', encoding='utf-8') as f:
-            json.dump(brain_data, f, ensure_ascii=False, indent=2)
+        item = brain_service.get_record(index)
+        item['name'] = name
+        item['unit'] = data.get('unit', '').strip()
+        item['material_price'] = float(data.get('material_price', 0))
+        item['work_price'] = float(data.get('work_price', 0))
+        item['material_price_approved'] = bool(data.get('material_price_approved', False))
+        item['work_price_approved'] = bool(data.get('work_price_approved', False))
+        item['updated_at'] = datetime.now().isoformat()
+        
+        # Сохраняем базу знаний и обновляем индекс только по этой записи
+        brain_service.update_record(index, item)
         
         return jsonify({"message": "Запись успешно обновлена"})
         
@@ -172,23 +282,15 @@ def delete_brain():
         if index is None or index < 0:
             return jsonify({"error": "Неверный индекс"}), 400
         
-        # Читаем текущую базу знаний
         brain_file = 'brain.json'
         if not os.path.exists(brain_file):
             return jsonify({"error": "База знаний не найдена"}), 404
         
-        with open(brain_file, 'r', encoding='utf-8') as f:
-            brain_data = json.load(f)
-        
-        if index >= len(brain_data):
+        if index >= len(brain_service.index):
             return jsonify({"error": "Запись не найдена"}), 404
         
-        # Удаляем запись
-        deleted_item = brain_data.pop(index)
-        
-        # Сохраняем обновленную базу знаний
-        with open(brain_file, 'w', encoding='utf-8') as f:
-            json.dump(brain_data, f, ensure_ascii=False, indent=2)
+        # Удаляем запись и сохраняем базу знаний
+        deleted_item = brain_service.delete_record(index)
         
         print(f"Удалена запись: {deleted_item.get('name', 'Без названия')}")
         return jsonify({"message": "Запись успешно удалена"})
@@ -235,6 +337,7 @@ def edit_raw_item():
         records[index]['unit'] = unit
         records[index]['material_price'] = material_price
         records[index]['work_price'] = work_price
+        records[index]['attributes'] = extract_attributes(name, unit)
         records[index]['updated_at'] = datetime.now().isoformat()
         
         # Сохраняем
@@ -248,6 +351,31 @@ def edit_raw_item():
         app.logger.error(f"Error editing raw data item: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/brain/duplicates', methods=['GET'])
+def find_brain_duplicates():
+    """
+    Возвращает вероятные дубликаты записи базы знаний (кандидаты на объединение).
+    Принимает ?index=<номер записи> или ?name=<наименование>, опционально &source=brain|raw.
+    """
+    try:
+        name = request.args.get('name', '').strip()
+        index = request.args.get('index', type=int)
+        if not name:
+            brain_items = get_brain_index().items
+            if index is None or not 0 <= index < len(brain_items):
+                return jsonify({"error": "Укажите наименование или номер записи"}), 400
+            name = brain_items[index]['name']
+        
+        threshold = request.args.get('threshold', type=float)
+        duplicates = get_near_duplicate_index().query(name, threshold=threshold, source=request.args.get('source') or None)
+        if index is not None:
+            duplicates = [d for d in duplicates if not (d['source'] == 'brain' and d['index'] == index)]
+        return jsonify({"name": name, "duplicates": duplicates})
+    
+    except Exception as e:
+        app.logger.error(f"Error finding duplicates: {e}")
+        return jsonify({"error": "Failed to find duplicates"}), 500
+
 @app.route('/api/brain/export', methods=['GET'])
 def export_brain():
     """Экспортирует базу знаний в Excel файл."""
@@ -256,12 +384,7 @@ def export_brain():
         if not brain_file.exists():
             return jsonify({'error': 'База знаний не найдена'}), 404
         
-        with open(brain_file, 'r', encoding='utf-8') as f:
-            brain_data = json.load(f)
-        
-        # Новый формат - массив объектов
-        if not isinstance(brain_data, list):
-            return jsonify({'error': 'Неверный формат базы знаний'}), 400
+        brain_data = get_brain_index(brain_file).items
         
         # Преобразуем в DataFrame
         rows = []
@@ -341,9 +464,8 @@ def import_brain():
         if not brain_data:
             return jsonify({'error': 'Не найдено записей с ценами для импорта'}), 400
         
-        # Сохраняем в новом формате
-        with open('brain.json', 'w', encoding='utf-8') as f:
-            json.dump(brain_data, f, ensure_ascii=False, indent=2)
+        # Сохраняем в новом формате (индекс строится заново и подменяется целиком)
+        brain_service.replace_all(brain_data)
         
         app.logger.info(f"Brain imported: {len(brain_data)} items")
         return jsonify({'success': True, 'count': len(brain_data)})
@@ -389,6 +511,8 @@ def reset_status():
 def clear_data():
     """Полностью очищает сгенерированные данные (raw_data, brain)."""
     try:
+        # Иначе фоновая запись отложенных правок создала бы brain.json заново
+        brain_service.flush()
         message = controller.clear_all_data()
         return jsonify({"message": message}), 200
     except RuntimeError as e:
@@ -406,4 +530,4 @@ def get_raw_data():
 # --- Main ---
 if __name__ == '__main__':
     # Очистка состояния при запуске, если это необходимо
-    app.run(debug=True, host='0.0.0.0', port=8000) 
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=8000) 
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+Извлечение технических характеристик из наименований позиций:
+диаметр (Ф315, 315мм, диаметр 315, дюймовый Ø1/2" - одно значение "1/2""),
+сечение кабеля (3x2.5), габарит (700x400), мощность (кВт) и нормализованная единица измерения.
+Характеристики используются, чтобы не сопоставлять позиции с разными размерами
+(Ф100 никогда не должен совпасть с Ф315).
+"""
+
+import re
+
+# Характеристики, по которым проверяется совместимость, в порядке вывода
+ATTRIBUTE_FIELDS = ('diameter', 'section', 'size', 'power_kw', 'unit')
+
+# Стандартные сечения жил кабеля, мм²
+CABLE_SECTIONS = {
+    0.35, 0.5, 0.75, 1.0, 1.5, 2.5, 4.0, 6.0, 10.0, 16.0, 25.0, 35.0, 50.0,
+    70.0, 95.0, 120.0, 150.0, 185.0, 240.0, 300.0, 400.0
+}
+MAX_CABLE_CORES = 61
+
+_NUMBER = r'(\d+(?:[.,]\d+)?)'
+_TIMES = r'\s*[xх×*]\s*'
+
+_DIAMETER_PREFIX = r'(?:[фød⌀]|ду|dn|диаметр(?:ом)?)'
+# Целая часть смешанной дроби - одна цифра (1 1/4"), чтобы "Ф15 1/2"" не читался как 15 1/2"
+_FRACTION = r'(?:\d[ -])?\d+/\d+'
+_INCH_MARK = r'\s*(?:"|\'\'|”|″|дюйм)'
+
+_DIAMETER_RE = re.compile(r'(?<![а-яa-z])' + _DIAMETER_PREFIX + r'\s*' + _NUMBER + r'(?![\d.,]*(?:/|' + _TIMES + r'\d))')
+# Дюймовый размер: дробь после Ø/Ду или число (дробь) со знаком дюйма - 1/2", Ø1/2, 1 1/4", 2"
+_INCH_RE = re.compile(r'(?<![а-яa-z\d.,/])(?:' + _DIAMETER_PREFIX + r'\s*(' + _FRACTION + r')|(?:' + _DIAMETER_PREFIX +
+                      r'\s*)?(' + _FRACTION + r'|\d+(?:[.,]\d+)?)(?=' + _INCH_MARK + r'))')
+_DIMENSIONS_RE = re.compile(r'(?<![\d.,])' + _NUMBER + _TIMES + _NUMBER + r'(?:' + _TIMES + _NUMBER + r')?')
+_MM_RE = re.compile(r'(?<![\d.,xх×*])(\d+)\s*мм(?![²2\w])')
+_POWER_KW_RE = re.compile(_NUMBER + r'\s*квт')
+_POWER_W_RE = re.compile(r'(?<![\d.,])(\d+)\s*вт\b')
+_WORD_RE = re.compile(r'[^\W\d_]+')
+
+# Основы слов, рядом с которыми "NN мм" означает диаметр
+_DIAMETER_CONTEXT = ('диаметр', 'труб', 'воздуховод', 'отвод', 'переход', 'тройник', 'фланец', 'фланц', 'муфт',
+                     'заглушк', 'клапан', 'кран', 'задвижк', 'хомут', 'гильз', 'патрубок', 'ниппел', 'штуцер', 'врезк',
+                     'вентилятор', 'шумоглушител')
+# Сколько слов перед "NN мм" просматривается в поисках такого слова
+DIAMETER_CONTEXT_WORDS = 3
+
+# Варианты написания единиц измерения -> нормализованная единица
+_UNIT_ALIASES = {
+    'шт': ('шт', 'штук', 'штука', 'штуки', 'ед', 'единица'),
+    'компл': ('компл', 'комплект', 'к-т', 'кмпл', 'компл-т', 'комп'),
+    'м': ('м', 'мп', 'м.п', 'п.м', 'пм', 'м.пог', 'пог.м', 'пог. м', 'м пог', 'метр', 'погонный метр'),
+    'м2': ('м2', 'м²', 'кв.м', 'кв. м', 'м.кв'),
+    'м3': ('м3', 'м³', 'куб.м', 'куб. м', 'м.куб'),
+    'кг': ('кг', 'килограмм'),
+    'т': ('т', 'тн', 'тонна'),
+    'л': ('л', 'литр'),
+    'упак': ('упак', 'уп', 'упаковка'),
+}
+_UNIT_BY_ALIAS = {alias: unit for unit, aliases in _UNIT_ALIASES.items() for alias in aliases}
+_SPACES_RE = re.compile(r'\s+')
+
+
+def _normalize(text):
+    """Регистр, ё/е и лишние пробелы (без зависимости от индекса базы знаний)"""
+    if text is None:
+        return ''
+    return _SPACES_RE.sub(' ', str(text).lower().replace('ё', 'е')).strip()
+
+
+def _to_number(text):
+    """Число из строки с запятой или точкой; целые значения приводятся к int для сравнения"""
+    value = float(text.replace(',', '.'))
+    return int(value) if value.is_integer() else value
+
+
+def _inch_size(match):
+    """Дюймовый размер одной строкой: 1/2", 1 1/4", 2" """
+    value = match.group(1) or match.group(2)
+    if '/' in value:
+        return re.sub(r'[ -]', ' ', value) + '"'
+    return f'{_to_number(value)}"'
+
+
+def _is_diameter_context(text, position):
+    """
+    "NN мм" в позиции position считается диаметром, если стоит сразу после первого слова
+    (наименования изделия: "Воздуховод 315 мм") или рядом со словом о трубе или диаметре
+    """
+    before = text[:position]
+    if _WORD_RE.fullmatch(before.strip(' .,:;-')):
+        return True
+    return any(word.startswith(_DIAMETER_CONTEXT) for word in _WORD_RE.findall(before)[-DIAMETER_CONTEXT_WORDS:])
+
+
+def normalize_unit(unit):
+    """Приводит единицу измерения к одному написанию (шт./Шт./штук -> шт); пустая строка, если не указана"""
+    text = _normalize(unit).rstrip('. ')
+    if not text:
+        return ''
+    return _UNIT_BY_ALIAS.get(text, _UNIT_BY_ALIAS.get(text.replace(' ', ''), text))
+
+
+def extract_attributes(name, unit=None):
+    """
+    Извлекает характеристики из наименования
+
+    Args:
+        name (str): Наименование позиции
+        unit (str): Единица измерения (если известна)
+
+    Returns:
+        dict: Найденные характеристики (ключи из ATTRIBUTE_FIELDS, только найденные)
+    """
+    text = _normalize(name)
+    attributes = {}
+
+    # Дюймовый размер - одно значение ("1/2""), иначе Ø1/2" читался бы как диаметр 1
+    match = _INCH_RE.search(text)
+    if match:
+        attributes['diameter'] = _inch_size(match)
+    else:
+        match = _DIAMETER_RE.search(text)
+        if match:
+            attributes['diameter'] = _to_number(match.group(1))
+
+    for match in _DIMENSIONS_RE.finditer(text):
+        first, second, third = match.groups()
+        if third is None and 'section' not in attributes and \
+                int(float(first.replace(',', '.'))) <= MAX_CABLE_CORES and first.isdigit() and \
+                float(second.replace(',', '.')) in CABLE_SECTIONS:
+            attributes['section'] = f"{int(first)}x{_to_number(second)}"
+        elif 'size' not in attributes:
+            attributes['size'] = 'x'.join(str(_to_number(v)) for v in (first, second, third) if v is not None)
+
+    # "315мм" считается диаметром, только если другого размера в наименовании нет
+    # и число стоит рядом с наименованием изделия ("Сдача системы в 2 этапа 100 мм" - не диаметр)
+    if not attributes:
+        for match in _MM_RE.finditer(text):
+            if int(match.group(1)) >= 10 and _is_diameter_context(text, match.start()):
+                attributes['diameter'] = int(match.group(1))
+                break
+
+    match = _POWER_KW_RE.search(text)
+    if match:
+        attributes['power_kw'] = _to_number(match.group(1))
+    else:
+        match = _POWER_W_RE.search(text)
+        if match:
+            attributes['power_kw'] = _to_number(str(int(match.group(1)) / 1000))
+
+    unit = normalize_unit(unit)
+    if unit:
+        attributes['unit'] = unit
+    return attributes
+
+
+def attributes_compatible(attributes1, attributes2):
+    """
+    Проверяет, что характеристики не противоречат друг другу:
+    характеристика, указанная у обеих позиций, должна совпадать
+    """
+    if not attributes1 or not attributes2:
+        return True
+    for field, value in attributes1.items():
+        other = attributes2.get(field)
+        if other is not None and other != value:
+            return False
+    return True
@@ -0,0 +1,151 @@
+"""
+Разбиение сырых записей на небольшие блоки кандидатов перед AI кластеризацией.
+Записи группируются по ключевому слову наименования (основа первого значимого слова),
+слишком большие группы делятся по техническим характеристикам, затем по компонентам
+похожих наименований (MinHash/LSH) и, в крайнем случае, на отрезки отсортированного списка.
+В AI отправляются только блоки, поэтому стоимость кластеризации растет с числом блоков,
+а не с квадратом размера группы.
+"""
+
+import logging
+from collections import defaultdict
+
+from attributes import ATTRIBUTE_FIELDS, extract_attributes
+from brain_index import normalize_name, tokenize
+from config import config
+from near_duplicates import NearDuplicateIndex, SOURCE_RAW
+
+logger = logging.getLogger(__name__)
+
+# Длина основы слова для ключа блока (окончания в русском языке меняются)
+BLOCK_KEY_STEM = 5
+# Слова, описывающие вид работ, а не предмет: ключ блока берется по следующему слову
+GENERIC_WORDS = {
+    'монтаж', 'демонтаж', 'установка', 'прокладка', 'устройство', 'подключение', 'замена',
+    'наладка', 'пусконаладка', 'пуско', 'работы', 'работа', 'сборка', 'поставка', 'изготовление',
+    'по', 'из', 'для', 'на', 'с', 'со', 'в', 'и',
+}
+
+
+def block_key(name):
+    """Ключ блока: основа первого значимого слова наименования"""
+    return block_key_of_tokens(tokenize(name))
+
+
+def block_key_of_tokens(tokens):
+    """Ключ блока по уже выделенным нормализованным словам наименования"""
+    for token in tokens:
+        if len(token) >= 3 and token.isalpha() and token not in GENERIC_WORDS:
+            return token[:BLOCK_KEY_STEM]
+    return tokens[0][:BLOCK_KEY_STEM] if tokens else ''
+
+
+class UnionFind:
+    """Система непересекающихся множеств над номерами 0..size-1 (сжатие путей)"""
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 != root2:
+            # Корнем остается меньший номер - результат не зависит от порядка пар
+            self.parent[max(root1, root2)] = min(root1, root2)
+
+
+def _attribute_key(record):
+    attributes = record.get('attributes')
+    if attributes is None:
+        attributes = extract_attributes(record.get('name', ''), record.get('unit'))
+    return tuple((field, str(attributes[field])) for field in ATTRIBUTE_FIELDS if field in attributes)
+
+
+def _similarity_components(records, threshold, reference=None):
+    """
+    Компоненты связности записей по парам похожих наименований (MinHash/LSH).
+    Подписи, уже посчитанные в reference (общем индексе похожих наименований), переиспользуются.
+    """
+    index = NearDuplicateIndex()
+    rows = []
+    for i, record in enumerate(records):
+        name = record.get('name', '')
+        signature = reference.signature_of(normalize_name(name)) if reference is not None else None
+        rows.append(index.add(name, SOURCE_RAW, i, signature))
+
+    sets = UnionFind(len(index))
+    for row1, row2, _ in index.candidate_pairs(threshold):
+        sets.union(row1, row2)
+
+    components = defaultdict(list)
+    leftovers = []
+    for record, row in zip(records, rows):
+        if row is None:
+            leftovers.append(record)
+        else:
+            components[sets.find(row)].append(record)
+    return list(components.values()) + ([leftovers] if leftovers else [])
+
+
+def _chunks(records, max_block_size):
+    """Делит записи на отрезки отсортированного по наименованию списка"""
+    ordered = sorted(records, key=lambda record: normalize_name(record.get('name', '')))
+    return [ordered[i:i + max_block_size] for i in range(0, len(ordered), max_block_size)]
+
+
+def _split_block(records, max_block_size, threshold, reference=None):
+    """Делит слишком большой блок: характеристики -> похожие наименования -> отрезки"""
+    if len(records) <= max_block_size:
+        return [records]
+
+    by_attributes = defaultdict(list)
+    for record in records:
+        by_attributes[_attribute_key(record)].append(record)
+
+    blocks = []
+    for group in by_attributes.values():
+        if len(group) <= max_block_size:
+            blocks.append(group)
+            continue
+        for component in _similarity_components(group, threshold, reference):
+            if len(component) <= max_block_size:
+                blocks.append(component)
+            else:
+                blocks.extend(_chunks(component, max_block_size))
+    return blocks
+
+
+def build_blocks(records, max_block_size=None, threshold=None, reference=None):
+    """
+    Разбивает записи на блоки кандидатов для кластеризации
+
+    Args:
+        records (list): Записи сырых данных
+        max_block_size (int): Максимальный размер блока (по умолчанию из конфигурации)
+        threshold (float): Порог сходства наименований для деления больших блоков
+        reference (NearDuplicateIndex): Индекс, из которого берутся готовые подписи наименований
+
+    Returns:
+        list: Блоки (списки записей); записи разных блоков в один кластер не попадают
+    """
+    max_block_size = max_block_size or config.get_optimize_block_size()
+    threshold = config.get_near_duplicate_threshold() if threshold is None else threshold
+
+    by_key = defaultdict(list)
+    for record in records:
+        by_key[block_key(record.get('name', ''))].append(record)
+
+    blocks = []
+    for key in sorted(by_key):
+        blocks.extend(_split_block(by_key[key], max_block_size, threshold, reference))
+
+    sizes = [len(block) for block in blocks]
+    logger.info(f"Разбиение на блоки: {len(records)} записей -> {len(blocks)} блоков "
+                f"(максимальный размер {max(sizes, default=0)}, одиночных {sizes.count(1)})")
+    return blocks
@@ -0,0 +1,381 @@
+"""
+Общий индекс базы знаний (brain.json) в памяти.
+Строится один раз при загрузке базы и используется расчетом смет, поиском и API:
+поиск по точному и нормализованному имени за O(1), инвертированный индекс по словам
+и отбор top-k кандидатов по символьным n-граммам для передачи в AI.
+"""
+
+import heapq
+import logging
+from bisect import bisect_left, insort
+import re
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from attributes import ATTRIBUTE_FIELDS, attributes_compatible, extract_attributes
+from brain_store import BrainStore, load_brain_store
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+# Слова, встречающиеся чаще, не порождают кандидатов, а только уточняют оценку
+TOKEN_POSTINGS_LIMIT = 2000
+
+_QUOTES_RE = re.compile("[\"'«»“”„`]")
+_SPACES_RE = re.compile(r'\s+')
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def normalize_name(text):
+    """
+    Приводит наименование к нормализованному виду для сравнения:
+    регистр, ё/е, кавычки, лишние пробелы и точки в конце
+    """
+    if text is None:
+        return ""
+    text = str(text).lower().replace('ё', 'е')
+    text = _QUOTES_RE.sub('', text)
+    text = _SPACES_RE.sub(' ', text).strip()
+    return text.rstrip('. ')
+
+
+def tokenize(text):
+    """Разбивает наименование на нормализованные слова"""
+    return _TOKEN_RE.findall(normalize_name(text))
+
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Возвращает множество символьных n-грамм нормализованной строки"""
+    text = normalize_name(text)
+    if not text:
+        return set()
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def ngram_similarity(text1, text2):
+    """Коэффициент Дайса по символьным n-граммам двух строк (от 0 до 1)"""
+    grams1 = char_ngrams(text1)
+    grams2 = char_ngrams(text2)
+    if not grams1 or not grams2:
+        return 0.0
+    return 2.0 * len(grams1 & grams2) / (len(grams1) + len(grams2))
+
+
+def _remove_from_postings(postings, key, slot):
+    """Удаляет слот из отсортированного списка; пустой список удаляется целиком"""
+    posting = postings.get(key)
+    if not posting:
+        return
+    pos = bisect_left(posting, slot)
+    if pos < len(posting) and posting[pos] == slot:
+        del posting[pos]
+    if not posting:
+        del postings[key]
+
+
+class BrainIndex:
+    """
+    Индекс наименований базы знаний: словари по точному и нормализованному имени,
+    инвертированный индекс по словам и индекс символьных n-грамм для отбора кандидатов.
+    Индексы ссылаются на слоты BrainStore; правки одной записи обновляют только
+    списки этой записи, без перестроения всего индекса.
+    """
+
+    def __init__(self, brain_items):
+        # Все модули работают с одним представлением базы - колоночным BrainStore
+        if not isinstance(brain_items, BrainStore):
+            brain_items = BrainStore.from_items(brain_items or [])
+        self.items = brain_items
+        # Номер версии растет при каждой правке (по нему обновляются производные индексы)
+        self.version = 0
+        # Слоты записей, измененных после построения (по порядку правок) - для догоняющих индексов
+        self.changed_slots = []
+        self._write_lock = threading.Lock()
+        self._by_name = {}
+        self._by_normalized = {}
+        self._token_postings = defaultdict(list)
+        self._token_sets = []
+        self._ngram_postings = defaultdict(list)
+        self._ngram_counts = []
+        # Технические характеристики записей и вторичные индексы "характеристика -> значение -> записи"
+        self._attributes = []
+        self._attribute_postings = {field: defaultdict(list) for field in ATTRIBUTE_FIELDS}
+
+        for slot in self.items.live_slots():
+            self._index_slot(slot)
+
+        logger.info(f"Построен индекс базы знаний: {len(self.items)} записей, {len(self._ngram_postings)} n-грамм")
+
+    def _index_slot(self, slot):
+        """Добавляет запись слота во все индексы (списки остаются отсортированными по слоту)"""
+        name = self.items.names[slot]
+        while len(self._token_sets) <= slot:
+            self._token_sets.append(frozenset())
+            self._ngram_counts.append(0)
+            self._attributes.append({})
+
+        attributes = extract_attributes(name, self.items.unit(slot))
+        self._attributes[slot] = attributes
+        for field, value in attributes.items():
+            insort(self._attribute_postings[field][value], slot)
+        self._by_name.setdefault(name, slot)
+        self._by_normalized.setdefault(normalize_name(name), slot)
+        tokens = frozenset(tokenize(name))
+        self._token_sets[slot] = tokens
+        for token in tokens:
+            insort(self._token_postings[token], slot)
+        grams = char_ngrams(name)
+        self._ngram_counts[slot] = len(grams)
+        for gram in grams:
+            insort(self._ngram_postings[gram], slot)
+
+    def _unindex_slot(self, slot):
+        """Убирает запись слота из всех индексов (затрагиваются только ее слова и n-граммы)"""
+        name = self.items.names[slot]
+        for field, value in self._attributes[slot].items():
+            _remove_from_postings(self._attribute_postings[field], value, slot)
+        for token in self._token_sets[slot]:
+            _remove_from_postings(self._token_postings, token, slot)
+        for gram in char_ngrams(name):
+            _remove_from_postings(self._ngram_postings, gram, slot)
+        self._attributes[slot] = {}
+        self._token_sets[slot] = frozenset()
+        self._ngram_counts[slot] = 0
+
+        # Если по имени находилась эта запись - ищем другую живую запись с тем же именем
+        normalized = normalize_name(name)
+        same_name = [other for other in self._token_postings.get(next(iter(tokenize(name)), ''), ())
+                     if other != slot and normalize_name(self.items.names[other]) == normalized]
+        if self._by_name.get(name) == slot:
+            exact = [other for other in same_name if self.items.names[other] == name]
+            if exact:
+                self._by_name[name] = exact[0]
+            else:
+                del self._by_name[name]
+        if self._by_normalized.get(normalized) == slot:
+            if same_name:
+                self._by_normalized[normalized] = same_name[0]
+            else:
+                del self._by_normalized[normalized]
+
+    def update_record(self, position, item):
+        """Заменяет запись на позиции position; возвращает ее слот"""
+        with self._write_lock:
+            slot = self.items.slot_at(position)
+            self._unindex_slot(slot)
+            self.items.set_record(slot, item)
+            self._index_slot(slot)
+            self.changed_slots.append(slot)
+            self.version += 1
+            return slot
+
+    def add_record(self, item):
+        """Добавляет запись в конец базы; возвращает ее слот"""
+        with self._write_lock:
+            slot = self.items.append_record(item)
+            self._index_slot(slot)
+            self.changed_slots.append(slot)
+            self.version += 1
+            return slot
+
+    def remove_record(self, position):
+        """Удаляет запись на позиции position; возвращает ее слот"""
+        with self._write_lock:
+            slot = self.items.slot_at(position)
+            self._unindex_slot(slot)
+            self.items.remove_record(position)
+            self.changed_slots.append(slot)
+            self.version += 1
+            return slot
+
+    def record(self, slot):
+        """Запись по слоту"""
+        return self.items.record(slot)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, name):
+        """Возвращает запись базы знаний по точному наименованию или None"""
+        idx = self._by_name.get(name)
+        return self.items.record(idx) if idx is not None else None
+
+    def resolve(self, name):
+        """
+        Находит запись по наименованию за O(1): сначала точно, затем по нормализованному имени.
+        Используется для ответов AI, которые отличаются регистром, кавычками или точкой в конце.
+        """
+        if not name:
+            return None
+        idx = self._by_name.get(name)
+        if idx is None:
+            idx = self._by_normalized.get(normalize_name(name))
+        return self.items.record(idx) if idx is not None else None
+
+    def attributes(self, idx):
+        """Технические характеристики записи (диаметр, сечение, габарит, мощность, единица)"""
+        return self._attributes[idx]
+
+    def with_attribute(self, field, value):
+        """Индексы записей с заданным значением характеристики"""
+        return self._attribute_postings.get(field, {}).get(value, [])
+
+    def compatible(self, idx, query_attributes):
+        """Проверяет, что характеристики записи не противоречат характеристикам запроса"""
+        return attributes_compatible(query_attributes, self._attributes[idx])
+
+    def token_candidates(self, query, unit=None):
+        """Возвращает индексы совместимых по характеристикам записей, у которых есть общее слово с запросом"""
+        candidates = set()
+        for token in set(tokenize(query)):
+            candidates.update(self._token_postings.get(token, ()))
+        query_attributes = extract_attributes(query, unit)
+        if query_attributes:
+            candidates = {idx for idx in candidates if self.compatible(idx, query_attributes)}
+        return candidates
+
+    def token_postings(self):
+        """Инвертированный индекс по словам: слово -> отсортированный список слотов записей"""
+        return self._token_postings
+
+    def token_set(self, idx):
+        """Возвращает заранее вычисленное множество слов записи"""
+        return self._token_sets[idx]
+
+    def token_overlaps(self, query, max_postings=TOKEN_POSTINGS_LIMIT, unit=None):
+        """
+        Считает число общих слов запроса с записями базы знаний.
+        Кандидаты берутся из списков редких слов; частые слова (длиннее max_postings)
+        только досчитываются по готовым множествам слов кандидатов.
+        Записи с противоречащими запросу характеристиками в оценку не попадают.
+
+        Returns:
+            tuple: (словарь индекс записи -> число общих слов, число слов запроса)
+        """
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return {}, 0
+
+        postings = sorted(
+            ((token, self._token_postings.get(token, ())) for token in query_tokens),
+            key=lambda pair: len(pair[1])
+        )
+        rare = [p for p in postings if p[1] and len(p[1]) <= max_postings]
+        frequent = [token for token, p in postings if len(p) > max_postings]
+        # Если все слова запроса частые - кандидаты берутся по самому редкому из них
+        if not rare and frequent:
+            rare = [postings[0]]
+            frequent = frequent[1:]
+
+        overlaps = defaultdict(int)
+        for _, posting in rare:
+            for idx in posting:
+                overlaps[idx] += 1
+        query_attributes = extract_attributes(query, unit)
+        if query_attributes:
+            overlaps = {idx: hits for idx, hits in overlaps.items() if self.compatible(idx, query_attributes)}
+        for token in frequent:
+            for idx in overlaps:
+                if token in self._token_sets[idx]:
+                    overlaps[idx] += 1
+        return overlaps, len(query_tokens)
+
+    def token_top_k(self, query, k=10, unit=None):
+        """Возвращает список (индекс записи, коэффициент Жаккара по словам) для k лучших записей"""
+        overlaps, query_len = self.token_overlaps(query, unit=unit)
+        scored = (
+            (idx, hits / (query_len + len(self._token_sets[idx]) - hits))
+            for idx, hits in overlaps.items()
+        )
+        # При равном сходстве выше запись, раньше добавленная в базу
+        return heapq.nsmallest(k, scored, key=lambda pair: (-pair[1], pair[0]))
+
+    def shortlist(self, query, k=15, unit=None):
+        """
+        Отбирает k наиболее похожих записей базы знаний
+
+        Args:
+            query (str): Наименование позиции из сметы
+            k (int): Максимальное количество кандидатов
+            unit (str): Единица измерения позиции (если известна)
+
+        Returns:
+            list: Записи базы знаний, отсортированные по убыванию сходства
+        """
+        return [self.items.record(idx) for idx, _ in self.shortlist_scored(query, k, unit)]
+
+    def shortlist_scored(self, query, k=15, unit=None):
+        """
+        Возвращает список (индекс записи, коэффициент Дайса) для k лучших кандидатов.
+        Записи с противоречащими запросу характеристиками отбрасываются до оценки.
+        """
+        query_grams = char_ngrams(query)
+        if not query_grams or not self.items:
+            return []
+
+        # Считаем общие n-граммы только для записей, у которых они есть
+        common = defaultdict(int)
+        for gram in query_grams:
+            for idx in self._ngram_postings.get(gram, ()):
+                common[idx] += 1
+
+        query_attributes = extract_attributes(query, unit)
+        query_len = len(query_grams)
+        scored = (
+            (idx, 2.0 * hits / (query_len + self._ngram_counts[idx]))
+            for idx, hits in common.items()
+            if not query_attributes or self.compatible(idx, query_attributes)
+        )
+        return heapq.nlargest(k, scored, key=lambda pair: pair[1])
+
+
+_shared_index = None
+_shared_index_key = None
+_shared_index_lock = threading.Lock()
+# Долгоживущий источник индекса (BrainService в процессе Flask): (путь к файлу, функция)
+_index_provider = None
+
+
+def set_brain_index_provider(brain_file, provider):
+    """
+    Регистрирует источник индекса для файла базы знаний. Пока источник задан,
+    get_brain_index не проверяет файл и не перестраивает индекс сам - этим занимается источник.
+    """
+    global _index_provider
+    _index_provider = (str(Path(brain_file).resolve()), provider) if provider else None
+
+
+def get_brain_index(brain_file="brain.json"):
+    """
+    Возвращает общий индекс базы знаний. Индекс перестраивается,
+    только если файл изменился (по времени модификации и размеру).
+    """
+    global _shared_index, _shared_index_key
+    brain_file = Path(brain_file)
+    provider = _index_provider
+    if provider is not None and provider[0] == str(brain_file.resolve()):
+        return provider[1]()
+
+    try:
+        stat = brain_file.stat()
+        key = (str(brain_file.resolve()), stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        key = (str(brain_file), None, None)
+
+    with _shared_index_lock:
+        if _shared_index is None or _shared_index_key != key:
+            _shared_index = BrainIndex(load_brain_store(brain_file))
+            _shared_index_key = key
+        return _shared_index
+
+
+def reset_brain_index():
+    """Сбрасывает общий индекс (вызывается после записи brain.json)"""
+    global _shared_index, _shared_index_key
+    with _shared_index_lock:
+        _shared_index = None
+        _shared_index_key = None
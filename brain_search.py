@@ -2,35 +2,55 @@
 Модуль для поиска и сопоставления элементов в базе знаний (brain.json)
 """
 
-import json
 import logging
-from pathlib import Path
+
+from ann_index import ann_enabled, get_ann_index
+from attributes import extract_attributes
+from brain_index import get_brain_index, normalize_name, ngram_similarity
 
 logger = logging.getLogger(__name__)
 
 class BrainSearch:
     """
-    Класс для поиска соответствий в базе знаний
+    Класс для поиска соответствий в базе знаний.
+    Работает поверх общего индекса BrainIndex: материалы - записи с ценой материала,
+    работы - записи с ценой работы.
     """
     
     def __init__(self, brain_file="brain.json"):
         self.brain_file = brain_file
-        self.brain_data = {}
+        self.index = None
         
     def load_brain(self):
-        """Загружает базу знаний из файла"""
-        try:
-            if Path(self.brain_file).exists():
-                with open(self.brain_file, 'r', encoding='utf-8') as f:
-                    self.brain_data = json.load(f)
-                logger.info(f"Загружена база знаний: {len(self.brain_data.get('material_prices', []))} материалов, {len(self.brain_data.get('work_prices', {}))} типов работ")
-                return True
-            else:
-                logger.warning(f"Файл базы знаний {self.brain_file} не найден")
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка загрузки базы знаний: {e}")
+        """Загружает базу знаний через общий индекс"""
+        self.index = get_brain_index(self.brain_file)
+        if not len(self.index):
+            logger.warning(f"База знаний {self.brain_file} пуста или не найдена")
             return False
+        logger.info(f"Загружена база знаний: {len(self.index)} записей")
+        return True
+
+    def _find_price(self, item_name, price_field):
+        """Ищет цену по названию: точное совпадение через индекс, затем частичное"""
+        if not self.index or not item_name:
+            return None
+
+        # Точное (нормализованное) совпадение за O(1)
+        item = self.index.resolve(item_name)
+        if item and item.get(price_field, 0) > 0:
+            return item.get(price_field, 0)
+
+        # Частичное совпадение среди совместимых по характеристикам записей с общими словами
+        query = normalize_name(item_name)
+        for idx in sorted(self.index.token_candidates(item_name)):
+            item = self.index.record(idx)
+            if item.get(price_field, 0) <= 0:
+                continue
+            item_brain_name = normalize_name(item.get('name', ''))
+            if query in item_brain_name or item_brain_name in query:
+                return item.get(price_field, 0)
+
+        return None
     
     def find_material_price(self, item_name, item_type=None):
         """
@@ -43,23 +63,7 @@ class BrainSearch:
         Returns:
             float or None: Цена материала или None если не найдено
         """
-        if not self.brain_data:
-            return None
-            
-        material_prices = self.brain_data.get('material_prices', [])
-        
-        # Точное совпадение
-        for item in material_prices:
-            if item.get('name', '').lower() == item_name.lower():
-                return item.get('material_price', 0)
-        
-        # Частичное совпадение
-        for item in material_prices:
-            item_brain_name = item.get('name', '').lower()
-            if item_name.lower() in item_brain_name or item_brain_name in item_name.lower():
-                return item.get('material_price', 0)
-                
-        return None
+        return self._find_price(item_name, 'material_price')
     
     def find_work_price(self, item_name, work_type=None):
         """
@@ -72,28 +76,7 @@ class BrainSearch:
         Returns:
             float or None: Цена работы или None если не найдено
         """
-        if not self.brain_data:
-            return None
-            
-        work_prices = self.brain_data.get('work_prices', {})
-        
-        if not work_type:
-            work_type = 'general'
-            
-        work_type_data = work_prices.get(work_type, [])
-        
-        # Точное совпадение
-        for item in work_type_data:
-            if item.get('name', '').lower() == item_name.lower():
-                return item.get('work_price', 0)
-        
-        # Частичное совпадение
-        for item in work_type_data:
-            item_brain_name = item.get('name', '').lower()
-            if item_name.lower() in item_brain_name or item_brain_name in item_name.lower():
-                return item.get('work_price', 0)
-                
-        return None
+        return self._find_price(item_name, 'work_price')
     
     def calculate_jaccard_similarity(self, text1, text2):
         """
@@ -119,6 +102,87 @@ class BrainSearch:
             
         return len(intersection) / len(union)
     
+    def match_confidence(self, item_name, brain_name):
+        """
+        Оценка совпадения двух наименований (от 0 до 1): среднее сходства по словам
+        (Жаккар) и по символьным n-граммам. Слова штрафуют перестановки характеристик,
+        n-граммы сглаживают опечатки и разные окончания.
+        Оценка не откалибрована: это не вероятность верного совпадения, а порог
+        fuzzy_match_threshold (0.8) выбран вручную и не подбирался по размеченным парам.
+        """
+        word_score = self.calculate_jaccard_similarity(normalize_name(item_name), normalize_name(brain_name))
+        char_score = ngram_similarity(item_name, brain_name)
+        return (word_score + char_score) / 2
+
+    def find_confident_match(self, item_name, candidates_limit=10, unit=None):
+        """
+        Находит наиболее вероятную запись базы знаний и уверенность в ней.
+        Оцениваются только записи, совместимые с позицией по характеристикам.
+
+        Args:
+            item_name (str): Название для поиска
+            candidates_limit (int): Сколько ближайших по n-граммам кандидатов оценивать
+            unit (str): Единица измерения позиции (если известна)
+
+        Returns:
+            tuple: (запись базы знаний или None, уверенность от 0 до 1)
+        """
+        if not self.index or not item_name:
+            return None, 0.0
+
+        if ann_enabled(len(self.index)):
+            # В большой базе кандидатов отбирает приближенный поиск вместо списков n-грамм
+            candidates, _ = get_ann_index(self.index, self.brain_file).top_k([item_name], candidates_limit * 2)
+            return self.best_candidate(item_name, candidates[0], unit, candidates_limit)
+
+        candidates = [idx for idx, _ in self.index.shortlist_scored(item_name, candidates_limit, unit)]
+        return self.best_candidate(item_name, candidates)
+
+    def best_candidate(self, item_name, candidate_indices, unit=None, candidates_limit=None):
+        """
+        Выбирает из готовых кандидатов (индексов записей) самую вероятную запись и уверенность в ней.
+        Используется с кандидатами от пакетного TF-IDF поиска; несовместимые по характеристикам
+        записи и индексы -1 пропускаются.
+
+        Returns:
+            tuple: (запись базы знаний или None, уверенность от 0 до 1)
+        """
+        query_attributes = extract_attributes(item_name, unit)
+        best_item = None
+        best_score = 0.0
+        scored = 0
+        for idx in map(int, candidate_indices):
+            # Кандидаты пакетного поиска могут ссылаться на уже удаленные записи
+            if idx < 0 or not self.index.items.is_live(idx):
+                continue
+            if query_attributes and not self.index.compatible(idx, query_attributes):
+                continue
+            item = self.index.record(idx)
+            score = self.match_confidence(item_name, item.get('name', ''))
+            if score > best_score:
+                best_item, best_score = item, score
+            scored += 1
+            if candidates_limit and scored >= candidates_limit:
+                break
+        return best_item, best_score
+
+    def top_k(self, query, k=10, unit=None):
+        """
+        Возвращает k записей базы знаний, наиболее похожих на запрос по словам
+        (среди совместимых по характеристикам)
+
+        Args:
+            query (str): Название для поиска
+            k (int): Максимальное количество результатов
+            unit (str): Единица измерения (если известна)
+
+        Returns:
+            list: Пары (запись базы знаний, коэффициент Жаккара), по убыванию сходства
+        """
+        if not self.index or not query:
+            return []
+        return [(self.index.record(idx), score) for idx, score in self.index.token_top_k(query, k, unit)]
+
     def find_best_match(self, item_name, item_type=None, work_type=None, threshold=0.3):
         """
         Находит лучшее соответствие в базе знаний с использованием нечеткого поиска
@@ -132,42 +196,55 @@ class BrainSearch:
         Returns:
             dict: Информация о найденном соответствии или None
         """
-        if not self.brain_data:
+        if not self.index or not item_name:
             return None
             
+        best_key = None
         best_match = None
-        best_score = 0
         
-        # Поиск среди материалов
-        if item_type != 'work':
-            material_prices = self.brain_data.get('material_prices', [])
-            for item in material_prices:
-                score = self.calculate_jaccard_similarity(item_name, item.get('name', ''))
-                if score > best_score and score >= threshold:
-                    best_score = score
-                    best_match = {
-                        'type': 'material',
-                        'name': item.get('name'),
-                        'price': item.get('material_price', 0),
-                        'score': score
-                    }
-        
-        # Поиск среди работ
-        if item_type == 'work' or item_type is None:
-            work_prices = self.brain_data.get('work_prices', {})
-            search_work_type = work_type or 'general'
-            
-            work_type_data = work_prices.get(search_work_type, [])
-            for item in work_type_data:
-                score = self.calculate_jaccard_similarity(item_name, item.get('name', ''))
-                if score > best_score and score >= threshold:
-                    best_score = score
-                    best_match = {
-                        'type': 'work',
-                        'work_type': search_work_type,
-                        'name': item.get('name'),
-                        'price': item.get('work_price', 0),
-                        'score': score
-                    }
+        # Оцениваем только совместимые записи с общими словами; множества слов записей посчитаны при загрузке
+        overlaps, query_len = self.index.token_overlaps(item_name)
+        for idx, hits in overlaps.items():
+            score = hits / (query_len + len(self.index.token_set(idx)) - hits)
+            # При равном сходстве выигрывает запись, раньше добавленная в базу
+            if score < threshold or (best_key is not None and (score, -idx) <= best_key):
+                continue
+            item = self.index.record(idx)
+
+            # Материал приоритетнее работы для одной и той же записи
+            if item_type != 'work' and item.get('material_price', 0) > 0:
+                best_match = {
+                    'type': 'material',
+                    'name': item.get('name'),
+                    'price': item.get('material_price', 0),
+                    'score': score
+                }
+            elif (item_type == 'work' or item_type is None) and item.get('work_price', 0) > 0:
+                best_match = {
+                    'type': 'work',
+                    'work_type': work_type or 'general',
+                    'name': item.get('name'),
+                    'price': item.get('work_price', 0),
+                    'score': score
+                }
+            else:
+                continue
+            best_key = (score, -idx)
         
-        return best_match 
\ No newline at end of file
+        return best_match
+
+    def find_best_matches(self, queries, item_type=None, work_type=None, threshold=0.3):
+        """
+        Пакетный вариант find_best_match: одинаковые (после нормализации) запросы ищутся один раз
+
+        Returns:
+            list: Результат find_best_match для каждого запроса в исходном порядке
+        """
+        found = {}
+        results = []
+        for query in queries:
+            key = normalize_name(query)
+            if key not in found:
+                found[key] = self.find_best_match(query, item_type, work_type, threshold)
+            results.append(found[key])
+        return results
@@ -0,0 +1,265 @@
+"""
+Долгоживущий сервис базы знаний в процессе Flask.
+Держит индекс в памяти: правки из редактора применяются к индексу точечно
+(только слова и n-граммы измененной записи) сразу, а brain.json записывается фоновым
+потоком: правки, сделанные подряд, сохраняются одной атомарной записью. Изменения brain.json извне
+(оптимизация, ручная правка файла) обнаруживаются фоновым потоком по времени
+модификации и хешу. Новый индекс строится в стороне и подменяется одной операцией,
+поэтому запросы не ждут перезагрузки и не видят недостроенный индекс. Если измененный
+файл не разбирается, остается текущий индекс. После подмены или правки тот же поток
+прогревает производные структуры (подсказки, матрицы поиска, калькулятор), чтобы
+первый запрос не платил за их перестроение.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from brain_index import BrainIndex, set_brain_index_provider
+from brain_store import load_brain_store
+from config import config
+from match_cache import compute_file_hash
+
+logger = logging.getLogger(__name__)
+
+
+class BrainService:
+    """
+    Сервис базы знаний: текущий индекс, правки записей и отслеживание файла
+    """
+
+    def __init__(self, brain_file="brain.json"):
+        self.brain_file = Path(brain_file)
+        self._lock = threading.RLock()
+        # Запись файла идет без основной блокировки, чтобы правки не ждали сериализации базы
+        self._write_lock = threading.Lock()
+        # Есть правки, еще не записанные в brain.json; время последней правки
+        self._dirty = False
+        self._changed_at = 0.0
+        # Идет запись файла: поток отслеживания не должен принять ее за внешнее изменение
+        self._writing = False
+        self._stop_event = threading.Event()
+        # Будит поток отслеживания раньше срока: после правки нужно прогреть производные структуры
+        self._wake_event = threading.Event()
+        self._watcher = None
+        self._warmups = []
+        self._warmed_key = None
+        self._signature = self._file_signature()
+        # Подпись файла, который не удалось разобрать: повторно не загружается до следующего изменения
+        self._failed_signature = None
+        self._index = BrainIndex(load_brain_store(self.brain_file))
+
+    @property
+    def index(self):
+        """Текущий индекс базы знаний (ссылка подменяется атомарно при перезагрузке)"""
+        return self._index
+
+    def add_warmup(self, callback):
+        """
+        Регистрирует прогрев: callback(index) вызывается в фоновом потоке для каждого
+        нового индекса и после правок. Регистрировать до start().
+        """
+        self._warmups.append(callback)
+
+    def start(self):
+        """Регистрирует сервис как источник индекса и запускает отслеживание файла"""
+        set_brain_index_provider(self.brain_file, lambda: self._index)
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name="brain-watcher", daemon=True)
+            self._watcher.start()
+        logger.info(f"Сервис базы знаний запущен: {len(self._index)} записей")
+
+    def stop(self):
+        """Останавливает отслеживание файла и записывает отложенные правки"""
+        self._stop_event.set()
+        self._wake_event.set()
+        self.flush()
+        set_brain_index_provider(self.brain_file, None)
+
+    def _file_stat(self):
+        """(время модификации, размер) файла или None, если файла нет"""
+        try:
+            stat = self.brain_file.stat()
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _file_signature(self):
+        """Подпись файла: (время модификации, размер) и MD5 содержимого"""
+        stat = self._file_stat()
+        return (stat, compute_file_hash(self.brain_file) if stat else None)
+
+    def _watch(self):
+        """Фоновая проверка файла базы знаний, запись отложенных правок и прогрев производных структур"""
+        while not self._stop_event.is_set():
+            wait = config.get_brain_reload_interval()
+            try:
+                self.check_for_changes()
+                if self._dirty:
+                    delay = self._changed_at + config.get_brain_write_delay() - time.monotonic()
+                    if delay <= 0:
+                        self.flush()
+                    else:
+                        wait = min(wait, delay)
+                # Калькулятор прогревается по записанному файлу: от него зависит версия кэша сопоставлений
+                if not self._dirty:
+                    self._warm_up()
+            except Exception as e:
+                logger.error(f"Ошибка проверки изменений базы знаний: {e}")
+            self._wake_event.wait(wait)
+            self._wake_event.clear()
+
+    def _warm_up(self):
+        """Прогревает производные структуры для текущей версии индекса, если еще не прогреты"""
+        index = self._index
+        key = (index, index.version)
+        if key == self._warmed_key:
+            return
+        started = time.perf_counter()
+        for callback in self._warmups:
+            try:
+                callback(index)
+            except Exception as e:
+                logger.error(f"Ошибка прогрева базы знаний: {e}")
+        self._warmed_key = key
+        logger.info(f"Производные структуры базы знаний прогреты за {time.perf_counter() - started:.2f} с")
+
+    def check_for_changes(self):
+        """
+        Перезагружает индекс, если brain.json изменился извне.
+        Сначала сравниваются время модификации и размер, хеш считается только при их изменении.
+
+        Returns:
+            bool: True, если индекс был перезагружен
+        """
+        # Поток отслеживания и правки не загружают один и тот же файл дважды;
+        # чтение индекса блокировку не берет, поэтому запросы не ждут перезагрузки
+        with self._lock:
+            stat = self._file_stat()
+            if self._writing or stat == self._signature[0]:
+                return False
+
+            digest = compute_file_hash(self.brain_file) if stat else None
+            if digest == self._signature[1]:
+                self._signature = (stat, digest)
+                return False
+            if (stat, digest) == self._failed_signature:
+                return False
+
+            # Новый индекс строится в стороне: запросы продолжают работать со старым
+            try:
+                new_index = BrainIndex(load_brain_store(self.brain_file, strict=True))
+            except Exception as e:
+                # Файл мог быть записан не до конца или испорчен - пустой индекс хуже прежнего
+                self._failed_signature = (stat, digest)
+                logger.error(f"Не удалось перезагрузить базу знаний, оставлен текущий индекс: {e}")
+                return False
+            if self._file_stat() != stat:
+                # Файл снова изменился во время загрузки - подхватим на следующей проверке
+                return False
+            if self._dirty:
+                # Файл заменен целиком (оптимизация, ручная правка) - он важнее несохраненных правок
+                logger.warning("brain.json изменился извне, несохраненные правки редактора отброшены")
+                self._dirty = False
+            self._index = new_index
+            self._signature = (stat, digest)
+            self._failed_signature = None
+        self._wake_event.set()
+        logger.info(f"База знаний перезагружена после внешнего изменения: {len(new_index)} записей")
+        return True
+
+    def _sync_before_write(self):
+        """Перед правкой подтягивает внешние изменения файла, чтобы не затереть их"""
+        if self._file_stat() != self._signature[0]:
+            self.check_for_changes()
+
+    def _mark_dirty(self):
+        """Отмечает правку для фоновой записи (вызывается под блокировкой)"""
+        self._dirty = True
+        self._changed_at = time.monotonic()
+
+    def flush(self):
+        """
+        Атомарно записывает отложенные правки в brain.json и запоминает подпись файла как
+        собственную. Вызывается фоновым потоком, а также перед задачами, читающими файл.
+
+        Returns:
+            bool: True, если файл был записан
+        """
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                brain_data = self._index.items.to_dicts()
+                self._dirty = False
+                self._writing = True
+            signature = None
+            try:
+                content = json.dumps(brain_data, ensure_ascii=False, indent=2).encode('utf-8')
+                tmp_file = self.brain_file.with_name(self.brain_file.name + '.tmp')
+                with open(tmp_file, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp_file, self.brain_file)
+                signature = (self._file_stat(), hashlib.md5(content).hexdigest())
+            except Exception as e:
+                logger.error(f"Ошибка записи базы знаний: {e}")
+            with self._lock:
+                self._writing = False
+                if signature is None:
+                    # Запись повторится на следующем проходе
+                    self._mark_dirty()
+                    return False
+                self._signature = signature
+        logger.info(f"База знаний сохранена: {len(brain_data)} записей")
+        return True
+
+    def get_record(self, position):
+        """Запись на позиции position в виде словаря"""
+        items = self._index.items
+        if not 0 <= position < len(items):
+            raise IndexError("Запись не найдена")
+        return dict(items[position])
+
+    def update_record(self, position, item):
+        """Заменяет запись на позиции position: индекс обновляется точечно, файл записывается в фоне"""
+        with self._lock:
+            self._sync_before_write()
+            index = self._index
+            if not 0 <= position < len(index.items):
+                raise IndexError("Запись не найдена")
+            index.update_record(position, item)
+            self._mark_dirty()
+        self._wake_event.set()
+
+    def delete_record(self, position):
+        """Удаляет запись на позиции position; возвращает удаленную запись"""
+        with self._lock:
+            self._sync_before_write()
+            index = self._index
+            if not 0 <= position < len(index.items):
+                raise IndexError("Запись не найдена")
+            deleted = dict(index.items[position])
+            index.remove_record(position)
+            self._mark_dirty()
+        self._wake_event.set()
+        return deleted
+
+    def add_record(self, item):
+        """Добавляет запись в конец базы"""
+        with self._lock:
+            self._sync_before_write()
+            self._index.add_record(item)
+            self._mark_dirty()
+        self._wake_event.set()
+
+    def replace_all(self, brain_data):
+        """Заменяет всю базу (импорт): новый индекс строится в стороне и подменяется целиком"""
+        new_index = BrainIndex(brain_data)
+        with self._lock:
+            self._index = new_index
+            self._mark_dirty()
+        self._wake_event.set()
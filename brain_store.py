@@ -0,0 +1,471 @@
+"""
+Компактное колоночное представление базы знаний (brain.json) в памяти.
+Вместо списка словарей записи хранятся по колонкам: интернированные наименования,
+словари единиц измерения и дат, массивы цен float64, словарное кодирование файлов-источников.
+Анализ цен (price_analysis) нужен редко и загружается лениво при первом обращении.
+
+Разобранная база сохраняется рядом с brain.json (brain.json.store и brain.json.analysis)
+и при следующем запуске читается из снимка, если brain.json не менялся. Оба файла снимка
+хранят ключ brain.json (время модификации и размер); анализ цен с чужим ключом
+при ленивой загрузке пересобирается из brain.json.
+"""
+
+import json
+import logging
+import os
+import pickle
+import sys
+import threading
+from bisect import bisect_left
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 3
+
+# Поля записи в порядке, в котором их пишет optimize_brain
+RECORD_FIELDS = (
+    'name', 'unit', 'material_price', 'work_price', 'price_analysis',
+    'cluster_size', 'source_files', 'created_at', 'updated_at', 'cluster_id'
+)
+# Поля, которых может не быть в записи (записи до инкрементальной оптимизации, добавленные вручную)
+OPTIONAL_FIELDS = ('cluster_id',)
+FLAG_FIELDS = ('material_price_approved', 'work_price_approved')
+
+# Значение флага, если поля нет в записи
+_FLAG_ABSENT = -1
+
+
+def _encode_strings(values):
+    """Словарное кодирование строк: (массив кодов int32, список уникальных значений)"""
+    vocabulary = []
+    codes_by_value = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, value in enumerate(values):
+        code = codes_by_value.get(value)
+        if code is None:
+            code = codes_by_value[value] = len(vocabulary)
+            vocabulary.append(sys.intern(value) if isinstance(value, str) else value)
+        codes[i] = code
+    return codes, vocabulary
+
+
+def _to_float(value):
+    """Приводит цену к float (пустые и некорректные значения - 0)"""
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _read_brain_json(brain_file):
+    """Читает записи базы знаний из файла (массив или старый формат с items)"""
+    with open(brain_file, 'r', encoding='utf-8') as f:
+        brain_data = json.load(f)
+
+    # Убеждаемся, что работаем с массивом
+    if isinstance(brain_data, list):
+        return brain_data
+    # Обратная совместимость со старым форматом
+    items = brain_data.get('items', {})
+    return list(items.values()) if isinstance(items, dict) else list(items)
+
+
+class BrainRecord(Mapping):
+    """
+    Запись базы знаний - легкое представление строки BrainStore.
+    Ведет себя как словарь только для чтения (get, [], keys, items);
+    dict(record) дает обычный словарь для изменения и сохранения.
+    """
+
+    __slots__ = ('_store', '_idx')
+
+    def __init__(self, store, idx):
+        self._store = store
+        self._idx = idx
+
+    @property
+    def index(self):
+        """Слот записи в хранилище (совпадает с позицией, пока записи не удалялись)"""
+        return self._idx
+
+    def __getitem__(self, key):
+        return self._store.get_field(self._idx, key)
+
+    def __iter__(self):
+        return iter(self._store.record_keys(self._idx))
+
+    def __len__(self):
+        return len(self._store.record_keys(self._idx))
+
+    def __repr__(self):
+        return f"BrainRecord({self._idx}, {self._store.names[self._idx]!r})"
+
+
+class BrainStore:
+    """
+    Колоночное хранилище записей базы знаний.
+    Поддерживает len(), индексацию и итерацию (элементы - BrainRecord) в порядке brain.json.
+
+    Записи адресуются слотами: номер слота не меняется при удалении других записей,
+    поэтому индексы поиска ссылаются на слоты, а позиции (как в brain.json и UI)
+    получаются из списка живых слотов. Измененные и добавленные после загрузки записи
+    хранятся целиком в словаре, колонки остаются неизменными.
+    """
+
+    def __init__(self, columns, analysis=None, analysis_file=None, source_file=None, source_key=None):
+        self.names = columns['names']
+        self.material_price = columns['material_price']
+        self.work_price = columns['work_price']
+        self.cluster_size = columns['cluster_size']
+        self._unit_codes, self._units = columns['units']
+        self._created_codes, self._created_values = columns['created_at']
+        self._updated_codes, self._updated_values = columns['updated_at']
+        self._cluster_id_codes, self._cluster_ids = columns['cluster_id']
+        self._source_offsets = columns['source_offsets']
+        self._source_codes = columns['source_codes']
+        self._source_files = columns['source_files']
+        self._flags = columns['flags']
+        self._extras = columns['extras']
+
+        # price_analysis: список JSON-строк или None до первого обращения
+        self._analysis = analysis
+        self._analysis_file = analysis_file
+        # brain.json и его ключ, которым должен быть подписан снимок анализа цен
+        self._source_file = source_file
+        self._source_key = source_key
+        self._analysis_lock = threading.Lock()
+
+        # Изменения после загрузки: слот -> полная запись; список живых слотов (None - все слоты по порядку)
+        self._overrides = {}
+        self._order = None
+        self._removed = set()
+
+    @classmethod
+    def from_items(cls, items):
+        """Строит хранилище из списка словарей (формат brain.json)"""
+        columns, analysis = cls._build_columns(items or [])
+        return cls(columns, analysis)
+
+    @staticmethod
+    def _build_columns(items):
+        """Раскладывает записи по колонкам; price_analysis сериализуется в компактные JSON-строки"""
+        count = len(items)
+        names = [sys.intern(str(item.get('name', ''))) for item in items]
+
+        source_files = []
+        source_ids = {}
+        source_offsets = np.zeros(count + 1, dtype=np.int32)
+        source_codes = []
+        flags = {field: np.full(count, _FLAG_ABSENT, dtype=np.int8) for field in FLAG_FIELDS}
+        extras = {}
+        analysis = []
+
+        for i, item in enumerate(items):
+            for file_name in item.get('source_files') or ():
+                code = source_ids.get(file_name)
+                if code is None:
+                    code = source_ids[file_name] = len(source_files)
+                    source_files.append(sys.intern(str(file_name)))
+                source_codes.append(code)
+            source_offsets[i + 1] = len(source_codes)
+
+            for field in FLAG_FIELDS:
+                if field in item:
+                    flags[field][i] = 1 if item[field] else 0
+
+            # Поля вне схемы сохраняются как есть, чтобы запись не теряла данные
+            extra = {k: v for k, v in item.items() if k not in RECORD_FIELDS and k not in FLAG_FIELDS}
+            if extra:
+                extras[i] = extra
+
+            price_analysis = item.get('price_analysis')
+            analysis.append(None if price_analysis is None else json.dumps(price_analysis, ensure_ascii=False, separators=(',', ':')))
+
+        columns = {
+            'names': names,
+            'units': _encode_strings([str(item.get('unit') or '') for item in items]),
+            'material_price': np.array([_to_float(item.get('material_price')) for item in items], dtype=np.float64),
+            'work_price': np.array([_to_float(item.get('work_price')) for item in items], dtype=np.float64),
+            'cluster_size': np.array([int(item.get('cluster_size') or 0) for item in items], dtype=np.int32),
+            'created_at': _encode_strings([item.get('created_at') for item in items]),
+            'updated_at': _encode_strings([item.get('updated_at') for item in items]),
+            'cluster_id': _encode_strings([item.get('cluster_id') for item in items]),
+            'source_offsets': source_offsets,
+            'source_codes': np.array(source_codes, dtype=np.int32),
+            'source_files': source_files,
+            'flags': flags,
+            'extras': extras,
+        }
+        return columns, analysis
+
+    def __len__(self):
+        return len(self.names) if self._order is None else len(self._order)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        return BrainRecord(self, self.slot_at(position))
+
+    def __iter__(self):
+        slots = range(len(self.names)) if self._order is None else list(self._order)
+        return (BrainRecord(self, slot) for slot in slots)
+
+    def slot_at(self, position):
+        """Слот записи по ее позиции в brain.json"""
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("индекс записи базы знаний вне диапазона")
+        return position if self._order is None else self._order[position]
+
+    def position_of(self, slot):
+        """Позиция записи слота в brain.json (список живых слотов всегда возрастает)"""
+        if self._order is None:
+            return slot
+        position = bisect_left(self._order, slot)
+        if position == len(self._order) or self._order[position] != slot:
+            raise KeyError(slot)
+        return position
+
+    def live_slots(self):
+        """Слоты живых записей в порядке brain.json"""
+        return range(len(self.names)) if self._order is None else list(self._order)
+
+    def record(self, slot):
+        """Запись по слоту (для индексов поиска)"""
+        return BrainRecord(self, slot)
+
+    def set_record(self, slot, item):
+        """Заменяет запись в слоте (колонки не перестраиваются)"""
+        item = dict(item)
+        item['name'] = sys.intern(str(item.get('name', '')))
+        self._overrides[slot] = item
+        self.names[slot] = item['name']
+
+    def append_record(self, item):
+        """Добавляет запись в конец базы; возвращает ее слот"""
+        slot = len(self.names)
+        self.names.append('')
+        if self._order is not None:
+            self._order.append(slot)
+        self.set_record(slot, item)
+        return slot
+
+    def remove_record(self, position):
+        """Удаляет запись по позиции; возвращает ее слот"""
+        slot = self.slot_at(position)
+        if self._order is None:
+            self._order = list(range(len(self.names)))
+        del self._order[position if position >= 0 else position + len(self._order)]
+        self._overrides.pop(slot, None)
+        self._removed.add(slot)
+        self.names[slot] = ''
+        return slot
+
+    def is_live(self, slot):
+        """Проверяет, что запись слота не удалена"""
+        return 0 <= slot < len(self.names) and slot not in self._removed
+
+    def unit(self, idx):
+        """Единица измерения записи"""
+        override = self._overrides.get(idx)
+        if override is not None:
+            return str(override.get('unit') or '')
+        return self._units[self._unit_codes[idx]]
+
+    def source_files(self, idx):
+        """Список файлов-источников записи"""
+        override = self._overrides.get(idx)
+        if override is not None:
+            return list(override.get('source_files') or [])
+        start, end = self._source_offsets[idx], self._source_offsets[idx + 1]
+        return [self._source_files[code] for code in self._source_codes[start:end]]
+
+    def price_analysis(self, idx):
+        """Анализ цен записи; при первом обращении загружается с диска"""
+        override = self._overrides.get(idx)
+        if override is not None:
+            return override.get('price_analysis')
+        analysis = self._analysis
+        if analysis is None:
+            analysis = self._load_analysis()
+        value = analysis[idx] if idx < len(analysis) else None
+        return None if value is None else json.loads(value)
+
+    def _load_analysis(self):
+        """Лениво читает анализ цен из файла снимка"""
+        with self._analysis_lock:
+            if self._analysis is None:
+                self._analysis = self._read_analysis()
+            return self._analysis
+
+    def _read_analysis(self):
+        """Анализ цен из снимка; снимок от другой версии brain.json пересобирается"""
+        try:
+            with open(self._analysis_file, 'rb') as f:
+                snapshot = pickle.load(f)
+            if isinstance(snapshot, dict) and snapshot.get('key') == self._source_key:
+                return snapshot['analysis']
+            logger.warning(f"Снимок анализа цен {self._analysis_file} не соответствует базе знаний, пересобираем")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки анализа цен {self._analysis_file}: {e}")
+        return self._rebuild_analysis()
+
+    def _rebuild_analysis(self):
+        """Пересобирает анализ цен из brain.json, если файл не менялся с загрузки хранилища"""
+        try:
+            if self._source_file is None or _file_key(self._source_file) != self._source_key:
+                # Записи изменившегося файла не совпадут со слотами хранилища
+                logger.error(f"{self._source_file} изменился после загрузки, анализ цен недоступен до перезагрузки")
+                return []
+            _, analysis = BrainStore._build_columns(_read_brain_json(self._source_file))
+            _atomic_pickle({'key': self._source_key, 'analysis': analysis}, self._analysis_file)
+            return analysis
+        except Exception as e:
+            logger.error(f"Ошибка пересборки анализа цен: {e}")
+            return []
+
+    def record_keys(self, idx):
+        """Имена полей записи (флаги и дополнительные поля - только если они есть)"""
+        override = self._overrides.get(idx)
+        if override is not None:
+            return list(override)
+        keys = [field for field in RECORD_FIELDS if field not in OPTIONAL_FIELDS]
+        if self._cluster_ids[self._cluster_id_codes[idx]] is not None:
+            keys.append('cluster_id')
+        keys.extend(field for field in FLAG_FIELDS if self._flags[field][idx] != _FLAG_ABSENT)
+        keys.extend(self._extras.get(idx, ()))
+        return keys
+
+    def get_field(self, idx, key):
+        """Значение поля записи; KeyError, если поля нет"""
+        override = self._overrides.get(idx)
+        if override is not None:
+            return override[key]
+        if key == 'name':
+            return self.names[idx]
+        if key == 'unit':
+            return self.unit(idx)
+        if key == 'material_price':
+            return float(self.material_price[idx])
+        if key == 'work_price':
+            return float(self.work_price[idx])
+        if key == 'cluster_size':
+            return int(self.cluster_size[idx])
+        if key == 'source_files':
+            return self.source_files(idx)
+        if key == 'created_at':
+            return self._created_values[self._created_codes[idx]]
+        if key == 'updated_at':
+            return self._updated_values[self._updated_codes[idx]]
+        if key == 'price_analysis':
+            return self.price_analysis(idx)
+        if key == 'cluster_id':
+            cluster_id = self._cluster_ids[self._cluster_id_codes[idx]]
+            if cluster_id is None:
+                raise KeyError(key)
+            return cluster_id
+        if key in self._flags:
+            flag = self._flags[key][idx]
+            if flag == _FLAG_ABSENT:
+                raise KeyError(key)
+            return bool(flag)
+        extra = self._extras.get(idx)
+        if extra and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def to_dict(self, idx):
+        """Запись в виде обычного словаря (формат brain.json)"""
+        return {key: self.get_field(idx, key) for key in self.record_keys(idx)}
+
+    def to_dicts(self):
+        """Все записи в виде списка словарей - для сохранения в brain.json и выдачи через API"""
+        return [self.to_dict(slot) for slot in self.live_slots()]
+
+    def _columns(self):
+        """Колонки для сохранения снимка"""
+        return {
+            'names': self.names,
+            'units': (self._unit_codes, self._units),
+            'material_price': self.material_price,
+            'work_price': self.work_price,
+            'cluster_size': self.cluster_size,
+            'created_at': (self._created_codes, self._created_values),
+            'updated_at': (self._updated_codes, self._updated_values),
+            'cluster_id': (self._cluster_id_codes, self._cluster_ids),
+            'source_offsets': self._source_offsets,
+            'source_codes': self._source_codes,
+            'source_files': self._source_files,
+            'flags': self._flags,
+            'extras': self._extras,
+        }
+
+
+def _snapshot_paths(brain_file):
+    """Пути файлов снимка базы знаний"""
+    return (brain_file.with_name(brain_file.name + '.store'),
+            brain_file.with_name(brain_file.name + '.analysis'))
+
+
+def _file_key(brain_file):
+    """Ключ снимка: версия формата, время модификации и размер brain.json"""
+    stat = Path(brain_file).stat()
+    return (STORE_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size)
+
+
+def _atomic_pickle(obj, path):
+    """Атомарно сохраняет объект в файл"""
+    tmp_file = path.with_name(path.name + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, path)
+
+
+def load_brain_store(brain_file="brain.json", strict=False):
+    """
+    Загружает базу знаний в колоночное хранилище.
+    Если brain.json не менялся с прошлой загрузки, читается снимок без разбора JSON.
+    При strict ошибка разбора brain.json пробрасывается, а не превращается в пустую базу.
+    """
+    brain_file = Path(brain_file)
+    if not brain_file.exists():
+        logger.error(f"Файл базы знаний {brain_file} не найден!")
+        return BrainStore.from_items([])
+
+    store_file, analysis_file = _snapshot_paths(brain_file)
+    key = _file_key(brain_file)
+
+    if store_file.exists() and analysis_file.exists():
+        try:
+            with open(store_file, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot.get('key') == key:
+                store = BrainStore(snapshot['columns'], analysis_file=analysis_file, source_file=brain_file, source_key=key)
+                logger.info(f"Загружено {len(store)} записей из снимка базы знаний")
+                return store
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать снимок базы знаний {store_file}: {e}")
+
+    try:
+        items = _read_brain_json(brain_file)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки базы знаний: {e}")
+        if strict:
+            raise
+        return BrainStore.from_items([])
+
+    columns, analysis = BrainStore._build_columns(items)
+    logger.info(f"Загружено {len(items)} записей из базы знаний")
+    try:
+        _atomic_pickle({'key': key, 'analysis': analysis}, analysis_file)
+        _atomic_pickle({'key': key, 'columns': columns}, store_file)
+    except Exception as e:
+        # Без снимка база просто держит анализ цен в памяти
+        logger.warning(f"Не удалось сохранить снимок базы знаний: {e}")
+        return BrainStore(columns, analysis)
+    return BrainStore(columns, analysis_file=analysis_file, source_file=brain_file, source_key=key)
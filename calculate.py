@@ -1,180 +1,421 @@
 import pandas as pd
 import json
 import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from pathlib import Path
 from datetime import datetime
-import openpyxl
+from collections import defaultdict
 from config import config
 import openai
+from ai_errors import check_finish_reason, is_fatal_error, is_split_error
 from prompt_loader import load_prompt
+from brain_index import get_brain_index, normalize_name, ngram_similarity
+from attributes import extract_attributes, normalize_unit
+from ann_index import get_candidate_generator
+from brain_search import BrainSearch
+from match_cache import MatchCache, compute_brain_version, compute_file_hash
+from workbook_io import read_workbook, write_prices_inplace
 
 logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Сколько строк листа просматривается при определении колонки с наименованиями
+NAME_COLUMN_SAMPLE_ROWS = 500
+
+# Колонка способа сопоставления заполненной строки; добавляется в смету только при write_match_tier_column
+MATCH_TIER_COLUMN = 'Способ сопоставления'
+
+# Уровни каскада сопоставления: точное имя -> локальный нечеткий поиск -> AI
+TIER_EXACT = 'точное'
+TIER_FUZZY = 'нечеткое'
+TIER_AI = 'AI'
+
+# Сколько TF-IDF кандидатов берется на позицию и сколько совместимых из них оценивается
+FUZZY_TFIDF_CANDIDATES = 20
+FUZZY_CANDIDATES_LIMIT = 10
+
+class AdaptiveBatchSizer:
+    """
+    Подбирает размер чанка для batch сопоставления по наблюдаемой задержке и ошибкам:
+    ошибка уменьшает размер на 30%, медленный чанк - пропорционально превышению
+    целевого времени, быстрый - увеличивает размер на четверть.
+    """
+
+    def __init__(self, initial_size, min_size=5, max_size=200, target_latency=30.0):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.target_latency = target_latency
+        self.size = min(max(initial_size, self.min_size), self.max_size)
+        self._lock = threading.Lock()
+
+    def record(self, chunk_size, elapsed, success):
+        """Учитывает результат выполненного чанка"""
+        with self._lock:
+            if not success:
+                self.size = max(self.min_size, int(self.size * 0.7))
+            elif elapsed > self.target_latency:
+                scaled = int(chunk_size * self.target_latency / elapsed)
+                self.size = max(self.min_size, min(self.size, scaled))
+            elif elapsed < self.target_latency / 2 and chunk_size * 2 >= self.size:
+                self.size = min(self.max_size, int(self.size * 1.25) + 1)
+
 class SmetaCalculator:
     def __init__(self, progress_manager, cancellation_token_getter=lambda: False):
         self.progress_manager = progress_manager
         self.brain_file = Path("brain.json")
         self.calculate_dir = Path("calculate")
         self.output_dir = Path("output")
-        self.brain = self._load_brain()
+        # Какие файлы уже рассчитаны: хеш входного файла и версия базы знаний
+        self.manifest_file = Path("calculate_manifest.json")
+        # Общий индекс базы знаний строится один раз при загрузке и переиспользуется
+        self.brain_index = get_brain_index(self.brain_file)
+        self.brain = self.brain_index.items
+        self.brain_search = BrainSearch(self.brain_file)
+        self.brain_search.load_brain()
+        self.match_cache = MatchCache(compute_brain_version(self.brain_file))
+        # Наименования, для которых AI не нашел совпадения в текущем запуске
+        self._unmatched_names = set()
         self.cancellation_token_getter = cancellation_token_getter
-        self.client = openai.OpenAI(api_key=config.get_openai_key())
+        # При лимите запросов и обрывах связи клиент сам повторяет запрос с нарастающей паузой
+        self.client = openai.OpenAI(api_key=config.get_openai_key(), max_retries=config.get_ai_max_retries())
+        # Общий лимит одновременных AI запросов для всех файлов и листов
+        self._ai_slots = threading.BoundedSemaphore(config.get_calculate_max_workers())
+        self.batch_sizer = AdaptiveBatchSizer(
+            config.get_calculate_batch_size(),
+            target_latency=config.get_calculate_target_latency(),
+        )
         
         self.calculate_dir.mkdir(exist_ok=True)
         self.output_dir.mkdir(exist_ok=True)
 
-    def _load_brain(self):
-        """Загружает базу знаний"""
-        if not self.brain_file.exists():
-            logger.error(f"Файл базы знаний {self.brain_file} не найден!")
-            return []
-        try:
-            with open(self.brain_file, 'r', encoding='utf-8') as f:
-                brain_data = json.load(f)
-            
-            # Убеждаемся, что работаем с массивом
-            if isinstance(brain_data, list):
-                logger.info(f"Загружено {len(brain_data)} записей из базы знаний")
-                return brain_data
-            else:
-                # Обратная совместимость со старым форматом
-                items = brain_data.get('items', {})
-                logger.info(f"Загружено {len(items)} записей из базы знаний (старый формат)")
-                return list(items.values())
-                
-        except Exception as e:
-            logger.error(f"Ошибка загрузки базы знаний: {e}")
-            return []
-            
     def _find_best_match_in_brain(self, item_name, brain_items):
         """Ищет лучшее совпадение в базе знаний через AI"""
         if not brain_items or not item_name:
             return None
 
+        # В промпт попадают только ближайшие кандидаты, а не вся база
+        candidates = self.brain_index.shortlist(item_name, config.get_match_candidates_limit())
+        if not candidates:
+            logger.info(f"Нет кандидатов в базе знаний для '{item_name}'")
+            return None
+
         try:
-            # Преобразуем brain для передачи в промпт (теперь это массив)
-            brain_for_prompt = "\n".join([f"- {item['name']}" for item in brain_items])
+            brain_for_prompt = "\n".join([f"- {item['name']}" for item in candidates])
             
             # Загружаем промпт из файла
             prompt = load_prompt("calculate_matching", brain_items=brain_for_prompt, item_name=item_name)
             
-            response = self.client.chat.completions.create(
-                model=config.get_openai_model(),
-                messages=[
-                    {"role": "system", "content": "Ты - эксперт по сопоставлению данных в строительных сметах. Отвечай только одной строкой - названием из базы."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0,
-                timeout=60.0,
-            )
+            with self._ai_slots:
+                response = self.client.chat.completions.create(
+                    model=config.get_openai_model(),
+                    messages=[
+                        {"role": "system", "content": "Ты - эксперт по сопоставлению данных в строительных сметах. Отвечай только одной строкой - названием из базы."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0,
+                    timeout=60.0,
+                )
             
             best_match_name = response.choices[0].message.content.strip()
+            if not best_match_name:
+                return None
             
-            # Ищем соответствующую запись в массиве
-            for item in brain_items:
-                if item['name'] == best_match_name:
-                    return item
-            
-            # Если точного совпадения нет, возвращаем первую запись (fallback)
-            logger.warning(f"Точное совпадение не найдено для '{best_match_name}', используем первую запись")
-            return brain_items[0] if brain_items else None
+            # Ищем запись по точному или нормализованному имени
+            match = self.brain_index.resolve(best_match_name)
+            if match is None:
+                logger.warning(f"Ответ AI '{best_match_name}' не найден в базе знаний для '{item_name}'")
+            return self._compatible_or_none(item_name, match)
 
         except Exception as e:
             logger.error(f"Ошибка AI-поиска для '{item_name}': {e}")
             return None
 
     def process_sheet(self, df, brain_items):
-        """Обрабатывает лист Excel с batch AI запросом"""
+        """Обрабатывает лист Excel с batch AI запросом (векторно, без iterrows)"""
         df = self._ensure_price_columns(df)
 
         # Находим колонку с наименованиями
-        name_col = max(df.columns, key=lambda c: df[c].astype(str).str.len().mean())
-        
-        # Собираем все наименования для batch обработки
-        items_to_process = []
-        row_indices = []
+        name_col = self._detect_name_column(df)
+        if name_col is None:
+            logger.info("Нет позиций для обработки в листе")
+            return df
         
-        for index, row in df.iterrows():
-            item_name = row.get(name_col)
-            if item_name and not pd.isna(item_name) and len(str(item_name).strip()) > 3:
-                items_to_process.append(str(item_name).strip())
-                row_indices.append(index)
+        # Отбираем строки с наименованиями колоночными операциями
+        names = df[name_col]
+        names = names[names.notna()].astype(str).str.strip()
+        names = names[names.str.len() > 3]
         
-        if not items_to_process:
+        if names.empty:
             logger.info("Нет позиций для обработки в листе")
             return df
         
-        # Batch AI запрос для всех позиций сразу
-        logger.info(f"Отправляем batch запрос для {len(items_to_process)} позиций")
-        matches = self._batch_find_matches(items_to_process, brain_items)
+        # Сопоставляем только уникальные наименования
+        unique_names = list(pd.unique(names))
+        matches = self._resolve_matches(unique_names, brain_items)
+        match_by_name = {name: match for name, match in zip(unique_names, matches) if match}
         
-        # Применяем найденные совпадения
-        for i, (item_name, row_index) in enumerate(zip(items_to_process, row_indices)):
-            if i < len(matches) and matches[i]:
-                match = matches[i]
-                
-                if match.get('material_price', 0) > 0:
-                    df.loc[row_index, 'Цена материала'] = match['material_price']
-                
-                if match.get('work_price', 0) > 0:
-                    df.loc[row_index, 'Цена работы'] = match['work_price']
+        # Применяем найденные цены одним выровненным присваиванием на колонку
+        filled_names = set()
+        for column, price_field in (('Цена материала', 'material_price'), ('Цена работы', 'work_price')):
+            price_by_name = {
+                name: match['item'].get(price_field, 0)
+                for name, match in match_by_name.items()
+                if match['item'].get(price_field, 0) > 0
+            }
+            filled_names.update(price_by_name)
+            prices = names.map(price_by_name).reindex(df.index)
+            df[column] = prices.where(prices.notna(), df[column])
+        
+        # Уровень каскада, сопоставивший заполненные строки, пишется в лог; колонкой в смету - только по настройке
+        if filled_names:
+            tiers = names.map({name: match_by_name[name]['tier'] for name in filled_names}).reindex(df.index)
+            logger.info(f"Заполнено строк по способам сопоставления: {tiers.value_counts().to_dict()}")
+            if config.get_write_match_tier_column():
+                df[MATCH_TIER_COLUMN] = tiers.where(tiers.notna(), df[MATCH_TIER_COLUMN]) if MATCH_TIER_COLUMN in df.columns else tiers
         
         return df
 
+    def _detect_name_column(self, df):
+        """Определяет колонку с наименованиями по средней длине текста на выборке строк"""
+        if df.empty or not len(df.columns):
+            return None
+        step = max(1, len(df) // NAME_COLUMN_SAMPLE_ROWS)
+        sample = df.iloc[::step]
+        return max(sample.columns, key=lambda c: sample[c].astype(str).str.len().mean())
+
+    def match_items(self, item_names, allow_ai=False, item_units=None):
+        """
+        Сопоставляет список наименований с базой знаний без чтения и записи Excel.
+        Используется синхронным API: без allow_ai работает только локальный каскад.
+        Если указаны единицы измерения, записи с другой единицей не сопоставляются.
+
+        Returns:
+            list: Для каждой позиции {'item', 'tier', 'confidence'} или None
+        """
+        matches = self._resolve_matches(item_names, self.brain, allow_ai=allow_ai and config.is_ai_enabled(), item_units=item_units)
+        self.match_cache.save()
+        return matches
+
+    def _match_key(self, item_name, unit=None):
+        """Ключ схлопывания одинаковых позиций: нормализованное имя (и единица, если указана)"""
+        key = normalize_name(item_name)
+        unit = normalize_unit(unit)
+        return f"{key}|{unit}" if unit else key
+
+    def _compatible_or_none(self, item_name, match, unit=None):
+        """Отбрасывает совпадение, если характеристики позиции и записи базы знаний противоречат друг другу"""
+        if match is None:
+            return None
+        query_attributes = extract_attributes(item_name, unit)
+        if query_attributes and not self.brain_index.compatible(match.index, query_attributes):
+            logger.info(f"Отклонено совпадение '{item_name}' -> '{match['name']}': разные характеристики")
+            return None
+        return match
+
+    def _resolve_matches(self, item_names, brain_items, allow_ai=True, item_units=None):
+        """
+        Находит совпадения для позиций каскадом: одинаковые наименования схлопываются,
+        затем точное совпадение имени, кэш, локальный нечеткий поиск и только
+        оставшиеся позиции с низкой уверенностью уходят в AI (если allow_ai).
+        На каждом уровне записи с противоречащими характеристиками (диаметр, сечение,
+        мощность, единица) отбрасываются.
+
+        Returns:
+            list: Для каждой позиции {'item', 'tier', 'confidence'} или None
+        """
+        units = item_units or [None] * len(item_names)
+        keys = [self._match_key(name, unit) for name, unit in zip(item_names, units)]
+        unique_names = {}
+        for key, name, unit in zip(keys, item_names, units):
+            unique_names.setdefault(key, (name, unit))
+
+        resolved = {}
+        pending = []
+        for key, (name, unit) in unique_names.items():
+            # 1. Точное (нормализованное) совпадение с записью базы знаний
+            item = self._compatible_or_none(name, self.brain_index.resolve(name), unit)
+            if item:
+                resolved[key] = self._match_result(item, TIER_EXACT, 1.0)
+                continue
+
+            # 2. Ранее найденное сопоставление из кэша
+            cached = self.match_cache.lookup(name)
+            cached_item = self._compatible_or_none(name, self.brain_index.get(cached['match_name']), unit) if cached else None
+            if cached_item:
+                resolved[key] = self._match_result(cached_item, cached.get('tier', TIER_AI), cached['confidence'])
+                continue
+            pending.append((key, name, unit))
+
+        # 3. Локальный нечеткий поиск с порогом уверенности: кандидаты для всех оставшихся позиций
+        #    одним пакетным запросом (TF-IDF или приближенный поиск для больших баз),
+        #    затем оценка только совместимых по характеристикам
+        names_to_ask = []
+        fuzzy_threshold = config.get_fuzzy_match_threshold()
+        candidates, _ = get_candidate_generator(self.brain_index, self.brain_file).top_k([name for _, name, _ in pending], FUZZY_TFIDF_CANDIDATES)
+        for (key, name, unit), row in zip(pending, candidates):
+            if row[0] >= 0:
+                item, confidence = self.brain_search.best_candidate(name, row, unit, FUZZY_CANDIDATES_LIMIT)
+            else:
+                # Наименование только из частых n-грамм - обычный поиск по индексу
+                item, confidence = self.brain_search.find_confident_match(name, FUZZY_CANDIDATES_LIMIT, unit)
+            if item and confidence >= fuzzy_threshold:
+                resolved[key] = self._match_result(item, TIER_FUZZY, confidence)
+                continue
+
+            # 4. AI - только для позиций с низкой уверенностью
+            if allow_ai and key not in self._unmatched_names:
+                names_to_ask.append((key, name, unit))
+
+        tier_counts = defaultdict(int)
+        for match in resolved.values():
+            tier_counts[match['tier']] += 1
+        logger.info(f"Уникальных позиций: {len(unique_names)} из {len(item_names)}, "
+                    f"найдено локально: {dict(tier_counts)}, в AI: {len(names_to_ask)}")
+
+        if names_to_ask:
+            logger.info(f"Отправляем batch запрос для {len(names_to_ask)} позиций")
+            found = self._batch_find_matches([name for _, name, _ in names_to_ask], brain_items)
+            for (key, name, unit), match in zip(names_to_ask, found):
+                match = self._compatible_or_none(name, match, unit)
+                if match:
+                    confidence = ngram_similarity(name, match['name'])
+                    resolved[key] = self._match_result(match, TIER_AI, confidence)
+                    self.match_cache.store(name, match['name'], confidence, TIER_AI)
+                else:
+                    self._unmatched_names.add(key)
+
+        return [resolved.get(key) for key in keys]
+
+    def _match_result(self, item, tier, confidence):
+        """Формирует результат сопоставления одной позиции"""
+        return {'item': item, 'tier': tier, 'confidence': round(float(confidence), 4)}
+
     def _batch_find_matches(self, item_names, brain_items):
-        """Находит совпадения для списка наименований одним AI запросом"""
+        """
+        Находит совпадения для списка наименований пачками (чанками) AI запросов.
+        Чанки выполняются параллельно, размер следующего чанка подстраивается
+        под задержку и ошибки предыдущих, результаты собираются в исходном порядке.
+        Пополам делятся только чанки с обрезанным или неразобранным ответом; при других
+        ошибках позиции чанка остаются без совпадения, а если AI недоступен (ключ, доступ,
+        квота), оставшиеся чанки не отправляются.
+        """
         if not item_names or not brain_items:
             return []
+
+        results = [None] * len(item_names)
+        # Очередь диапазонов (начало, конец) позиций, которые еще не отправлены
+        pending = [(0, len(item_names))]
+        in_flight = {}
+        ai_available = True
+
+        max_workers = config.get_calculate_max_workers()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or in_flight:
+                # Отправляем новые чанки, пока есть свободные воркеры
+                while pending and len(in_flight) < max_workers:
+                    if self.cancellation_token_getter():
+                        pending.clear()
+                        break
+                    start, end = pending.pop(0)
+                    chunk_end = min(end, start + self.batch_sizer.size)
+                    if chunk_end < end:
+                        pending.insert(0, (chunk_end, end))
+                    future = executor.submit(self._timed_match_chunk, item_names[start:chunk_end])
+                    in_flight[future] = (start, chunk_end)
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end = in_flight.pop(future)
+                    elapsed, matches, error = future.result()
+                    # Размер чанка подстраивается только под ошибки, зависящие от размера
+                    if error is None or is_split_error(error):
+                        self.batch_sizer.record(end - start, elapsed, error is None)
+
+                    if error is None:
+                        results[start:end] = matches
+                    elif is_fatal_error(error):
+                        if ai_available:
+                            ai_available = False
+                            logger.error(f"AI недоступен ({error}), оставшиеся позиции остаются без совпадения")
+                        pending.clear()
+                    elif not is_split_error(error):
+                        # Повторы уже сделаны клиентом, деление не поможет
+                        logger.error(f"Чанк позиций {start+1}-{end} не обработан AI: {error}")
+                    elif end - start > 1:
+                        # Ответ обрезан или не разобран - делим чанк пополам и отправляем повторно
+                        logger.warning(f"Чанк позиций {start+1}-{end} не обработан ({error}), делим пополам")
+                        middle = (start + end) // 2
+                        pending[0:0] = [(start, middle), (middle, end)]
+                    else:
+                        # Одиночная позиция - индивидуальный запрос
+                        results[start] = self._find_best_match_in_brain(item_names[start], brain_items)
+
+        logger.info(f"Обработано {sum(1 for m in results if m)} совпадений из {len(item_names)} позиций")
+        return results
+
+    def _timed_match_chunk(self, item_names):
+        """Выполняет запрос для чанка и возвращает (время, совпадения, ошибка)"""
+        with self._ai_slots:
+            started = time.monotonic()
+            try:
+                matches = self._match_chunk(item_names)
+                return time.monotonic() - started, matches, None
+            except Exception as e:
+                logger.error(f"Ошибка batch AI поиска: {e}")
+                return time.monotonic() - started, None, e
+
+    def _match_chunk(self, item_names):
+        """Находит совпадения для одного чанка наименований одним AI запросом"""
+        # Локальный отбор кандидатов: размер промпта зависит от k, а не от размера базы
+        candidates_limit = config.get_match_candidates_limit()
+        shortlists = [self.brain_index.shortlist(name, candidates_limit) for name in item_names]
+
+        # Формируем список позиций с их кандидатами для промпта
+        items_blocks = []
+        for i, (name, candidates) in enumerate(zip(item_names, shortlists)):
+            lines = [f"{i+1}. {name}"]
+            lines.extend(f"   - {item['name']}" for item in candidates)
+            if not candidates:
+                lines.append("   (кандидатов нет)")
+            items_blocks.append("\n".join(lines))
+        items_list = "\n".join(items_blocks)
         
-        try:
-            # Формируем списки для промпта
-            items_list = "\n".join([f"{i+1}. {name}" for i, name in enumerate(item_names)])
-            brain_list = "\n".join([f"- {item['name']}" for item in brain_items])
-            
-            # Загружаем промпт для batch сопоставления
-            prompt = load_prompt("calculate_batch_matching", 
-                               items_list=items_list, 
-                               brain_list=brain_list)
-            
-            response = self.client.chat.completions.create(
-                model=config.get_openai_model(),
-                messages=[
-                    {"role": "system", "content": "Ты эксперт по сопоставлению позиций в строительных сметах. Отвечай только JSON массивом."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0,
-                timeout=120.0,
-            )
-            
-            result_text = response.choices[0].message.content.strip()
-            logger.info(f"AI batch ответ: {result_text[:200]}...")
-            
-            # Парсим JSON ответ
-            matches_data = json.loads(result_text)
-            
-            # Преобразуем в объекты brain_items
-            matches = []
-            for match_name in matches_data:
-                if match_name:
-                    # Ищем соответствующий объект в brain_items
-                    found_item = None
-                    for brain_item in brain_items:
-                        if brain_item['name'] == match_name:
-                            found_item = brain_item
-                            break
-                    matches.append(found_item)
-                else:
-                    matches.append(None)
-            
-            logger.info(f"Обработано {len(matches)} совпадений из {len(item_names)} позиций")
-            return matches
-            
-        except Exception as e:
-            logger.error(f"Ошибка batch AI поиска: {e}")
-            # Fallback на индивидуальные запросы
-            logger.info("Переходим на индивидуальную обработку")
-            return [self._find_best_match_in_brain(name, brain_items) for name in item_names]
+        # Загружаем промпт для batch сопоставления
+        prompt = load_prompt("calculate_batch_matching", items_list=items_list)
+        
+        response = self.client.chat.completions.create(
+            model=config.get_openai_model(),
+            messages=[
+                {"role": "system", "content": "Ты эксперт по сопоставлению позиций в строительных сметах. Отвечай только JSON массивом."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            timeout=120.0,
+        )
+        check_finish_reason(response)
+        
+        result_text = response.choices[0].message.content.strip()
+        logger.info(f"AI batch ответ: {result_text[:200]}...")
+        
+        # Парсим JSON ответ; обрезанный или неполный ответ считается ошибкой чанка
+        matches_data = json.loads(result_text)
+        if not isinstance(matches_data, list) or len(matches_data) != len(item_names):
+            raise ValueError(f"ожидалось {len(item_names)} ответов, получено {len(matches_data) if isinstance(matches_data, list) else 0}")
+        
+        # Преобразуем в объекты brain_items через индекс (точное или нормализованное имя)
+        matches = []
+        for item_name, match_name in zip(item_names, matches_data):
+            found_item = self.brain_index.resolve(match_name) if match_name else None
+            if match_name and found_item is None:
+                logger.warning(f"Ответ AI '{match_name}' не найден в базе знаний")
+            matches.append(self._compatible_or_none(item_name, found_item))
+        return matches
 
     def _ensure_price_columns(self, df):
         """Проверяет наличие колонок цен и добавляет их, если они отсутствуют."""
@@ -184,62 +425,189 @@ class SmetaCalculator:
             df['Цена работы'] = 0.0
         return df
 
-    def _find_files_to_process(self):
-        """Находит все .xlsx файлы в папке для расчета."""
-        files = list(self.calculate_dir.glob("*.xlsx"))
+    def _find_files_to_process(self, file_names=None):
+        """Находит .xlsx файлы для расчета: выбранные по именам или все в папке calculate/."""
+        if file_names:
+            files = []
+            for name in file_names:
+                file_path = self.calculate_dir / Path(name).name
+                if file_path.is_file():
+                    files.append(file_path)
+                else:
+                    logger.warning(f"Файл {name} не найден в папке {self.calculate_dir}")
+        else:
+            files = list(self.calculate_dir.glob("*.xlsx"))
         logger.info(f"Найдено {len(files)} файлов для расчета в папке {self.calculate_dir}")
         return files
+
+    def _load_manifest(self):
+        """Загружает сведения о ранее рассчитанных файлах"""
+        if not self.manifest_file.exists():
+            return {}
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {self.manifest_file}: {e}")
+            return {}
+
+    def _save_manifest(self, manifest):
+        """Сохраняет сведения о рассчитанных файлах"""
+        try:
+            with open(self.manifest_file, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.manifest_file}: {e}")
+
+    def _is_up_to_date(self, manifest_entry, input_hash, brain_version):
+        """Проверяет, есть ли результат для того же входного файла и той же версии базы знаний"""
+        if not manifest_entry:
+            return False
+        return (manifest_entry.get('input_hash') == input_hash
+                and manifest_entry.get('brain_version') == brain_version
+                and (self.output_dir / manifest_entry.get('output_file', '')).is_file())
     
-    def calculate_all(self):
-        """Основной метод для расчета всех файлов в папке calculate/"""
+    def calculate_all(self, file_names=None, skip_unchanged=False):
+        """
+        Основной метод расчета смет из папки calculate/
+
+        Args:
+            file_names (list): Имена файлов для расчета; если не заданы - все файлы папки
+            skip_unchanged (bool): Пропускать файлы, уже рассчитанные по той же базе знаний
+        """
         self.progress_manager.start_task("calculate", "Начинаем расчет смет...")
+        self._unmatched_names.clear()
         
         if not self.brain:
             message = "База знаний пуста. Запустите оптимизацию."
             self.progress_manager.fail_task(message)
             return False, message
 
-        files_to_calculate = self._find_files_to_process()
+        files_to_calculate = self._find_files_to_process(file_names)
         if not files_to_calculate:
             message = "Нет файлов для расчета в папке calculate/"
             self.progress_manager.complete_task(message)
             return True, message
+
+        manifest = self._load_manifest()
+        brain_version = self.match_cache.brain_version
+        input_hashes = {file_path: compute_file_hash(file_path) for file_path in files_to_calculate}
+        skipped_count = 0
+        if skip_unchanged:
+            up_to_date = [
+                file_path for file_path in files_to_calculate
+                if self._is_up_to_date(manifest.get(file_path.name), input_hashes[file_path], brain_version)
+            ]
+            skipped_count = len(up_to_date)
+            files_to_calculate = [file_path for file_path in files_to_calculate if file_path not in up_to_date]
+            if not files_to_calculate:
+                message = f"Все выбранные файлы уже рассчитаны по текущей базе знаний (пропущено {skipped_count})."
+                self.progress_manager.complete_task(message)
+                return True, message
             
         total_files = len(files_to_calculate)
         processed_count = 0
+        parallel_jobs = config.get_calculate_parallel_jobs()
+        self.progress_manager.update_progress(0, f"Расчет {total_files} файлов (параллельно: {parallel_jobs})...")
         
-        for i, file_path in enumerate(files_to_calculate):
-            # Проверка отмены
-            if self.cancellation_token_getter():
-                message = "Расчет отменен пользователем."
-                self.progress_manager.fail_task(message)
-                return False, message
-            
-            progress = int((i / total_files) * 100)
-            self.progress_manager.update_progress(progress, f"Расчет файла {i+1}/{total_files}: {file_path.name}")
-            
-            if self.process_file(file_path, self.brain):
-                processed_count += 1
+        # Разбор и запись Excel - в пуле процессов, сопоставление - в потоках
+        process_pool = self._create_process_pool()
+        try:
+            with ThreadPoolExecutor(max_workers=parallel_jobs) as file_pool:
+                futures = {
+                    file_pool.submit(self.process_file, file_path, self.brain, process_pool): file_path
+                    for file_path in files_to_calculate
+                }
+                for done_count, future in enumerate(as_completed(futures), 1):
+                    file_path = futures[future]
+                    output_file_path = future.result()
+                    if output_file_path:
+                        processed_count += 1
+                        manifest[file_path.name] = {
+                            'input_hash': input_hashes[file_path],
+                            'brain_version': brain_version,
+                            'output_file': output_file_path.name,
+                            'calculated_at': datetime.now().isoformat()
+                        }
+                        self._save_manifest(manifest)
+                    self.match_cache.save()
+                    
+                    progress = int((done_count / total_files) * 100)
+                    self.progress_manager.update_progress(progress, f"Рассчитан файл {done_count}/{total_files}: {file_path.name}")
+                    
+                    # Проверка отмены
+                    if self.cancellation_token_getter():
+                        for pending in futures:
+                            pending.cancel()
+                        message = "Расчет отменен пользователем."
+                        self.progress_manager.fail_task(message)
+                        return False, message
+        finally:
+            if process_pool:
+                process_pool.shutdown()
         
         message = f"Расчет завершен. Успешно обработано {processed_count}/{total_files} файлов."
+        if skipped_count:
+            message += f" Пропущено без изменений: {skipped_count}."
         self.progress_manager.complete_task(message)
         return True, message 
 
-    def process_file(self, file_path, brain_items):
-        """Обрабатывает один файл сметы, добавляя цены из базы знаний."""
+    def _create_process_pool(self):
+        """
+        Создает пул процессов для чтения и записи книг Excel (при одном процессе пула нет -
+        книги обрабатываются в текущем процессе). fork из многопоточного процесса Flask небезопасен,
+        поэтому процессы запускаются через forkserver (или spawn): в них передаются только
+        функции workbook_io и их аргументы. При запуске процесс заново импортирует главный модуль,
+        поэтому app.py создает контроллер и сервис базы знаний только в create_app().
+        """
+        workers = config.get_calculate_process_workers()
+        if workers <= 1:
+            return None
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+
+    def process_file(self, file_path, brain_items, process_pool=None):
+        """Обрабатывает один файл сметы, добавляя цены из базы знаний. Возвращает путь к результату или None."""
+        if self.cancellation_token_getter():
+            return None
         try:
-            xls = pd.ExcelFile(file_path)
+            sheets = self._run_in_pool(process_pool, read_workbook, file_path)
             output_file_path = self.output_dir / f"РАСЧЕТАННАЯ_{file_path.stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
             
-            with pd.ExcelWriter(output_file_path, engine='openpyxl') as writer:
-                for sheet_name in xls.sheet_names:
-                    df = pd.read_excel(xls, sheet_name=sheet_name)
-                    processed_df = self.process_sheet(df, brain_items)
-                    processed_df.to_excel(writer, sheet_name=sheet_name, index=False)
+            # Листы одной книги сопоставляются параллельно
+            parallel_jobs = min(config.get_calculate_parallel_jobs(), len(sheets))
+            if parallel_jobs > 1:
+                with ThreadPoolExecutor(max_workers=parallel_jobs) as sheet_pool:
+                    processed = sheet_pool.map(lambda df: self.process_sheet(df.copy(), brain_items), sheets.values())
+                    processed_sheets = dict(zip(sheets.keys(), processed))
+            else:
+                processed_sheets = {name: self.process_sheet(df.copy(), brain_items) for name, df in sheets.items()}
+            
+            # В копию исходной книги пишутся только изменившиеся ячейки цен
+            prices = {
+                name: self._changed_prices(sheets[name], df)
+                for name, df in processed_sheets.items() if not df.empty
+            }
+            self._run_in_pool(process_pool, write_prices_inplace, file_path, output_file_path, prices)
             
             logger.info(f"Файл {file_path.name} успешно обработан и сохранен как {output_file_path.name}")
-            return True
+            return output_file_path
 
         except Exception as e:
             logger.error(f"Ошибка при обработке файла {file_path.name}: {e}", exc_info=True)
-            return False
\ No newline at end of file
+            return None
+
+    def _changed_prices(self, original_df, processed_df):
+        """Возвращает цены и способ сопоставления, изменившиеся при расчете листа (остальные - NaN)"""
+        columns = ['Цена материала', 'Цена работы']
+        if MATCH_TIER_COLUMN in processed_df.columns:
+            columns.append(MATCH_TIER_COLUMN)
+        before = original_df.reindex(columns=columns)
+        after = processed_df[columns]
+        return after.where(after.ne(before))
+
+    def _run_in_pool(self, process_pool, func, *args):
+        """Выполняет функцию в пуле процессов, а если пула нет - в текущем потоке"""
+        if process_pool is None:
+            return func(*args)
+        return process_pool.submit(func, *args).result()
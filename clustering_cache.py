@@ -0,0 +1,125 @@
+"""
+Дисковый кэш решений AI кластеризации между запусками оптимизации.
+Ключ - хеш набора нормализованных наименований блока, содержимого промпта и модели,
+поэтому блок с теми же наименованиями повторно в AI не отправляется, а изменение промпта
+или модели делает старые записи недоступными. Хранится разбиение наименований на кластеры;
+размер кэша ограничен, давно не использованные записи вытесняются (LRU).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from brain_index import normalize_name
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+
+class ClusteringCache:
+    """
+    Кэш разбиений блоков записей на кластеры
+    """
+
+    def __init__(self, prompt_version, model, max_entries, cache_file="clustering_cache.json"):
+        self.cache_file = Path(cache_file)
+        self.prompt_version = prompt_version
+        self.model = model
+        self.max_entries = max_entries
+        # Порядок словаря - порядок использования: последние использованные записи в конце
+        self.entries = self._load()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Загружает кэш с диска (записи в порядке использования)"""
+        if not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш кластеризации {self.cache_file}: {e}")
+            return {}
+        if data.get('version') != CACHE_FORMAT_VERSION:
+            return {}
+        entries = data.get('entries', {})
+        logger.info(f"Загружено {len(entries)} записей из кэша кластеризации")
+        return entries
+
+    def key(self, records):
+        """Ключ блока: набор нормализованных наименований, версия промпта и модель"""
+        names = sorted({normalize_name(record['name']) for record in records})
+        content = json.dumps([names, self.prompt_version, self.model], ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def lookup(self, records):
+        """
+        Восстанавливает кластеры блока из кэша
+
+        Returns:
+            list or None: Пары (каноническое наименование, записи кластера) или None, если блока нет в кэше
+        """
+        key = self.key(records)
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # Запись становится последней использованной
+            self.entries[key] = entry
+            self.hits += 1
+            self._dirty = True
+
+        records_by_name = defaultdict(list)
+        for record in records:
+            records_by_name[normalize_name(record['name'])].append(record)
+        clusters = []
+        for canonical_name, names in entry:
+            cluster_records = [record for name in names for record in records_by_name.pop(name, ())]
+            if cluster_records:
+                clusters.append((canonical_name, cluster_records))
+        return clusters
+
+    def store(self, records, clusters):
+        """Сохраняет кластеры блока (пары (каноническое наименование, записи)) в памяти"""
+        entry = [[canonical_name, list(dict.fromkeys(normalize_name(record['name']) for record in cluster_records))]
+                 for canonical_name, cluster_records in clusters]
+        key = self.key(records)
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            self._evict()
+            self._dirty = True
+
+    def _evict(self):
+        """Вытесняет давно не использованные записи сверх max_entries (вызывается под блокировкой)"""
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    def save(self):
+        """Атомарно записывает кэш на диск, если он изменился"""
+        with self._lock:
+            if not self._dirty:
+                return True
+            # Размер кэша мог быть уменьшен в конфигурации
+            self._evict()
+            try:
+                tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump({'version': CACHE_FORMAT_VERSION, 'entries': self.entries}, f, ensure_ascii=False)
+                os.replace(tmp_file, self.cache_file)
+                self._dirty = False
+                logger.info(f"Сохранено {len(self.entries)} записей в кэш кластеризации "
+                            f"(попаданий {self.hits}, промахов {self.misses})")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения кэша кластеризации: {e}")
+                return False
@@ -52,5 +52,85 @@ class Config:
         """Получает максимальный процент расхождения цен в кластерах"""
         return self.config.get("price_variance_threshold", 25.0)
 
+    def get_match_candidates_limit(self):
+        """Получает количество кандидатов из базы знаний, передаваемых в AI для одной позиции"""
+        return self.config.get("match_candidates_limit", 15)
+
+    def get_fuzzy_match_threshold(self):
+        """Получает минимальную оценку локального нечеткого поиска (не откалибрована), ниже которой позиция уходит в AI"""
+        return float(self.config.get("fuzzy_match_threshold", 0.8))
+
+    def get_write_match_tier_column(self):
+        """Получает флаг записи способа сопоставления отдельной колонкой в рассчитанную смету (по умолчанию выключен)"""
+        return bool(self.config.get("write_match_tier_column", False))
+
+    def get_calculate_max_workers(self):
+        """Получает максимальное число параллельных AI запросов при расчете смет"""
+        return max(1, int(self.config.get("calculate_max_workers", 4)))
+
+    def get_calculate_batch_size(self):
+        """Получает начальный размер чанка позиций для одного AI запроса при расчете"""
+        return max(1, int(self.config.get("calculate_batch_size", 40)))
+
+    def get_calculate_parallel_jobs(self):
+        """Получает число файлов (и листов одного файла), рассчитываемых одновременно"""
+        return max(1, int(self.config.get("calculate_parallel_jobs", min(4, os.cpu_count() or 1))))
+
+    def get_calculate_process_workers(self):
+        """Получает число процессов для разбора и записи Excel при расчете (1 - в процессе приложения)"""
+        return max(1, int(self.config.get("calculate_process_workers", min(4, os.cpu_count() or 1))))
+
+    def get_calculate_target_latency(self):
+        """Получает целевое время ответа AI на один чанк (сек.) для подбора размера чанка"""
+        return float(self.config.get("calculate_target_latency", 30.0))
+
+    def get_near_duplicate_threshold(self):
+        """Получает минимальное сходство (оценка Жаккара по MinHash) для поиска похожих наименований"""
+        return float(self.config.get("near_duplicate_threshold", 0.5))
+
+    def get_brain_reload_interval(self):
+        """Получает интервал проверки изменений brain.json в секундах"""
+        return float(self.config.get("brain_reload_interval", 2.0))
+
+    def get_brain_write_delay(self):
+        """Получает задержку (сек.) фоновой записи brain.json после правки: правки подряд записываются один раз"""
+        return float(self.config.get("brain_write_delay", 0.5))
+
+    def get_ai_max_retries(self):
+        """Получает число повторов AI запроса с нарастающей паузой при лимите запросов и обрывах связи"""
+        return int(self.config.get("ai_max_retries", 4))
+
+    def get_optimize_block_size(self):
+        """Получает максимальный размер блока записей, отправляемого на AI кластеризацию"""
+        return int(self.config.get("optimize_block_size", 50))
+
+    def get_optimize_max_workers(self):
+        """Получает число параллельных AI запросов кластеризации при оптимизации"""
+        return int(self.config.get("optimize_max_workers", 4))
+
+    def get_clustering_cache_size(self):
+        """Получает максимальное число блоков в кэше решений AI кластеризации (0 - кэш отключен)"""
+        return int(self.config.get("clustering_cache_size", 20000))
+
+    def get_optimize_clustering(self):
+        """Получает способ кластеризации при оптимизации: auto (AI при наличии ключа), ai или local (без AI)"""
+        return self.config.get("optimize_clustering", "auto")
+
+    def get_local_cluster_threshold(self):
+        """Получает минимальное сходство наименований (Дайс по n-граммам) для объединения без AI"""
+        return float(self.config.get("local_cluster_threshold", 0.75))
+
+    def get_candidate_generator(self):
+        """Получает способ отбора кандидатов: auto, exact (TF-IDF по всей базе) или ann (приближенный поиск)"""
+        return self.config.get("candidate_generator", "auto")
+
+    def get_ann_min_brain_size(self):
+        """Получает размер базы знаний, начиная с которого в режиме auto используется приближенный поиск"""
+        return int(self.config.get("ann_min_brain_size", 50000))
+
+    def get_ann_nprobe(self):
+        """Получает число просматриваемых кластеров приближенного поиска (больше - точнее, но медленнее)"""
+        return int(self.config.get("ann_nprobe", 8))
+
 # Глобальный экземпляр конфигурации
 config = Config() 
\ No newline at end of file
@@ -13,6 +13,8 @@ from optimize_brain import BrainOptimizer
 from calculate import SmetaCalculator
 from config import Config
 from progress_manager import ProgressManager
+from brain_index import get_brain_index
+from ann_index import get_candidate_generator
 from assistant_manager import AssistantManager # <--- Добавил импорт
 
 logger = logging.getLogger(__name__)
@@ -30,6 +32,11 @@ class SmetaAIController:
         self.assistant_manager = AssistantManager() # <--- Создаем один раз
         self.current_task_thread = None
         self._task_cancelled = False
+        # "Теплый" калькулятор для синхронного API сопоставления
+        self._matcher = None
+        self._matcher_key = None
+        self._matcher_building = None
+        self._matcher_lock = threading.Lock()
 
     def _run_task(self, task_function, *args):
         self._task_cancelled = False
@@ -45,8 +52,12 @@ class SmetaAIController:
         finally:
             self.current_task_thread = None
 
+    def is_task_running(self):
+        """Выполняется ли фоновая задача"""
+        return bool(self.current_task_thread and self.current_task_thread.is_alive())
+
     def start_task_async(self, task_function, *args):
-        if self.current_task_thread and self.current_task_thread.is_alive():
+        if self.is_task_running():
             raise RuntimeError("Другая задача уже выполняется.")
         self.current_task_thread = threading.Thread(target=self._run_task, args=(task_function, *args))
         self.current_task_thread.start()
@@ -146,14 +157,127 @@ class SmetaAIController:
             
         self.start_task_async(ingest_instance.process_files, files_to_process)
 
-    def start_optimize_async(self):
+    def start_optimize_async(self, full=False, clustering=None):
+        """Запускает оптимизацию базы знаний: инкрементальную или полную (full=True), с AI или без (clustering)."""
         optimizer = BrainOptimizer(self.progress_manager, self.get_cancellation_token)
-        self.start_task_async(optimizer.optimize)
+        self.start_task_async(optimizer.optimize, full, clustering)
 
-    def start_calculate_async(self):
+    def start_calculate_async(self, file_names=None, skip_unchanged=False):
+        """Запускает расчет выбранных файлов (или всех файлов папки calculate, если список пуст)."""
+        if file_names:
+            missing = [name for name in file_names if not (self.calculate_dir / Path(name).name).is_file()]
+            if missing:
+                raise ValueError(f"Файлы не найдены в папке calculate: {', '.join(missing)}")
         calculator = SmetaCalculator(self.progress_manager, self.get_cancellation_token)
-        self.start_task_async(calculator.calculate_all)
+        self.start_task_async(calculator.calculate_all, file_names, skip_unchanged)
+        if file_names:
+            return f"Расчет запущен для файлов: {len(file_names)}."
+        return "Расчет запущен для всех файлов папки calculate."
+
+    def save_calculate_uploads(self, uploaded_files):
+        """Сохраняет загруженные сметы в папку calculate и возвращает их имена."""
+        self.calculate_dir.mkdir(exist_ok=True)
+        file_names = []
+        for uploaded in uploaded_files:
+            # Берем только имя файла, без пути (secure_filename удалил бы кириллицу)
+            file_name = Path(uploaded.filename or '').name
+            if not file_name.lower().endswith('.xlsx'):
+                raise ValueError(f"Поддерживаются только файлы .xlsx: {uploaded.filename}")
+            uploaded.save(self.calculate_dir / file_name)
+            file_names.append(file_name)
+        return file_names
         
+    def _create_matcher(self, key):
+        """Создает калькулятор для версии базы знаний key и заранее строит его источник кандидатов"""
+        matcher = SmetaCalculator(self.progress_manager)
+        get_candidate_generator(matcher.brain_index, matcher.brain_file)
+        with self._matcher_lock:
+            if self._matcher_building == key:
+                self._matcher, self._matcher_key = matcher, key
+                self._matcher_building = None
+        return matcher
+
+    def _build_matcher(self, key):
+        try:
+            self._create_matcher(key)
+        except Exception as e:
+            self.app.logger.error(f"Ошибка подготовки калькулятора: {e}")
+            with self._matcher_lock:
+                if self._matcher_building == key:
+                    self._matcher_building = None
+
+    def warm_matcher(self):
+        """Готовит калькулятор для текущей версии базы знаний в вызывающем потоке (прогрев)"""
+        index = get_brain_index(self.brain_file)
+        key = (index, index.version)
+        with self._matcher_lock:
+            if self._matcher_key == key or self._matcher_building == key:
+                return
+            self._matcher_building = key
+        self._build_matcher(key)
+
+    def _get_matcher(self):
+        """
+        Возвращает калькулятор с загруженным индексом; пересоздается при смене или правке базы знаний.
+        Пока новый калькулятор готовится в фоне, запросы обслуживает прежний.
+        """
+        index = get_brain_index(self.brain_file)
+        key = (index, index.version)
+        with self._matcher_lock:
+            if self._matcher is not None and self._matcher_key == key:
+                return self._matcher
+            if self._matcher is not None:
+                if self._matcher_building != key:
+                    self._matcher_building = key
+                    threading.Thread(target=self._build_matcher, args=(key,), daemon=True).start()
+                return self._matcher
+            self._matcher_building = key
+        # Первый калькулятор создается синхронно - прежнего нет
+        return self._create_matcher(key)
+
+    def match_items(self, items, allow_ai=False):
+        """
+        Синхронно сопоставляет позиции с базой знаний.
+
+        Args:
+            items (list): Позиции: строки или словари {"name": ..., "unit": ...}
+            allow_ai (bool): Разрешить AI для позиций с низкой уверенностью
+
+        Returns:
+            list: Результат для каждой позиции в исходном порядке
+        """
+        positions = []
+        for item in items:
+            if isinstance(item, dict):
+                positions.append((str(item.get('name') or '').strip(), item.get('unit')))
+            else:
+                positions.append((str(item or '').strip(), None))
+
+        matcher = self._get_matcher()
+        matches = matcher.match_items(
+            [name for name, _ in positions],
+            allow_ai=allow_ai,
+            item_units=[unit for _, unit in positions]
+        )
+
+        results = []
+        for (name, unit), match in zip(positions, matches):
+            result = {'name': name, 'unit': unit, 'match': None, 'tier': None, 'confidence': 0.0}
+            if match:
+                brain_item = match['item']
+                result.update({
+                    'match': {
+                        'name': brain_item.get('name'),
+                        'unit': brain_item.get('unit', ''),
+                        'material_price': brain_item.get('material_price', 0),
+                        'work_price': brain_item.get('work_price', 0),
+                    },
+                    'tier': match['tier'],
+                    'confidence': match['confidence'],
+                })
+            results.append(result)
+        return results
+
     def get_cancellation_token(self):
         return self._task_cancelled
 
@@ -178,15 +302,9 @@ class SmetaAIController:
                 status_data['raw_data_size'] = 0
                 status_data['processed_files_count'] = 0
 
-            if Path("brain.json").exists():
-                with open("brain.json", 'r', encoding='utf-8') as f:
-                    brain_data = json.load(f)
-                    # brain.json теперь массив, а не объект с items
-                    if isinstance(brain_data, list):
-                        status_data['brain_size'] = len(brain_data)
-                    else:
-                        # Обратная совместимость со старым форматом
-                    status_data['brain_size'] = len(brain_data.get('items', {}))
+            if Path(self.brain_file).exists():
+                # Размер берется из общего индекса, без повторного разбора brain.json
+                status_data['brain_size'] = len(get_brain_index(self.brain_file))
             else:
                 status_data['brain_size'] = 0
         
@@ -196,18 +314,14 @@ class SmetaAIController:
         return status_data
 
     def clear_all_data(self):
-        """Удаляет сгенерированные данные (raw_data, brain) для чистого старта."""
-        raw_data_file = Path("raw_data.json")
-        brain_file = Path("brain.json")
+        """Удаляет сгенерированные данные (raw_data, brain, принадлежность кластерам) для чистого старта."""
         files_deleted = []
         
         try:
-            if raw_data_file.exists():
-                raw_data_file.unlink()
-                files_deleted.append(raw_data_file.name)
-            if brain_file.exists():
-                brain_file.unlink()
-                files_deleted.append(brain_file.name)
+            for data_file in (Path("raw_data.json"), Path("brain.json"), Path("brain_clusters.json")):
+                if data_file.exists():
+                    data_file.unlink()
+                    files_deleted.append(data_file.name)
             
             self.progress_manager.reset_progress()
             
@@ -279,8 +393,7 @@ class SmetaAIController:
         if not brain_path.exists():
             return {"error": "Файл brain.json не найден."}, 404
         try:
-            with open(brain_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return get_brain_index(brain_path).items.to_dicts()
         except Exception as e:
             logger.error(f"Ошибка чтения brain.json: {e}")
             return {"error": "Не удалось прочитать файл brain.json."}, 500 
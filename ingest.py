@@ -7,6 +7,7 @@ import logging
 from datetime import datetime
 from assistant_manager import AssistantManager # Новый менеджер
 from config import config
+from attributes import extract_attributes
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
@@ -178,7 +179,7 @@ class SmetaIngest:
             if self.cancellation_token_getter():
                 logger.info("Процесс загрузки отменен пользователем.")
                 self.progress_manager.fail_task("Процесс отменен.")
-             return
+                return
 
             base_progress = i * file_progress_span
 
@@ -196,9 +197,10 @@ class SmetaIngest:
                     # Нормализуем цены, если нужно
                     normalized_records = self._filter_records_with_prices(ai_records)
                     
-                    # Добавляем к каждой записи имя исходного файла
+                    # Добавляем к каждой записи имя исходного файла и технические характеристики
                     for record in normalized_records:
                         record['source_file'] = file_path.name
+                        record['attributes'] = extract_attributes(record.get('name', ''), record.get('unit'))
                     
                     all_records.extend(normalized_records)
                     newly_processed_files.append(file_path.name)
@@ -0,0 +1,200 @@
+"""
+Кластеризация сырых записей без AI.
+Одинаковые наименования (после нормализации) сразу объединяются; пары кандидатов ищутся
+методом скользящего окна по отсортированным наименованиям: внутри блока (ключ блока -
+основа первого значимого слова) и по наименованиям с отсортированными словами
+(порядок слов не важен). Пары оцениваются по символьным n-граммам наименований
+с проверкой характеристик, чисел и слов: наименования, различающиеся хотя бы одним
+значимым словом (водяной/электрический, круглый/прямоугольный), не объединяются.
+Похожие пары объединяются (система непересекающихся множеств). Время работы почти
+линейное: каждая запись сравнивается не более чем с окном соседей в каждом проходе.
+"""
+
+import logging
+import re
+from collections import Counter, defaultdict, deque
+
+from attributes import attributes_compatible, extract_attributes, normalize_unit
+from blocking import UnionFind, block_key_of_tokens
+from brain_index import NGRAM_SIZE, normalize_name
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Сколько соседей по отсортированному списку сравнивается с каждым наименованием
+LOCAL_CLUSTER_WINDOW = 5
+# Пары с оценкой чуть ниже порога считаются пограничными: они объединяются, только если
+# совпадают все слова наименований (разница лишь в знаках препинания, пробелах и окончаниях).
+# В AI они не отправляются: без AI кластеризуют режим local, режим auto без ключа и блоки,
+# на которых AI не сработал, а в режиме ai пограничные пары и так попадают в AI внутри блоков
+BORDERLINE_MARGIN = 0.1
+# Длина основы слова при сравнении слов (окончания в русском языке меняются, "оцинк." = "оцинкованный")
+WORD_STEM = 5
+# Служебные слова, не влияющие на смысл наименования
+STOP_WORDS = {'для', 'под', 'без', 'при', 'или', 'через'}
+_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)?')
+_TIMES_RE = re.compile(r'(?<=\d)\s*[xх×*]\s*(?=\d)')
+_DECIMAL_COMMA_RE = re.compile(r'(?<=\d),(?=\d)')
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def _comparison_name(name):
+    """Нормализованное наименование для сравнения: 3х1,5 и 3x1.5 записываются одинаково"""
+    return _DECIMAL_COMMA_RE.sub('.', _TIMES_RE.sub('x', normalize_name(name)))
+
+
+def _ngrams(name):
+    """Символьные n-граммы уже нормализованного наименования (как brain_index.char_ngrams)"""
+    if not name:
+        return set()
+    padded = f" {name} "
+    if len(padded) <= NGRAM_SIZE:
+        return {padded}
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+def _stems(tokens):
+    """
+    Основы слов наименования: (значимые слова, все слова).
+    Значимые - слова из букв длиной от 3 символов, кроме служебных.
+    """
+    content = frozenset(token[:WORD_STEM] for token in tokens
+                        if len(token) >= 3 and token.isalpha() and token not in STOP_WORDS)
+    return content, frozenset(token[:WORD_STEM] if token.isalpha() else token for token in tokens)
+
+
+class _Names:
+    """
+    Уникальные наименования (нормализованное наименование, единица) и их записи.
+    Характеристики извлекаются только для наименований, попавших в похожие пары.
+    """
+
+    def __init__(self, records):
+        self.keys = []
+        self.records = []
+        self.tokens = []
+        self.stems = []
+        self.numbers = []
+        self._attributes = {}
+        ids = {}
+        raw_ids = {}
+        for record in records:
+            name, unit = record.get('name', ''), record.get('unit')
+            raw_key = (name, unit)
+            key_id = raw_ids.get(raw_key)
+            if key_id is None:
+                key = (_comparison_name(name), normalize_unit(unit))
+                key_id = ids.get(key)
+                if key_id is None:
+                    key_id = ids[key] = len(self.keys)
+                    self.keys.append(key)
+                    self.records.append([])
+                    tokens = _TOKEN_RE.findall(key[0])
+                    self.tokens.append(tokens)
+                    self.stems.append(_stems(tokens))
+                    self.numbers.append(tuple(_NUMBER_RE.findall(key[0])))
+                raw_ids[raw_key] = key_id
+            self.records[key_id].append(record)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def attributes(self, key_id):
+        attributes = self._attributes.get(key_id)
+        if attributes is None:
+            record = self.records[key_id][0]
+            attributes = self._attributes[key_id] = extract_attributes(record.get('name', ''), record.get('unit'))
+        return attributes
+
+
+def _scan_window(names, order, groups, sets, threshold):
+    """
+    Сравнивает каждое наименование с соседями в окне отсортированного списка.
+    groups - ключ группы для каждого наименования (соседи из разных групп не сравниваются).
+
+    Returns:
+        tuple: (число объединенных пар, число пограничных пар, из них объединено)
+    """
+    joined = borderline = borderline_joined = 0
+    recent = deque(maxlen=LOCAL_CLUSTER_WINDOW)
+    current_group = None
+    for key_id in order:
+        if groups[key_id] != current_group:
+            current_group = groups[key_id]
+            recent.clear()
+        grams = _ngrams(names.keys[key_id][0])
+        numbers = names.numbers[key_id]
+        for other_id, other_grams in recent:
+            if numbers != names.numbers[other_id] or not grams or not other_grams:
+                continue
+            if sets.find(key_id) == sets.find(other_id):
+                continue
+            # Разные значимые слова - разные позиции, как бы ни были похожи наименования
+            content, all_words = names.stems[key_id]
+            other_content, other_words = names.stems[other_id]
+            if content != other_content:
+                continue
+            score = 2.0 * len(grams & other_grams) / (len(grams) + len(other_grams))
+            if score < threshold:
+                if score < threshold - BORDERLINE_MARGIN:
+                    continue
+                borderline += 1
+                # Пограничная пара - только если совпадают все слова
+                if all_words != other_words:
+                    continue
+                borderline_joined += 1
+            if attributes_compatible(names.attributes(key_id), names.attributes(other_id)):
+                sets.union(key_id, other_id)
+                joined += 1
+        recent.append((key_id, grams))
+    return joined, borderline, borderline_joined
+
+
+def _representative(records):
+    """Наименование, которое станет названием кластера: самое частое, затем самое полное"""
+    counts = Counter(record.get('name', '') for record in records)
+    return max(counts, key=lambda name: (counts[name], len(name)))
+
+
+def cluster_records(records, threshold=None):
+    """
+    Кластеризует записи без AI
+
+    Args:
+        records (list): Записи сырых данных
+        threshold (float): Минимальное сходство наименований (по умолчанию из конфигурации)
+
+    Returns:
+        dict: {название кластера: записи}; первой в кластере идет запись с названием кластера
+    """
+    threshold = config.get_local_cluster_threshold() if threshold is None else threshold
+    names = _Names(records)
+    sets = UnionFind(len(names))
+
+    # Проход 1: внутри блоков по отсортированным наименованиям
+    blocks = [block_key_of_tokens(tokens) for tokens in names.tokens]
+    order = sorted(range(len(names)), key=lambda key_id: (blocks[key_id], names.keys[key_id][0]))
+    joined, borderline, borderline_joined = _scan_window(names, order, blocks, sets, threshold)
+
+    # Проход 2: по наименованиям с отсортированными словами ("канальный вентилятор" = "вентилятор канальный")
+    sorted_names = [' '.join(sorted(tokens)) for tokens in names.tokens]
+    order = sorted(range(len(names)), key=sorted_names.__getitem__)
+    joined2, borderline2, borderline_joined2 = _scan_window(names, order, [None] * len(names), sets, threshold)
+
+    groups = defaultdict(list)
+    for key_id in range(len(names)):
+        groups[sets.find(key_id)].extend(names.records[key_id])
+
+    clusters = {}
+    for i, group_records in enumerate(groups.values()):
+        if len(group_records) == 1:
+            name = group_records[0].get('name', '')
+        else:
+            name = _representative(group_records)
+            group_records.sort(key=lambda record: record.get('name', '') != name)
+        clusters[f"Кластер {i+1}: {name}"] = group_records
+
+    logger.info(f"Локальная кластеризация: {len(records)} записей, {len(names)} уникальных наименований -> "
+                f"{len(clusters)} кластеров (объединено пар {joined + joined2}, пограничных {borderline + borderline2}, "
+                f"из них объединено {borderline_joined + borderline_joined2})")
+    return clusters
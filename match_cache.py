@@ -0,0 +1,103 @@
+"""
+Дисковый кэш сопоставлений для расчета смет.
+Хранит соответствие "нормализованное наименование -> запись базы знаний" между запусками
+и сбрасывается при любом изменении brain.json.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from brain_index import normalize_name
+
+logger = logging.getLogger(__name__)
+
+
+def compute_file_hash(file_path):
+    """Вычисляет MD5-хеш содержимого файла (None, если файла нет)"""
+    file_path = Path(file_path)
+    if not file_path.exists():
+        return None
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def compute_brain_version(brain_file):
+    """Вычисляет версию базы знаний как MD5-хеш содержимого файла"""
+    return compute_file_hash(brain_file)
+
+
+class MatchCache:
+    """
+    Кэш сопоставлений позиций сметы с записями базы знаний
+    """
+
+    def __init__(self, brain_version, cache_file="match_cache.json"):
+        self.cache_file = Path(cache_file)
+        self.brain_version = brain_version
+        self.entries = self._load()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Загружает кэш; записи другой версии базы знаний отбрасываются"""
+        if not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать кэш сопоставлений {self.cache_file}: {e}")
+            return {}
+
+        if data.get('brain_version') != self.brain_version:
+            logger.info("База знаний изменилась, кэш сопоставлений сброшен")
+            return {}
+
+        entries = data.get('entries', {})
+        logger.info(f"Загружено {len(entries)} записей из кэша сопоставлений")
+        return entries
+
+    def lookup(self, item_name):
+        """
+        Ищет сопоставление в кэше
+
+        Returns:
+            dict or None: {'match_name': ..., 'confidence': ..., 'tier': ...} или None
+        """
+        return self.entries.get(normalize_name(item_name))
+
+    def store(self, item_name, match_name, confidence, tier=None):
+        """Сохраняет сопоставление в памяти (на диск - через save)"""
+        with self._lock:
+            self.entries[normalize_name(item_name)] = {
+                'match_name': match_name,
+                'confidence': round(float(confidence), 4),
+                'tier': tier,
+                'cached_at': datetime.now().isoformat()
+            }
+            self._dirty = True
+
+    def save(self):
+        """Атомарно записывает кэш на диск, если он изменился"""
+        with self._lock:
+            if not self._dirty:
+                return True
+            try:
+                tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump({'brain_version': self.brain_version, 'entries': self.entries}, f, ensure_ascii=False)
+                os.replace(tmp_file, self.cache_file)
+                self._dirty = False
+                logger.info(f"Сохранено {len(self.entries)} записей в кэш сопоставлений")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения кэша сопоставлений: {e}")
+                return False
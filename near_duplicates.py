@@ -0,0 +1,311 @@
+"""
+Индекс похожих наименований (MinHash + LSH) по базе знаний и сырым данным.
+Наименования разбиваются на символьные n-граммы, для каждого считается MinHash-подпись,
+подписи раскладываются по корзинам LSH. Поиск похожих идет только по совпавшим корзинам,
+без попарного сравнения всех записей. Подписи сохраняются на диск между запусками.
+"""
+
+import json
+import logging
+import os
+import pickle
+import threading
+import zlib
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from brain_index import char_ngrams, get_brain_index, normalize_name
+from config import config
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = 1
+SHINGLE_SIZE = 3
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16
+# Фиксированное зерно: подписи, сохраненные на диск, должны совпадать между запусками
+MINHASH_SEED = 20250730
+# Корзины больше этого размера не порождают пар (слишком общие наименования)
+MAX_BUCKET_PAIRS_SIZE = 200
+
+SOURCE_BRAIN = 'brain'
+SOURCE_RAW = 'raw'
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class MinHasher:
+    """Вычисляет MinHash-подписи наименований по символьным n-граммам"""
+
+    def __init__(self, num_perm=NUM_PERMUTATIONS, seed=MINHASH_SEED):
+        rng = np.random.default_rng(seed)
+        # Коэффициенты < 2^31, чтобы a * x + b не переполнял uint64 при 32-битных хешах
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, name):
+        """MinHash-подпись наименования (None для пустого наименования)"""
+        grams = char_ngrams(name, SHINGLE_SIZE)
+        if not grams:
+            return None
+        hashes = np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+        values = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return values.min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """
+    LSH-индекс наименований. Одинаковые после нормализации наименования хранятся одной строкой
+    со списком ссылок (источник, номер записи в источнике).
+    """
+
+    def __init__(self, num_perm=NUM_PERMUTATIONS, bands=LSH_BANDS):
+        if num_perm % bands:
+            raise ValueError("Число перестановок должно делиться на число полос LSH")
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.names = []
+        self.refs = []
+        self._keys = []
+        self._row_by_key = {}
+        self._signatures = []
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _band_keys(self, signature):
+        step = self.rows_per_band
+        return [signature[band * step:(band + 1) * step].tobytes() for band in range(self.bands)]
+
+    def add(self, name, source, ref, signature=None):
+        """Добавляет наименование в индекс; возвращает номер строки индекса или None"""
+        key = normalize_name(name)
+        if not key:
+            return None
+        row = self._row_by_key.get(key)
+        if row is None:
+            if signature is None:
+                signature = self.hasher.signature(key)
+            row = len(self.names)
+            self._row_by_key[key] = row
+            self._keys.append(key)
+            self.names.append(name)
+            self.refs.append([])
+            self._signatures.append(signature)
+            for band, band_key in enumerate(self._band_keys(signature)):
+                self._buckets[band][band_key].append(row)
+        self.refs[row].append((source, ref))
+        return row
+
+    def row_of(self, name):
+        """Номер строки индекса для наименования или None"""
+        return self._row_by_key.get(normalize_name(name))
+
+    def signature_of(self, key):
+        """Сохраненная подпись нормализованного наименования или None"""
+        row = self._row_by_key.get(key)
+        return self._signatures[row] if row is not None else None
+
+    def _candidate_rows(self, signature):
+        rows = set()
+        for band, band_key in enumerate(self._band_keys(signature)):
+            rows.update(self._buckets[band].get(band_key, ()))
+        return rows
+
+    def query(self, name, threshold=None, limit=20, source=None):
+        """
+        Находит наименования, похожие на заданное
+
+        Args:
+            name (str): Наименование для поиска
+            threshold (float): Минимальная оценка сходства Жаккара (по умолчанию из конфигурации)
+            limit (int): Максимальное количество результатов
+            source (str): Ограничить результат источником ('brain' или 'raw')
+
+        Returns:
+            list: Словари {'name', 'source', 'index', 'similarity'} по убыванию сходства;
+                само наименование (после нормализации) в результат не входит
+        """
+        threshold = config.get_near_duplicate_threshold() if threshold is None else threshold
+        key = normalize_name(name)
+        signature = self.signature_of(key)
+        if signature is None:
+            signature = self.hasher.signature(key)
+        if signature is None:
+            return []
+
+        own_row = self._row_by_key.get(key)
+        scored = []
+        for row in self._candidate_rows(signature):
+            if row == own_row:
+                continue
+            similarity = float(np.mean(self._signatures[row] == signature))
+            if similarity >= threshold:
+                scored.append((similarity, row))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+
+        results = []
+        for similarity, row in scored:
+            for ref_source, ref in self.refs[row]:
+                if source and ref_source != source:
+                    continue
+                results.append({
+                    'name': self.names[row],
+                    'source': ref_source,
+                    'index': ref,
+                    'similarity': round(similarity, 3)
+                })
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def candidate_pairs(self, threshold=None):
+        """
+        Пары строк индекса, похожие не меньше порога (по совпадающим корзинам LSH)
+
+        Returns:
+            list: Кортежи (строка 1, строка 2, оценка сходства)
+        """
+        threshold = config.get_near_duplicate_threshold() if threshold is None else threshold
+        seen = set()
+        pairs = []
+        for buckets in self._buckets:
+            for rows in buckets.values():
+                if len(rows) < 2 or len(rows) > MAX_BUCKET_PAIRS_SIZE:
+                    continue
+                # Сходство всех пар корзины одним сравнением матриц подписей
+                signatures = np.stack([self._signatures[row] for row in rows])
+                similarity = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+                first, second = np.nonzero(np.triu(similarity >= threshold, 1))
+                for i, j in zip(first.tolist(), second.tolist()):
+                    pair = (rows[i], rows[j])
+                    if pair in seen:
+                        continue
+                    seen.add(pair)
+                    pairs.append((rows[i], rows[j], float(similarity[i, j])))
+        return pairs
+
+    def save(self, index_file, sources_key=None):
+        """Атомарно сохраняет подписи на диск (корзины перестраиваются при загрузке)"""
+        index_file = Path(index_file)
+        data = {
+            'version': INDEX_FORMAT_VERSION,
+            'params': (self.hasher.num_perm, self.bands, MINHASH_SEED, SHINGLE_SIZE),
+            'sources_key': sources_key,
+            'names': self.names,
+            'keys': self._keys,
+            'refs': self.refs,
+            'signatures': np.array(self._signatures, dtype=np.uint32).reshape(len(self._signatures), self.hasher.num_perm),
+        }
+        tmp_file = index_file.with_name(index_file.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        """Загружает индекс с диска; возвращает (индекс, ключ источников) или (None, None)"""
+        try:
+            with open(index_file, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать индекс похожих наименований {index_file}: {e}")
+            return None, None
+
+        index = cls()
+        if data.get('version') != INDEX_FORMAT_VERSION or \
+                tuple(data.get('params', ())) != (index.hasher.num_perm, index.bands, MINHASH_SEED, SHINGLE_SIZE):
+            return None, None
+
+        for name, key, refs, signature in zip(data['names'], data['keys'], data['refs'], data['signatures']):
+            row = len(index.names)
+            index._row_by_key[key] = row
+            index._keys.append(key)
+            index.names.append(name)
+            index.refs.append([tuple(ref) for ref in refs])
+            index._signatures.append(signature)
+            for band, band_key in enumerate(index._band_keys(signature)):
+                index._buckets[band][band_key].append(row)
+        return index, data.get('sources_key')
+
+
+def _file_key(path):
+    """Ключ версии файла по времени модификации и размеру"""
+    try:
+        stat = Path(path).stat()
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def _load_raw_names(raw_data_file):
+    """Наименования записей сырых данных (в порядке записей raw_data.json)"""
+    if not Path(raw_data_file).exists():
+        return []
+    try:
+        with open(raw_data_file, 'r', encoding='utf-8') as f:
+            return [record.get('name', '') for record in json.load(f).get('records', [])]
+    except Exception as e:
+        logger.error(f"Ошибка загрузки {raw_data_file}: {e}")
+        return []
+
+
+def build_near_duplicate_index(brain_file="brain.json", raw_data_file="raw_data.json", previous=None):
+    """
+    Строит индекс по наименованиям brain.json и raw_data.json.
+    Подписи наименований, уже посчитанные в previous, переиспользуются.
+    """
+    index = NearDuplicateIndex()
+    reused = 0
+    brain_items = get_brain_index(brain_file).items
+    sources = (
+        (SOURCE_BRAIN, [brain_items.names[slot] for slot in brain_items.live_slots()]),
+        (SOURCE_RAW, _load_raw_names(raw_data_file)),
+    )
+    for source, names in sources:
+        for ref, name in enumerate(names):
+            signature = previous.signature_of(normalize_name(name)) if previous else None
+            if signature is not None:
+                reused += 1
+            index.add(name, source, ref, signature)
+    logger.info(f"Построен индекс похожих наименований: {len(index)} наименований (подписей из кэша: {reused})")
+    return index
+
+
+_shared_index = None
+_shared_index_key = None
+_shared_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index(brain_file="brain.json", raw_data_file="raw_data.json", index_file="near_duplicates.index"):
+    """
+    Возвращает индекс похожих наименований. Индекс читается с диска, а при изменении
+    brain.json или raw_data.json перестраивается (с переиспользованием подписей) и сохраняется.
+    """
+    global _shared_index, _shared_index_key
+    sources_key = (_file_key(brain_file), _file_key(raw_data_file))
+
+    with _shared_index_lock:
+        if _shared_index is not None and _shared_index_key == sources_key:
+            return _shared_index
+
+        previous, saved_key = _shared_index, None
+        if previous is None and Path(index_file).exists():
+            previous, saved_key = NearDuplicateIndex.load(index_file)
+
+        if previous is not None and saved_key == sources_key:
+            index = previous
+        else:
+            index = build_near_duplicate_index(brain_file, raw_data_file, previous)
+            try:
+                index.save(index_file, sources_key)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить индекс похожих наименований: {e}")
+
+        _shared_index, _shared_index_key = index, sources_key
+        return index
@@ -1,24 +1,80 @@
+import hashlib
 import json
 import logging
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from datetime import datetime
 from collections import defaultdict
 from config import config
 from progress_manager import ProgressManager
 from prompt_loader import load_prompt
+from near_duplicates import get_near_duplicate_index
+from blocking import build_blocks
+import local_clustering
+from clustering_cache import ClusteringCache
+from match_cache import compute_file_hash
+from brain_index import BrainIndex, normalize_name
+from brain_search import BrainSearch
+from price_stats import cluster_price_statistics, price_statistics
+from attributes import attributes_compatible, extract_attributes, normalize_unit
+from ai_errors import check_finish_reason, is_fatal_error, is_split_error
 import openai
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+CLUSTERING_PROMPT_FILE = "prompt_optimize_clustering.txt"
+# Номер позиции в ответе AI: "12" или "12. Название"
+_LEADING_NUMBER_RE = re.compile(r'\s*(\d+)')
+# Сколько ближайших записей базы знаний проверяется при присоединении новой сырой записи
+ATTACH_CANDIDATES_LIMIT = 10
+MEMBERSHIP_FORMAT_VERSION = 2
+
+
+def compute_record_ids(records):
+    """
+    Идентификаторы сырых записей по содержимому (наименование, единица, цены, файл).
+    Повторы одинаковых записей различаются порядковым номером повтора.
+    """
+    ids = []
+    seen = defaultdict(int)
+    for record in records:
+        content = json.dumps([record.get('name'), record.get('unit'), record.get('material_price'),
+                              record.get('work_price'), record.get('source_file')], ensure_ascii=False)
+        digest = hashlib.md5(content.encode('utf-8')).hexdigest()
+        ids.append(f"{digest}:{seen[digest]}")
+        seen[digest] += 1
+    return ids
+
+
+def membership_name_key(record):
+    """
+    Ключ принадлежности по наименованию (нормализованное наименование и единица).
+    Не зависит от цен, поэтому запись с измененной ценой остается в прежнем кластере.
+    """
+    return f"{normalize_name(record.get('name'))}|{normalize_unit(record.get('unit'))}"
+
+
 class BrainOptimizer:
     def __init__(self, progress_manager=None, cancellation_token_getter=lambda: False):
         self.raw_data_path = Path("raw_data.json")
         self.brain_path = Path("brain.json")
+        # Принадлежность сырых записей кластерам: id записи -> cluster_id записи brain.json
+        self.membership_path = Path("brain_clusters.json")
         self.progress_manager = progress_manager
         self.cancellation_token_getter = cancellation_token_getter
-        self.client = openai.OpenAI(api_key=config.get_openai_key())
+        # Без ключа клиент не создается, кластеризация выполняется без AI
+        # При лимите запросов и обрывах связи клиент сам повторяет запрос с нарастающей паузой
+        self.client = (openai.OpenAI(api_key=config.get_openai_key(), max_retries=config.get_ai_max_retries())
+                       if config.is_ai_enabled() else None)
+        # Способ кластеризации для текущего запуска (None - из конфигурации)
+        self.clustering = None
+        # Кэш решений AI кластеризации (создается на время кластеризации)
+        self.clustering_cache = None
         
     def load_raw_data(self):
         """Загружает сырые данные"""
@@ -36,95 +92,213 @@ class BrainOptimizer:
             return None
     
     def _ai_cluster_similar_items(self, records):
-        """Кластеризация похожих записей через AI с предварительной группировкой"""
+        """
+        Кластеризация похожих записей через AI: записи разбиваются на блоки ограниченного размера,
+        блоки кластеризуются параллельно, затем кластеры разных блоков с одинаковым
+        каноническим наименованием объединяются. Ошибка одного блока не влияет на остальные:
+        блок с обрезанным или неразобранным ответом делится пополам, при других ошибках
+        кластеризуется без AI; если AI недоступен (ключ, доступ, квота), без AI кластеризуются
+        и все оставшиеся блоки. Блоки, уже кластеризованные в прошлых запусках, берутся из кэша (clustering_cache).
+        Возвращает None, если оптимизация отменена.
+        """
         if not records:
             return {}
         
         if self.progress_manager:
             self.progress_manager.update_progress(30, f"AI кластеризация {len(records)} записей...")
         
-        # Предварительная группировка по типам для улучшения кластеризации
-        type_groups = self._pre_group_by_type(records)
-        all_clusters = {}
-        
+        # Разбиение на небольшие блоки кандидатов: в AI уходят только блоки ограниченного размера
         try:
-            for group_name, group_records in type_groups.items():
-                if len(group_records) <= 1:
-                    # Если в группе одна запись, создаем индивидуальный кластер
-                    for record in group_records:
-                        cluster_name = f"{group_name}: {record['name']}"
-                        all_clusters[cluster_name] = [record]
-                    continue
-                
-                # Кластеризуем записи внутри группы
-                names_list = [f"{i+1}. {rec['name']}" for i, rec in enumerate(group_records)]
-                
-                # Загружаем промпт для кластеризации
-                prompt = load_prompt("optimize_clustering", input_list="\n".join(names_list))
-                
-                response = self.client.chat.completions.create(
-                    model=config.get_openai_model(),
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.1
-                )
-                
-                result_text = response.choices[0].message.content.strip()
-                logger.info(f"AI ответ для группы {group_name}: {result_text[:100]}...")
+            reference = get_near_duplicate_index(self.brain_path, self.raw_data_path)
+        except Exception as e:
+            logger.warning(f"Индекс похожих наименований недоступен, подписи будут посчитаны заново: {e}")
+            reference = None
+        blocks = build_blocks(records, reference=reference)
+        
+        # Блоки с теми же наименованиями, что и в прошлых запусках, берутся из кэша без AI
+        cache_size = config.get_clustering_cache_size()
+        if cache_size > 0:
+            self.clustering_cache = ClusteringCache(compute_file_hash(CLUSTERING_PROMPT_FILE),
+                                                    config.get_openai_model(), cache_size)
+        
+        # Блоки из одной записи становятся кластерами без AI
+        chunk_clusters = [[(block[0]['name'], block)] for block in blocks if len(block) == 1]
+        pending = [block for block in blocks if len(block) > 1]
+        total = len(pending)
+        in_flight = {}
+        completed = 0
+        ai_available = True
+        
+        max_workers = config.get_optimize_max_workers()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < max_workers:
+                    if self.cancellation_token_getter():
+                        pending.clear()
+                        break
+                    chunk = pending.pop(0)
+                    if not ai_available:
+                        chunk_clusters.append(list(local_clustering.cluster_records(chunk).items()))
+                        completed += 1
+                        continue
+                    in_flight[executor.submit(self._cluster_chunk, chunk)] = chunk
                 
-                # Парсим результат кластеризации для этой группы
-                group_clusters = self._parse_clustering_result(result_text, group_records)
+                if not in_flight:
+                    break
                 
-                # Добавляем кластеры группы в общий результат
-                for cluster_name, cluster_records in group_clusters.items():
-                    prefixed_name = f"{group_name}: {cluster_name}"
-                    all_clusters[prefixed_name] = cluster_records
-            
-            # Если кластеризация не сработала, создаем fallback
-            if not all_clusters:
-                logger.warning("AI кластеризация не вернула результатов. Создаем индивидуальные кластеры.")
-                all_clusters = self._create_individual_clusters(records)
-            
-            logger.info(f"Создано {len(all_clusters)} кластеров из {len(type_groups)} групп")
-            return all_clusters
-            
-        except Exception as e:
-            logger.error(f"Ошибка AI кластеризации: {e}")
-            # Fallback: каждая запись в отдельный кластер
-            return self._create_individual_clusters(records)
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    try:
+                        chunk_clusters.append(future.result())
+                        completed += 1
+                    except Exception as e:
+                        if is_fatal_error(e) and ai_available:
+                            ai_available = False
+                            logger.error(f"AI недоступен ({e}), оставшиеся блоки кластеризуются без AI")
+                        if is_split_error(e) and len(chunk) > 2:
+                            # Ответ не поместился или не разобран - делим блок пополам и отправляем повторно
+                            logger.warning(f"Блок из {len(chunk)} записей не кластеризован ({e}), делим пополам")
+                            middle = len(chunk) // 2
+                            pending[0:0] = [chunk[:middle], chunk[middle:]]
+                            total += 1
+                        else:
+                            # Повторы уже сделаны клиентом, деление не поможет - блок кластеризуется без AI
+                            logger.error(f"Ошибка AI кластеризации блока из {len(chunk)} записей: {e}")
+                            chunk_clusters.append(list(local_clustering.cluster_records(chunk).items()))
+                            completed += 1
+                    
+                    if self.progress_manager:
+                        progress = 30 + int(40 * completed / max(total, 1))
+                        self.progress_manager.update_progress(progress, f"AI кластеризация: обработано блоков {completed} из {total}")
+        
+        # Кэш сохраняется и при отмене: уже полученные ответы AI пригодятся в следующем запуске
+        if self.clustering_cache is not None:
+            self.clustering_cache.save()
+            self.clustering_cache = None
+        
+        if self.cancellation_token_getter():
+            return None
+        
+        all_clusters = self._merge_chunk_clusters(chunk_clusters)
+        logger.info(f"Создано {len(all_clusters)} кластеров из {len(blocks)} блоков")
+        return all_clusters
+
+    def _cluster_chunk(self, chunk_records):
+        """
+        Кластеризует один блок записей через AI (или берет прежний ответ из кэша).
+        Записи, не попавшие ни в один кластер ответа, остаются отдельными кластерами.
+
+        Returns:
+            list: Пары (каноническое наименование, записи кластера)
+        """
+        cache = self.clustering_cache
+        if cache is not None:
+            cached = cache.lookup(chunk_records)
+            if cached is not None:
+                return cached
+        
+        names_list = [f"{i+1}. {rec['name']}" for i, rec in enumerate(chunk_records)]
+        prompt = load_prompt("optimize_clustering", input_list="\n".join(names_list))
+        
+        response = self.client.chat.completions.create(
+            model=config.get_openai_model(),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        check_finish_reason(response)
+        
+        result_text = response.choices[0].message.content.strip()
+        logger.info(f"AI ответ для блока из {len(chunk_records)} записей: {result_text[:100]}...")
+        
+        clusters = list(self._parse_clustering_result(result_text, chunk_records).items())
+        recognized = bool(clusters)
+        assigned = {id(record) for _, cluster_records in clusters for record in cluster_records}
+        clusters.extend((record['name'], [record]) for record in chunk_records if id(record) not in assigned)
+        # Нераспознанный ответ не кэшируется, чтобы блок был отправлен в AI повторно
+        if cache is not None and recognized:
+            cache.store(chunk_records, clusters)
+        return clusters
+
+    def _merge_chunk_clusters(self, chunk_clusters):
+        """
+        Объединяет кластеры разных блоков с одинаковым (после нормализации) каноническим
+        наименованием; запись, попавшая в несколько кластеров, остается в первом.
+        """
+        merged = {}
+        names = {}
+        seen = set()
+        for clusters in chunk_clusters:
+            for canonical_name, cluster_records in clusters:
+                key = normalize_name(canonical_name)
+                target = merged.setdefault(key, [])
+                names.setdefault(key, canonical_name)
+                for record in cluster_records:
+                    if id(record) not in seen:
+                        seen.add(id(record))
+                        target.append(record)
+        
+        clusters = {}
+        for key, cluster_records in merged.items():
+            if cluster_records:
+                clusters[f"Кластер {len(clusters) + 1}: {names[key]}"] = cluster_records
+        return clusters
+
+    @staticmethod
+    def _record_index(value, count):
+        """Индекс записи в блоке по номеру из ответа AI (1, "1" или "1. Название") или None"""
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, int):
+            number = value
+        else:
+            match = _LEADING_NUMBER_RE.match(str(value))
+            if not match:
+                return None
+            number = int(match.group(1))
+        return number - 1 if 1 <= number <= count else None
 
     def _parse_clustering_result(self, result_text, records):
-        """Парсит результат кластеризации от AI"""
+        """
+        Парсит результат кластеризации от AI: {"clusters": [[номера позиций], ...]}.
+        Номера разрешаются по индексу в блоке, название кластера берется из первой позиции группы.
+        Поддерживается и прежний формат {каноническое название: ["1. Название", ...]}.
+        Повторно указанные номера относятся к первой группе.
+        """
         try:
-            # Пытаемся распарсить как JSON
             clusters_json = json.loads(result_text)
-            clusters = {}
-            
-            for canonical_name, original_names in clusters_json.items():
-                cluster_records = []
-                for original_name in original_names:
-                    # Ищем запись по имени (убираем номер из начала)
-                    clean_name = original_name
-                    if '. ' in original_name:
-                        parts = original_name.split('. ', 1)
-                        if len(parts) == 2 and parts[0].isdigit():
-                            clean_name = parts[1]
-                    
-                    # Ищем соответствующую запись
-                    for record in records:
-                        if record['name'] == clean_name:
-                            cluster_records.append(record)
-                            break
-                
-                if cluster_records:
-                    clusters[canonical_name] = cluster_records
-            
-            logger.info(f"Создано {len(clusters)} кластеров из JSON")
-            return clusters
-            
         except json.JSONDecodeError:
             logger.warning("Не удалось распарсить JSON, пробуем старый формат")
             # Fallback на старый парсинг
             return self._parse_clustering_result_old_format(result_text, records)
+        
+        if isinstance(clusters_json, dict) and isinstance(clusters_json.get('clusters'), list):
+            groups = [(None, group) for group in clusters_json['clusters']]
+        elif isinstance(clusters_json, dict):
+            groups = list(clusters_json.items())
+        else:
+            groups = [(None, group) for group in clusters_json] if isinstance(clusters_json, list) else []
+        
+        clusters = {}
+        assigned = set()
+        for canonical_name, group in groups:
+            if not isinstance(group, list):
+                continue
+            indices = []
+            for value in group:
+                index = self._record_index(value, len(records))
+                if index is not None and index not in assigned:
+                    assigned.add(index)
+                    indices.append(index)
+            if not indices:
+                continue
+            cluster_records = [records[index] for index in indices]
+            name = canonical_name if isinstance(canonical_name, str) and canonical_name else cluster_records[0]['name']
+            clusters.setdefault(name, []).extend(cluster_records)
+        
+        logger.info(f"Создано {len(clusters)} кластеров из JSON")
+        return clusters
 
     def _parse_clustering_result_old_format(self, result_text, records):
         """Парсит результат кластеризации в старом формате"""
@@ -162,45 +336,57 @@ class BrainOptimizer:
 
     def _create_brain_from_clusters(self, clusters):
         """Создает brain.json из кластеров с умной обработкой цен"""
-        brain_data = []
+        clusters_records = [records for records in clusters.values() if records]
+        # Статистика цен считается сразу для всех кластеров
+        price_results = cluster_price_statistics(clusters_records)
+        return [self._build_brain_record(cluster_records, prices)
+                for cluster_records, prices in zip(clusters_records, price_results)]
+
+    def _build_brain_record(self, cluster_records, price_results=None, existing=None):
+        """
+        Создает запись brain по записям кластера и статистике его цен (материала, работы).
+        Если передана прежняя запись (existing), сохраняются ее наименование, единица,
+        ручные правки и утвержденные цены; пересчитываются только статистика и неутвержденные цены.
+        """
+        # Берем первую запись как основу
+        base_record = cluster_records[0]
         
-        for cluster_name, cluster_records in clusters.items():
-            if not cluster_records:
-                continue
-                
-            # Берем первую запись как основу
-            base_record = cluster_records[0]
-            
-            # Собираем все варианты цен
-            material_prices = [r['material_price'] for r in cluster_records if r.get('material_price', 0) > 0]
-            work_prices = [r['work_price'] for r in cluster_records if r.get('work_price', 0) > 0]
-            
-            # Применяем умную логику обработки цен
-            material_result = self._smart_price_calculation(material_prices, "материала", cluster_name)
-            work_result = self._smart_price_calculation(work_prices, "работы", cluster_name)
-            
-            # Создаем запись для brain с расширенной информацией
-            brain_record = {
-                "name": base_record['name'],
-                "unit": base_record.get('unit', ''),
-                "material_price": material_result['final_price'],
-                "work_price": work_result['final_price'],
-                
-                # Расширенная информация о ценах
-                "price_analysis": {
-                    "material": material_result if material_prices else None,
-                    "work": work_result if work_prices else None
-                },
-                
+        material_result, work_result = price_results or cluster_price_statistics([cluster_records])[0]
+        
+        # Расширенная информация о ценах
+        price_analysis = {
+            "material": material_result if material_result['original_prices'] else None,
+            "work": work_result if work_result['original_prices'] else None
+        }
+        source_files = list(set(r.get('source_file', '') for r in cluster_records))
+        
+        if existing is not None:
+            brain_record = dict(existing)
+            if not existing.get('material_price_approved'):
+                brain_record['material_price'] = material_result['final_price']
+            if not existing.get('work_price_approved'):
+                brain_record['work_price'] = work_result['final_price']
+            brain_record.update({
+                "price_analysis": price_analysis,
                 "cluster_size": len(cluster_records),
-                "source_files": list(set(r.get('source_file', '') for r in cluster_records)),
-                "created_at": datetime.now().isoformat(),
+                "source_files": source_files,
                 "updated_at": datetime.now().isoformat()
-            }
-            
-            brain_data.append(brain_record)
+            })
+            return brain_record
         
-        return brain_data
+        # Создаем запись для brain с расширенной информацией
+        return {
+            "name": base_record['name'],
+            "unit": base_record.get('unit', ''),
+            "material_price": material_result['final_price'],
+            "work_price": work_result['final_price'],
+            "price_analysis": price_analysis,
+            "cluster_size": len(cluster_records),
+            "source_files": source_files,
+            "created_at": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat(),
+            "cluster_id": uuid.uuid4().hex[:12]
+        }
 
     def _smart_price_calculation(self, prices, price_type, item_name):
         """
@@ -208,145 +394,209 @@ class BrainOptimizer:
         - 2 цены: если разница ≤25% → среднее, иначе среднее + предупреждение
         - 3 цены: если разница мин-макс ≤25% → среднее, иначе среднее + предупреждение  
         - 4+ цен: отбрасываем крайние, если разница 2й и предпоследней ≤25% → среднее, иначе среднее + предупреждение
+        Для одного кластера; при построении базы статистика всех кластеров считается сразу (price_stats).
         """
-        if not prices:
-            return {
-                'final_price': 0,
-                'original_prices': [],
-                'used_prices': [],
-                'calculation_method': 'no_prices',
-                'warning': None,
-                'variance_percent': 0
-            }
-        
-        # Сортируем цены
-        sorted_prices = sorted(prices)
-        original_count = len(prices)
-        threshold = config.get_price_variance_threshold()
-        
-        if original_count == 1:
-            return {
-                'final_price': round(sorted_prices[0], 2),
-                'original_prices': prices,
-                'used_prices': sorted_prices,
-                'calculation_method': 'single_price',
-                'warning': None,
-                'variance_percent': 0
-            }
-        
-        elif original_count == 2:
-            # 2 цены: проверяем разницу
-            min_price, max_price = sorted_prices[0], sorted_prices[1]
-            variance = ((max_price - min_price) / min_price) * 100
-            
-            final_price = round(sum(sorted_prices) / len(sorted_prices), 2)
-            warning = f"Перепроверить цену {price_type}!" if variance > threshold else None
-            
-            return {
-                'final_price': final_price,
-                'original_prices': prices,
-                'used_prices': sorted_prices,
-                'calculation_method': 'average_2_prices',
-                'warning': warning,
-                'variance_percent': round(variance, 1)
-            }
-        
-        elif original_count == 3:
-            # 3 цены: проверяем разницу между мин и макс
-            min_price, max_price = sorted_prices[0], sorted_prices[2]
-            variance = ((max_price - min_price) / min_price) * 100
-            
-            final_price = round(sum(sorted_prices) / len(sorted_prices), 2)
-            warning = f"Перепроверить цену {price_type}!" if variance > threshold else None
-            
-            return {
-                'final_price': final_price,
-                'original_prices': prices,
-                'used_prices': sorted_prices,
-                'calculation_method': 'average_3_prices',
-                'warning': warning,
-                'variance_percent': round(variance, 1)
-            }
+        return price_statistics([prices], price_type)[0]
+
+    def _local_cluster_similar_items(self, records):
+        """Кластеризация без AI: похожие наименования с совместимыми характеристиками (local_clustering)"""
+        if not records:
+            return {}
+        if self.progress_manager:
+            self.progress_manager.update_progress(30, f"Кластеризация {len(records)} записей без AI...")
+        return local_clustering.cluster_records(records)
+
+    def _cluster_similar_items(self, records):
+        """
+        Кластеризация выбранным способом (optimize_clustering): ai, local или auto -
+        AI при наличии ключа, иначе без AI. Возвращает None, если оптимизация отменена.
+        """
+        mode = self.clustering or config.get_optimize_clustering()
+        if mode == 'local' or (mode == 'auto' and self.client is None):
+            return self._local_cluster_similar_items(records)
+        if self.client is None:
+            raise RuntimeError("Не задан OpenAI API ключ для AI кластеризации")
+        return self._ai_cluster_similar_items(records)
+
+    def load_membership(self):
+        """
+        Загружает принадлежность сырых записей кластерам
+
+        Returns:
+            tuple: ({id записи: cluster_id}, {ключ наименования: cluster_id}) или None
+        """
+        if not self.membership_path.exists():
+            return None
+        try:
+            with open(self.membership_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # В версии 1 не было карты наименований - она восстановится при следующем сохранении
+            if data.get('version') not in (1, MEMBERSHIP_FORMAT_VERSION):
+                return None
+            return data.get('records', {}), data.get('names', {})
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {self.membership_path}: {e}")
+            return None
+
+    def save_membership(self, membership, records, record_ids):
+        """Сохраняет принадлежность сырых записей кластерам (по id записи и по наименованию)"""
+        names = {}
+        for record, record_id in zip(records, record_ids):
+            cluster_id = membership.get(record_id)
+            if cluster_id is not None:
+                names.setdefault(membership_name_key(record), cluster_id)
+        try:
+            tmp_file = self.membership_path.with_name(self.membership_path.name + '.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': MEMBERSHIP_FORMAT_VERSION, 'records': membership, 'names': names},
+                          f, ensure_ascii=False)
+            os.replace(tmp_file, self.membership_path)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.membership_path}: {e}")
+            return False
+
+    def _load_brain_entries(self):
+        """Текущие записи brain.json или None"""
+        if not self.brain_path.exists():
+            return None
+        try:
+            with open(self.brain_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {self.brain_path}: {e}")
+            return None
+
+    def _attach_to_existing(self, record, index, search):
+        """Ищет запись базы знаний, к кластеру которой относится сырая запись (без AI)"""
+        name, unit = record['name'], record.get('unit')
+        item = index.resolve(name)
+        if item is not None and attributes_compatible(extract_attributes(name, unit),
+                                                      extract_attributes(item['name'], item.get('unit'))):
+            return item
         
-        else:
-            # 4+ цен: отбрасываем крайние
-            trimmed_prices = sorted_prices[1:-1]  # Убираем первую и последнюю
-            
-            if len(trimmed_prices) >= 2:
-                min_trimmed, max_trimmed = trimmed_prices[0], trimmed_prices[-1]
-                variance = ((max_trimmed - min_trimmed) / min_trimmed) * 100
-            else:
-                variance = 0
-            
-            final_price = round(sum(trimmed_prices) / len(trimmed_prices), 2)
-            warning = f"Перепроверить цену {price_type}!" if variance > threshold else None
-            
-            return {
-                'final_price': final_price,
-                'original_prices': prices,
-                'used_prices': trimmed_prices,
-                'calculation_method': f'trimmed_average_{original_count}_prices',
-                'warning': warning,
-                'variance_percent': round(variance, 1),
-                'excluded_prices': [sorted_prices[0], sorted_prices[-1]]
-            }
-
-    def _create_individual_clusters(self, records):
-        """Создает индивидуальный кластер для каждой записи"""
-        clusters = {}
-        for i, record in enumerate(records):
-            cluster_name = f"Кластер {i+1}: {record['name']}"
-            clusters[cluster_name] = [record]
-        logger.info(f"Создано {len(clusters)} индивидуальных кластеров")
-        return clusters
+        candidates = [idx for idx, _ in index.shortlist_scored(name, ATTACH_CANDIDATES_LIMIT, unit)]
+        item, confidence = search.best_candidate(name, candidates, unit)
+        if item is not None and confidence >= config.get_fuzzy_match_threshold():
+            return item
+        return None
 
-    def _pre_group_by_type(self, records):
-        """Предварительная группировка записей по типам оборудования"""
-        groups = {
-            'Вентиляция': [],
-            'Электрика': [],
-            'Трубопроводы': [],
-            'Крепеж': [],
-            'Работы': [],
-            'Прочее': []
-        }
+    def _optimize_incremental(self, records, record_ids, membership, names, brain_data):
+        """
+        Инкрементальная оптимизация: новые и измененные сырые записи присоединяются
+        к существующим кластерам - сначала по наименованиям записей кластеров (names),
+        затем через локальный индекс базы знаний; в AI уходят только оставшиеся.
+        Пересчитываются только кластеры, в которых появились или пропали записи.
+
+        Returns:
+            tuple: (записи brain.json, принадлежность записей кластерам) или None при отмене
+        """
+        entries = {entry['cluster_id']: entry for entry in brain_data}
+        current_ids = set(record_ids)
         
-        for record in records:
-            name = record['name'].lower()
-            
-            # Определяем тип по ключевым словам
-            if any(word in name for word in ['вентилятор', 'воздуховод', 'решетка', 'клапан', 'шумоглушитель', 'глушитель']):
-                groups['Вентиляция'].append(record)
-            elif any(word in name for word in ['кабель', 'провод', 'щит', 'автомат', 'розетка', 'выключатель', 'светильник']):
-                groups['Электрика'].append(record)
-            elif any(word in name for word in ['труба', 'фитинг', 'тройник', 'отвод', 'переход', 'заглушка']):
-                groups['Трубопроводы'].append(record)
-            elif any(word in name for word in ['болт', 'гайка', 'шайба', 'саморез', 'дюбель', 'анкер', 'крепеж']):
-                groups['Крепеж'].append(record)
-            elif any(word in name for word in ['монтаж', 'установка', 'демонтаж', 'наладка', 'пуско-наладка', 'работы']):
-                groups['Работы'].append(record)
-            else:
-                groups['Прочее'].append(record)
+        # Кластеры, из которых пропали записи (файл удален или запись изменилась)
+        touched = {cluster_id for record_id, cluster_id in membership.items()
+                   if record_id not in current_ids and cluster_id in entries}
+        new_membership = {record_id: cluster_id for record_id, cluster_id in membership.items() if record_id in current_ids}
         
-        # Убираем пустые группы
-        groups = {k: v for k, v in groups.items() if v}
+        members = defaultdict(list)
+        new_records = []
+        for record, record_id in zip(records, record_ids):
+            cluster_id = membership.get(record_id)
+            if cluster_id is None:
+                new_records.append((record_id, record))
+            elif cluster_id in entries:
+                members[cluster_id].append(record)
+            # Записи удаленных вручную кластеров в базу знаний не возвращаются
         
-        logger.info(f"Предварительная группировка: {[(k, len(v)) for k, v in groups.items()]}")
-        return groups
-    
+        logger.info(f"Инкрементальная оптимизация: новых или измененных записей {len(new_records)}, "
+                    f"кластеров с удаленными записями {len(touched)}")
+        
+        # Присоединение к существующим кластерам по локальному индексу
+        index = BrainIndex(brain_data)
+        search = BrainSearch(self.brain_path)
+        search.index = index
+        leftovers = []
+        for record_id, record in new_records:
+            # Запись с тем же наименованием, что и у записи кластера (например, изменилась только цена)
+            cluster_id = names.get(membership_name_key(record))
+            if cluster_id is not None and cluster_id not in entries:
+                # Кластер удален вручную - запись в базу знаний не возвращается
+                new_membership[record_id] = cluster_id
+                continue
+            if cluster_id is None:
+                item = self._attach_to_existing(record, index, search)
+                if item is None:
+                    leftovers.append((record_id, record))
+                    continue
+                cluster_id = item['cluster_id']
+            members[cluster_id].append(record)
+            new_membership[record_id] = cluster_id
+            touched.add(cluster_id)
+        
+        # Оставшиеся записи кластеризуются через AI и становятся новыми записями базы
+        new_entries = []
+        if leftovers:
+            logger.info(f"Присоединено к существующим кластерам: {len(new_records) - len(leftovers)}, в AI: {len(leftovers)}")
+            clusters = self._cluster_similar_items([record for _, record in leftovers])
+            if clusters is None:
+                return None
+            record_id_of = {id(record): record_id for record_id, record in leftovers}
+            new_entries = self._create_brain_from_clusters(clusters)
+            for entry, cluster_records in zip(new_entries, [records for records in clusters.values() if records]):
+                for record in cluster_records:
+                    new_membership[record_id_of[id(record)]] = entry['cluster_id']
+        
+        # Пересчет статистики только затронутых кластеров
+        recomputed = [cluster_id for cluster_id in touched if members.get(cluster_id)]
+        price_results = dict(zip(recomputed, cluster_price_statistics([members[cluster_id] for cluster_id in recomputed])))
+        result = []
+        for entry in brain_data:
+            cluster_id = entry['cluster_id']
+            if cluster_id in touched:
+                if cluster_id not in price_results:
+                    # Кластер без записей удаляется, если цены в нем не утверждены вручную
+                    if entry.get('material_price_approved') or entry.get('work_price_approved'):
+                        result.append(entry)
+                    continue
+                entry = self._build_brain_record(members[cluster_id], price_results[cluster_id], existing=entry)
+            result.append(entry)
+        result.extend(new_entries)
+        
+        logger.info(f"Пересчитано кластеров: {len(touched)}, новых записей базы: {len(new_entries)}")
+        return result, new_membership
+
+    def _full_membership(self, clusters, brain_data, records, record_ids):
+        """Принадлежность записей кластерам после полной оптимизации"""
+        record_id_of = {id(record): record_id for record, record_id in zip(records, record_ids)}
+        membership = {}
+        cluster_records = [records_ for records_ in clusters.values() if records_]
+        for entry, members in zip(brain_data, cluster_records):
+            for record in members:
+                membership[record_id_of[id(record)]] = entry['cluster_id']
+        return membership
+
     def save_brain(self, brain_data):
-        """Сохраняет brain.json"""
+        """Атомарно сохраняет brain.json: сервис базы знаний не увидит недописанный файл"""
         try:
-            with open(self.brain_path, 'w', encoding='utf-8') as f:
+            tmp_path = self.brain_path.with_name(self.brain_path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(brain_data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.brain_path)
             logger.info(f"Сохранено {len(brain_data)} записей в {self.brain_path}")
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения {self.brain_path}: {e}")
             return False
     
-    def optimize(self):
-        """Основной метод оптимизации"""
+    def optimize(self, full=False, clustering=None):
+        """
+        Основной метод оптимизации.
+        По умолчанию инкрементальный: кластеризуются только новые и измененные сырые записи;
+        full=True пересобирает базу знаний из всех записей.
+        clustering: 'ai', 'local' (без AI) или 'auto'; по умолчанию из конфигурации.
+        """
+        self.clustering = clustering
         logger.info("Starting brain optimization...")
         if self.progress_manager:
             self.progress_manager.start_task("optimize", "Запуск оптимизации базы знаний...")
@@ -366,23 +616,42 @@ class BrainOptimizer:
                 return
 
             records = raw_data.get('records', [])
+            record_ids = compute_record_ids(records)
             if self.progress_manager:
                 self.progress_manager.update_progress(10, f"Загружено {len(records)} записей для оптимизации...")
 
-            # AI кластеризация
-            clusters = self._ai_cluster_similar_items(records)
-            
-            if self.progress_manager:
-                self.progress_manager.update_progress(70, f"Создано {len(clusters)} кластеров, формирование базы знаний...")
+            # Инкрементальный режим возможен, если известна принадлежность записей кластерам
+            # и у всех записей базы знаний есть cluster_id (после импорта его нет)
+            loaded = None if full else self.load_membership()
+            brain_entries = self._load_brain_entries() if loaded is not None else None
+            if brain_entries is not None and all(entry.get('cluster_id') for entry in brain_entries):
+                membership, names = loaded
+                result = self._optimize_incremental(records, record_ids, membership, names, brain_entries)
+                if result is None:
+                    if self.progress_manager:
+                        self.progress_manager.fail_task("Оптимизация отменена пользователем.")
+                    return
+                brain_data, membership = result
+            else:
+                # Кластеризация (AI или без AI)
+                clusters = self._cluster_similar_items(records)
+                if clusters is None:
+                    if self.progress_manager:
+                        self.progress_manager.fail_task("Оптимизация отменена пользователем.")
+                    return
+                
+                if self.progress_manager:
+                    self.progress_manager.update_progress(70, f"Создано {len(clusters)} кластеров, формирование базы знаний...")
 
-            # Создание brain.json
-            brain_data = self._create_brain_from_clusters(clusters)
+                # Создание brain.json
+                brain_data = self._create_brain_from_clusters(clusters)
+                membership = self._full_membership(clusters, brain_data, records, record_ids)
             
             if self.progress_manager:
                 self.progress_manager.update_progress(90, "Сохранение базы знаний...")
 
             # Сохранение
-            if self.save_brain(brain_data):
+            if self.save_brain(brain_data) and self.save_membership(membership, records, record_ids):
                 if self.progress_manager:
                     self.progress_manager.complete_task(f"Оптимизация завершена. Создано {len(brain_data)} записей в базе знаний.")
             else:
@@ -0,0 +1,178 @@
+"""
+Статистика цен кластеров базы знаний, посчитанная сразу для всех кластеров.
+Цены всех кластеров собираются в одну таблицу (номер кластера, цена), сортируются внутри
+кластеров одной сортировкой, а крайние значения, разброс и предупреждения считаются
+по массивам. Результат для каждого кластера совпадает с BrainOptimizer._smart_price_calculation:
+- 1 цена: она и используется
+- 2-3 цены: среднее, разброс между минимальной и максимальной
+- 4+ цен: крайние отбрасываются, среднее и разброс по оставшимся
+"""
+
+import logging
+from itertools import chain
+
+import numpy as np
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# С какого количества цен отбрасываются минимальная и максимальная
+TRIM_MIN_COUNT = 4
+# Насколько близко к половине должен быть остаток, чтобы округление делалось через round()
+ROUND_TIE_TOLERANCE = 1e-9
+
+
+def _segment_sums(values, starts, counts):
+    """Суммы отрезков массива, сложенные слева направо (как sum() по списку цен)"""
+    sums = np.zeros(len(counts))
+    if not len(counts):
+        return sums
+    by_size = np.argsort(-counts, kind='stable')
+    negative_counts = -counts[by_size]
+    size_starts = starts[by_size]
+    for position in range(int(-negative_counts[0])):
+        # Отрезки длиннее position идут первыми
+        active = np.searchsorted(negative_counts, -position, side='left')
+        sums[by_size[:active]] += values[size_starts[:active] + position]
+    return sums
+
+
+def _round(values, digits, exact_values):
+    """
+    Округление как round(value, digits) для массива.
+    rint(x * 10**digits) / 10**digits совпадает с round(), кроме значений рядом с половиной
+    последнего разряда - они округляются через round() по exact_values(индекс).
+    """
+    scale = 10 ** digits
+    scaled = values * scale
+    rounded = (np.rint(scaled) / scale).tolist()
+    fraction = scaled - np.floor(scaled)
+    near_tie = np.abs(fraction - 0.5) <= ROUND_TIE_TOLERANCE * np.maximum(np.abs(scaled), 1.0)
+    for i in np.flatnonzero(near_tie).tolist():
+        rounded[i] = round(exact_values(i), digits)
+    return rounded
+
+
+def _calculation_method(count):
+    if count == 1:
+        return 'single_price'
+    if count < TRIM_MIN_COUNT:
+        return f'average_{count}_prices'
+    return f'trimmed_average_{count}_prices'
+
+
+def price_statistics(price_groups, price_type, threshold=None):
+    """
+    Считает статистику цен для группы кластеров
+
+    Args:
+        price_groups (list): Списки положительных цен, по одному на кластер
+        price_type (str): Вид цены для текста предупреждения ("материала" или "работы")
+        threshold (float): Допустимый разброс цен в процентах (по умолчанию из конфигурации)
+
+    Returns:
+        list: Словари статистики (как у _smart_price_calculation) в порядке price_groups
+    """
+    threshold = config.get_price_variance_threshold() if threshold is None else threshold
+    counts = np.fromiter(map(len, price_groups), dtype=np.int64, count=len(price_groups))
+    flat = list(chain.from_iterable(price_groups))
+    values = np.asarray(flat, dtype=np.float64)
+
+    # Одна устойчивая сортировка по (кластер, цена) - как sorted() внутри каждого кластера
+    group_ids = np.repeat(np.arange(len(price_groups)), counts)
+    order = np.lexsort((values, group_ids))
+    sorted_values = values[order]
+    sorted_prices = [flat[i] for i in order.tolist()]
+
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    # Границы используемых цен (для разброса и среднего): для 4+ цен без крайних
+    trimmed = counts >= TRIM_MIN_COUNT
+    low = np.where(trimmed, starts + 1, starts)
+    high = np.where(trimmed, ends - 2, ends - 1)
+    has_spread = counts >= 2
+    low_values = sorted_values[np.where(has_spread, low, 0)] if len(values) else np.zeros(len(counts))
+    high_values = sorted_values[np.where(has_spread, high, 0)] if len(values) else np.zeros(len(counts))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = np.where(has_spread, (high_values - low_values) / low_values * 100, 0.0)
+        # Среднее по используемым ценам (для 4+ цен без крайних)
+        used_counts = np.where(trimmed, counts - 2, counts)
+        means = _segment_sums(sorted_values, low, used_counts) / used_counts
+    warnings = variance > threshold
+
+    used_bounds = list(zip(low.tolist(), (low + used_counts).tolist()))
+
+    def exact_mean(group):
+        used_start, used_end = used_bounds[group]
+        used_prices = sorted_prices[used_start:used_end]
+        return sum(used_prices) / len(used_prices)
+
+    final_prices = _round(np.nan_to_num(means), 2, exact_mean)
+    variance_percents = _round(variance, 1, lambda group: float(variance[group]))
+
+    warning_text = f"Перепроверить цену {price_type}!"
+    methods = {count: _calculation_method(count) for count in set(counts.tolist())}
+    results = []
+    for prices, count, start, end, final_price, variance_percent, warn in zip(
+            price_groups, counts.tolist(), starts.tolist(), ends.tolist(), final_prices, variance_percents,
+            warnings.tolist()):
+        if count == 0:
+            results.append({
+                'final_price': 0,
+                'original_prices': [],
+                'used_prices': [],
+                'calculation_method': 'no_prices',
+                'warning': None,
+                'variance_percent': 0
+            })
+            continue
+
+        group_prices = sorted_prices[start:end]
+        if count == 1:
+            price = group_prices[0]
+            results.append({
+                # round() целого числа возвращает целое
+                'final_price': price if type(price) is int else final_price,
+                'original_prices': prices,
+                'used_prices': group_prices,
+                'calculation_method': 'single_price',
+                'warning': None,
+                'variance_percent': 0
+            })
+            continue
+
+        used_prices = group_prices[1:-1] if count >= TRIM_MIN_COUNT else group_prices
+        result = {
+            'final_price': final_price,
+            'original_prices': prices,
+            'used_prices': used_prices,
+            'calculation_method': methods[count],
+            'warning': warning_text if warn else None,
+            'variance_percent': variance_percent
+        }
+        if count >= TRIM_MIN_COUNT:
+            result['excluded_prices'] = [group_prices[0], group_prices[-1]]
+        results.append(result)
+    return results
+
+
+def cluster_price_statistics(clusters_records):
+    """
+    Статистика цен материала и работы для кластеров сырых записей
+
+    Args:
+        clusters_records (list): Списки записей, по одному на кластер
+
+    Returns:
+        list: Пары (статистика цены материала, статистика цены работы) в порядке кластеров
+    """
+    material_groups = [[r['material_price'] for r in records if r.get('material_price', 0) > 0]
+                       for records in clusters_records]
+    work_groups = [[r['work_price'] for r in records if r.get('work_price', 0) > 0]
+                   for records in clusters_records]
+    threshold = config.get_price_variance_threshold()
+    material = price_statistics(material_groups, "материала", threshold)
+    work = price_statistics(work_groups, "работы", threshold)
+    logger.info(f"Посчитана статистика цен для {len(clusters_records)} кластеров")
+    return list(zip(material, work))
@@ -490,27 +490,21 @@ async function loadFileSelectionList() {
         const fileList = document.getElementById('file-selection-list');
         const startBtn = document.getElementById('start-calculate-btn');
         
-        if (!files.input_files || files.input_files.length === 0) {
+        if (!files.calculate_files || files.calculate_files.length === 0) {
             fileList.innerHTML = '<p class="text-muted">Файлы не найдены</p>';
             return;
         }
         
         let html = '<div class="list-group">';
         
-        files.input_files.forEach(file => {
-            const size = formatFileSize(file.size);
-            const date = new Date(file.modified).toLocaleDateString('ru-RU');
-            
+        // Сметы для расчета из папки calculate
+        files.calculate_files.forEach(fileName => {
             html += `
                 <button type="button" class="list-group-item list-group-item-action file-select-item" 
-                        data-filename="${file.name}" onclick="selectFile('${file.name}')">
+                        data-filename="${fileName}" onclick="selectFile('${fileName}')">
                     <div class="d-flex justify-content-between align-items-center">
                         <div>
-                            <h6 class="mb-1">${file.name}</h6>
-                            <small class="text-muted">
-                                <i class="fas fa-calendar"></i> ${date} | 
-                                <i class="fas fa-weight-hanging"></i> ${size}
-                            </small>
+                            <h6 class="mb-1">${fileName}</h6>
                         </div>
                         <div class="file-select-indicator">
                             <i class="fas fa-circle text-muted"></i>
@@ -564,18 +558,22 @@ async function startCalculate() {
     }
     
     try {
+        // Рассчитываем только выбранный файл; уже рассчитанный по той же базе знаний пропускается
         const response = await fetch('/api/calculate', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
-            }
-            // Тело запроса больше не нужно, бэкенд обработает все файлы
+            },
+            body: JSON.stringify({
+                files: selectedFile ? [selectedFile] : [],
+                skip_unchanged: true
+            })
         });
         
         const result = await response.json();
         
         if (response.ok) {
-            showNotification(`Расчет всех файлов запущен`, 'success');
+            showNotification(result.message || 'Расчет запущен', 'success');
             showProgressSection();
         } else {
             showNotification(result.error || 'Ошибка запуска расчета', 'error');
@@ -766,19 +764,29 @@ function showBrainSection() {
     loadBrainData();
 }
 
-// Загрузка данных базы знаний
+// Загрузка данных базы знаний: сервер возвращает только подходящие под поиск записи
+// (подсказки по префиксам слов), полная база в браузер не загружается
 async function loadBrainData() {
     try {
-        const response = await fetch('/api/brain');
+        const searchInput = document.getElementById('brainSearchInput');
+        const priceSelect = document.getElementById('brainPriceFilter');
+        const params = new URLSearchParams({
+            q: searchInput ? searchInput.value : '',
+            price: priceSelect ? priceSelect.value : '',
+            limit: BRAIN_TABLE_LIMIT
+        });
+        const response = await fetch(`/api/brain/suggest?${params}`);
         
         if (!response.ok) {
             throw new Error(`HTTP ${response.status}: ${response.statusText}`);
         }
         
-        const brainData = await response.json();
+        const data = await response.json();
+        const results = Array.isArray(data.results) ? data.results : [];
         
-        // Сохраняем данные для редактирования
-        currentBrainData = Array.isArray(brainData) ? brainData : [];
+        // Сохраняем данные для редактирования по позиции записи в базе
+        currentBrainData = [];
+        results.forEach(item => { currentBrainData[item.index] = item; });
         
         const tbody = document.querySelector('#brainTable tbody');
         
@@ -789,15 +797,16 @@ async function loadBrainData() {
         }
         
         tbody.innerHTML = '';
+        const counter = document.getElementById('brainTableCounter');
         
-        if (currentBrainData.length === 0) {
-            tbody.innerHTML = '<tr><td colspan="8" class="text-center text-muted">База знаний пуста. Запустите оптимизацию.</td></tr>';
-            const counter = document.getElementById('brainTableCounter');
-            if (counter) counter.textContent = 'Показано: 0 записей';
+        if (results.length === 0) {
+            const message = data.total ? 'Ничего не найдено' : 'База знаний пуста. Запустите оптимизацию.';
+            tbody.innerHTML = `<tr><td colspan="8" class="text-center text-muted">${message}</td></tr>`;
+            if (counter) counter.textContent = `Показано: 0 из ${data.total || 0} записей`;
             return;
         }
         
-        currentBrainData.forEach((item, index) => {
+        results.forEach(item => {
             const row = document.createElement('tr');
             
             // Форматируем источники
@@ -823,7 +832,7 @@ async function loadBrainData() {
                 <td>${item.cluster_size || 1}</td>
                 <td><small>${sources}</small></td>
                 <td>
-                    <button class="btn btn-sm btn-outline-primary" onclick="editBrainItem(${index})">
+                    <button class="btn btn-sm btn-outline-primary" onclick="editBrainItem(${item.index})">
                         <i class="fas fa-edit"></i>
                     </button>
                 </td>
@@ -832,9 +841,7 @@ async function loadBrainData() {
             tbody.appendChild(row);
         });
         
-        // Устанавливаем начальный счетчик
-        const counter = document.getElementById('brainTableCounter');
-        if (counter) counter.textContent = `Показано: ${currentBrainData.length} записей`;
+        if (counter) counter.textContent = `Показано: ${results.length} из ${data.total} записей`;
         
     } catch (error) {
         console.error('Ошибка загрузки базы знаний:', error);
@@ -947,8 +954,12 @@ function editBrainItem(index) {
     showNotification('Функция редактирования в разработке', 'info');
 }
 
-// Глобальная переменная для хранения данных базы знаний
+// Глобальная переменная для хранения данных базы знаний (показанные записи по позиции в базе)
 let currentBrainData = [];
+// Сколько записей базы знаний показывать в таблице и задержка поиска при наборе, мс
+const BRAIN_TABLE_LIMIT = 200;
+const BRAIN_SEARCH_DELAY = 150;
+let brainSearchTimer = null;
 // Глобальная переменная для хранения данных полной базы
 let currentRawData = [];
 
@@ -1269,49 +1280,9 @@ async function saveBrainEdit() {
 
 // Фильтрация таблицы базы знаний
 function filterBrainTable() {
-    const searchTerm = document.getElementById('brainSearchInput').value.toLowerCase();
-    const priceFilter = document.getElementById('brainPriceFilter').value;
-    
-    const table = document.getElementById('brainTable');
-    const rows = table.getElementsByTagName('tbody')[0].getElementsByTagName('tr');
-    let visibleCount = 0;
-    
-    for (let i = 0; i < rows.length; i++) {
-        const row = rows[i];
-        const cells = row.getElementsByTagName('td');
-        
-        if (cells.length === 0) continue; // Пропускаем заголовки
-        
-        // Используем исходные данные вместо парсинга текста
-        const item = currentBrainData[i];
-        if (!item) continue;
-        
-        const name = item.name.toLowerCase();
-        const materialPrice = item.material_price || 0;
-        const workPrice = item.work_price || 0;
-        
-        // Проверка поиска
-        const matchesSearch = name.includes(searchTerm);
-        
-        // Проверка фильтра цен
-        let matchesPrice = true;
-        if (priceFilter === 'material') {
-            matchesPrice = materialPrice > 0;
-        } else if (priceFilter === 'work') {
-            matchesPrice = workPrice > 0;
-        }
-        
-        // Показываем/скрываем строку
-        if (matchesSearch && matchesPrice) {
-            row.style.display = '';
-            visibleCount++;
-        } else {
-            row.style.display = 'none';
-        }
-    }
-    
-    // Обновляем счетчик
-    document.getElementById('brainTableCounter').textContent = `Показано: ${visibleCount} записей`;
+    // Запрос к серверу после паузы в наборе, а не на каждое нажатие клавиши
+    clearTimeout(brainSearchTimer);
+    brainSearchTimer = setTimeout(loadBrainData, BRAIN_SEARCH_DELAY);
 }
 
 // Фильтрация таблицы полной базы
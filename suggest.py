@@ -0,0 +1,247 @@
+"""
+Подсказки при наборе наименования для поиска по базе знаний.
+Префиксное дерево строится по нормализованным словам наименований; в узлах с большим
+числом записей заранее хранятся лучшие записи, поэтому подсказка по короткому префиксу
+не перебирает все записи. Записи ранжируются по размеру кластера (сколько исходных
+позиций подтверждают цену), затем по длине наименования.
+"""
+
+import heapq
+import logging
+import threading
+
+from brain_index import normalize_name, tokenize
+
+logger = logging.getLogger(__name__)
+
+SUGGEST_LIMIT = 20
+# Сколько лучших записей хранится в узле; в узлах с меньшим числом записей они собираются при запросе
+NODE_TOP_SIZE = 50
+# Слова, по которым больше записей, не собираются в множество, а проверяются по записям-кандидатам
+SUGGEST_SCAN_LIMIT = 20000
+
+
+class _TrieNode:
+    __slots__ = ('children', 'token', 'weight', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.token = None
+        # Сумма длин списков записей по словам поддерева (оценка числа записей сверху)
+        self.weight = 0
+        self.top = None
+
+
+class SuggestIndex:
+    """
+    Префиксное дерево слов базы знаний. Списки записей по словам берутся из BrainIndex,
+    правки записей догоняются по журналу измененных слотов индекса.
+    """
+
+    def __init__(self, brain_index):
+        self.brain_index = brain_index
+        self._root = _TrieNode()
+        self._lock = threading.Lock()
+
+        items = brain_index.items
+        # Ранг записи: позиция в порядке (больший кластер, короче наименование, раньше в базе)
+        order = sorted(items.live_slots(), key=lambda slot: (-self._cluster_size(slot), len(items.names[slot]), slot))
+        self._rank = [len(order)] * len(items.names)
+        for rank, slot in enumerate(order):
+            self._rank[slot] = rank
+
+        postings = brain_index.token_postings()
+        for token, slots in postings.items():
+            self._insert(token, len(slots))
+        self._fill_top(self._root, postings)
+        self._synced = len(brain_index.changed_slots)
+        logger.info(f"Построено дерево подсказок: {len(postings)} слов")
+
+    def _cluster_size(self, slot):
+        try:
+            return int(self.brain_index.items.get_field(slot, 'cluster_size') or 0)
+        except KeyError:
+            return 0
+
+    def _insert(self, token, weight):
+        node = self._root
+        node.weight += weight
+        for char in token:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _TrieNode()
+            node = child
+            node.weight += weight
+        node.token = token
+        return node
+
+    def _fill_top(self, node, postings):
+        """Заполняет лучшие записи узлов с большим числом записей (снизу вверх)"""
+        candidates = set()
+        for child in node.children.values():
+            candidates.update(self._fill_top(child, postings))
+        if node.token is not None:
+            candidates.update(heapq.nsmallest(NODE_TOP_SIZE, postings.get(node.token, ()), key=self._rank.__getitem__))
+        best = heapq.nsmallest(NODE_TOP_SIZE, candidates, key=self._rank.__getitem__)
+        if node.weight > NODE_TOP_SIZE:
+            node.top = best
+        return best
+
+    def _find(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _subtree_slots(self, node):
+        """Записи всех слов поддерева (без повторов)"""
+        postings = self.brain_index.token_postings()
+        slots = set()
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.token is not None:
+                slots.update(postings.get(current.token, ()))
+            stack.extend(current.children.values())
+        return slots
+
+    def sync(self):
+        """Добавляет слова и записи, измененные в индексе базы знаний после построения"""
+        index = self.brain_index
+        with self._lock:
+            changed = index.changed_slots[self._synced:]
+            self._synced += len(changed)
+            # Добавленные записи ранжируются после всех остальных
+            self._rank.extend(range(len(self._rank), len(index.items.names)))
+            for slot in dict.fromkeys(changed):
+                if not index.items.is_live(slot):
+                    continue
+                for token in index.token_set(slot):
+                    node = self._root
+                    for char in token:
+                        node = node.children.setdefault(char, _TrieNode())
+                        node.weight += 1
+                        # Измененная запись занимает место в лучших записях узла, если ранг позволяет
+                        if node.top is not None and slot not in node.top:
+                            node.top = heapq.nsmallest(NODE_TOP_SIZE, node.top + [slot], key=self._rank.__getitem__)
+                    node.token = token
+
+    def suggest(self, query, limit=SUGGEST_LIMIT, price=None):
+        """
+        Подсказки для набираемого наименования: каждое слово запроса должно быть началом
+        какого-либо слова записи (последнее слово обычно набрано не до конца).
+
+        Args:
+            query (str): Набранный текст
+            limit (int): Количество подсказок
+            price (str): 'material' или 'work' - только записи с такой ценой
+
+        Returns:
+            list: Слоты записей; сначала записи, наименование которых начинается с запроса
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        nodes = []
+        for term in dict.fromkeys(terms):
+            node = self._find(term)
+            if node is None:
+                return []
+            nodes.append((node.weight, term, node))
+        nodes.sort(key=lambda entry: entry[0])
+        _, _, narrowest = nodes[0]
+
+        items = self.brain_index.items
+        price_field = {'material': 'material_price', 'work': 'work_price'}.get(price)
+
+        # Записи слов с небольшими поддеревьями пересекаются как множества;
+        # слова с огромными поддеревьями (короткие префиксы) проверяются по каждой записи
+        candidates = None
+        checked_terms = []
+        for weight, term, node in nodes:
+            if weight > SUGGEST_SCAN_LIMIT:
+                checked_terms.append(term)
+                continue
+            slots = self._subtree_slots(node)
+            candidates = slots if candidates is None else candidates & slots
+        if candidates is None:
+            candidates = narrowest.top
+
+        def accepted(slot):
+            if not items.is_live(slot):
+                return False
+            if checked_terms:
+                tokens = self.brain_index.token_set(slot)
+                if not all(any(token.startswith(term) for token in tokens) for term in checked_terms):
+                    return False
+            return not price_field or items.get_field(slot, price_field) > 0
+
+        found = []
+        for slot in sorted(candidates, key=self._rank.__getitem__):
+            if accepted(slot):
+                found.append(slot)
+                if len(found) >= limit:
+                    break
+
+        prefix = normalize_name(query)
+        found.sort(key=lambda slot: (not normalize_name(items.names[slot]).startswith(prefix), self._rank[slot]))
+        return found
+
+
+_shared_suggest = None
+_shared_suggest_building = None
+_shared_suggest_lock = threading.Lock()
+
+
+def _build_suggest_index(brain_index):
+    """Строит дерево подсказок для нового индекса и подменяет им текущее"""
+    global _shared_suggest, _shared_suggest_building
+    try:
+        suggest_index = SuggestIndex(brain_index)
+        with _shared_suggest_lock:
+            # Пока строилось дерево, мог появиться еще более новый индекс
+            if _shared_suggest is None or _shared_suggest_building is brain_index:
+                _shared_suggest = suggest_index
+    except Exception as e:
+        logger.error(f"Ошибка построения дерева подсказок: {e}")
+    finally:
+        with _shared_suggest_lock:
+            if _shared_suggest_building is brain_index:
+                _shared_suggest_building = None
+
+
+def get_suggest_index(brain_index):
+    """
+    Возвращает дерево подсказок для индекса базы знаний (строится один раз, правки догоняются).
+    Для нового индекса дерево строится в фоне, а до готовности возвращается прежнее -
+    записи результата берутся из его brain_index.
+    """
+    global _shared_suggest, _shared_suggest_building
+    with _shared_suggest_lock:
+        if _shared_suggest is not None and _shared_suggest.brain_index is brain_index:
+            _shared_suggest.sync()
+            return _shared_suggest
+        if _shared_suggest is not None:
+            if _shared_suggest_building is not brain_index:
+                _shared_suggest_building = brain_index
+                threading.Thread(target=_build_suggest_index, args=(brain_index,), daemon=True).start()
+            _shared_suggest.sync()
+            return _shared_suggest
+        _shared_suggest = SuggestIndex(brain_index)
+        return _shared_suggest
+
+
+def warm_suggest_index(brain_index):
+    """Заранее строит дерево подсказок для индекса в вызывающем потоке (прогрев базы знаний)"""
+    global _shared_suggest_building
+    with _shared_suggest_lock:
+        if _shared_suggest is not None and _shared_suggest.brain_index is brain_index:
+            _shared_suggest.sync()
+            return
+        if _shared_suggest_building is brain_index:
+            return
+        _shared_suggest_building = brain_index
+    _build_suggest_index(brain_index)
@@ -0,0 +1,30 @@
+"""Характеристики и совместимость на характерных наименованиях смет"""
+
+import pytest
+
+from attributes import attributes_compatible, extract_attributes
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('Воздуховод Ф315', {'diameter': 315}),
+    ('Воздуховод 315 мм', {'diameter': 315}),
+    ('Кабель ВВГнг 3х2,5', {'section': '3x2.5'}),
+    ('Труба медная Ø1/2" (12,7х0,8 мм)', {'diameter': '1/2"', 'size': '12.7x0.8'}),
+    ('Кран шаровой Ду 1 1/4"', {'diameter': '1 1/4"'}),
+    # Числа без обозначения диаметра не считаются характеристикой
+    ('Сдача системы в 2 этапа 100 мм', {}),
+    ('Изоляция толщиной 13 мм', {}),
+])
+def test_extract_attributes(name, expected):
+    assert extract_attributes(name) == expected
+
+
+@pytest.mark.parametrize('name1, name2, expected', [
+    ('Воздуховод Ф100', 'Воздуховод Ф315', False),
+    ('Воздуховод Ф315', 'Воздуховод диаметром 315', True),
+    ('Труба медная Ø1/2" (12,7х0,8 мм)', 'Труба медная 1/2" (12,7х0,8 мм)', True),
+    ('Труба медная Ø1/2"', 'Труба медная Ø1"', False),
+    ('Сдача системы в 2 этапа 100 мм', 'Сдача системы в 2 этапа', True),
+])
+def test_attributes_compatible(name1, name2, expected):
+    assert attributes_compatible(extract_attributes(name1), extract_attributes(name2)) == expected
@@ -0,0 +1,161 @@
+"""
+Пакетный поиск похожих наименований по TF-IDF символьных n-грамм.
+Наименования базы знаний один раз векторизуются в разреженную матрицу,
+а все наименования листа сметы оцениваются одним произведением разреженных матриц
+(по блокам строк, чтобы ограничить память).
+"""
+
+import logging
+import threading
+import weakref
+
+import numpy as np
+from scipy import sparse
+
+from brain_index import char_ngrams
+
+logger = logging.getLogger(__name__)
+
+# Сколько наименований запроса умножается за один блок
+QUERY_BLOCK_SIZE = 512
+# n-граммы, встречающиеся в большей доле записей, почти не влияют на ранжирование,
+# но делают произведение матриц плотным - в больших базах они отбрасываются
+MAX_DOCUMENT_FREQUENCY = 0.05
+LARGE_BRAIN_SIZE = 1000
+
+
+class TfidfMatcher:
+    """
+    Матрица TF-IDF наименований базы знаний (строки нормированы по L2),
+    сходство - косинус между векторами запроса и записей
+    """
+
+    def __init__(self, names, max_df=MAX_DOCUMENT_FREQUENCY):
+        self.size = len(names)
+        rows = [char_ngrams(name) for name in names]
+
+        document_frequency = {}
+        for grams in rows:
+            for gram in grams:
+                document_frequency[gram] = document_frequency.get(gram, 0) + 1
+
+        # Частые n-граммы отбрасываются только для больших баз
+        max_count = max(int(max_df * self.size), 1) if self.size >= LARGE_BRAIN_SIZE else self.size
+        self.vocabulary = {}
+        idf = []
+        for gram, count in document_frequency.items():
+            if count <= max_count:
+                self.vocabulary[gram] = len(idf)
+                idf.append(np.log((1 + self.size) / (1 + count)) + 1.0)
+        self.idf = np.array(idf, dtype=np.float32)
+
+        # Храним транспонированную матрицу (n-граммы x записи): запрос @ матрица дает оценки записей
+        self._matrix_t = self._vectorize_grams(rows).T.tocsr()
+        logger.info(f"Построена TF-IDF матрица: {self.size} записей, {len(self.vocabulary)} n-грамм")
+
+    def _vectorize_grams(self, rows):
+        """Строит L2-нормированную CSR-матрицу по множествам n-грамм"""
+        indptr = [0]
+        indices = []
+        for grams in rows:
+            indices.extend(idx for idx in (self.vocabulary.get(gram) for gram in grams) if idx is not None)
+            indptr.append(len(indices))
+        indices = np.array(indices, dtype=np.int32)
+        data = self.idf[indices] if len(indices) else np.empty(0, dtype=np.float32)
+        matrix = sparse.csr_matrix((data, indices, np.array(indptr, dtype=np.int64)),
+                                   shape=(len(rows), len(self.idf)), dtype=np.float32)
+
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.diags(1.0 / norms).dot(matrix).tocsr().astype(np.float32)
+
+    def vectorize(self, names):
+        """Векторизует наименования в разреженную матрицу в словаре базы знаний"""
+        return self._vectorize_grams([char_ngrams(name) for name in names])
+
+    def top_k(self, names, k=10):
+        """
+        Находит k ближайших записей базы знаний для каждого наименования
+
+        Args:
+            names (list): Наименования (например, все уникальные позиции листа)
+            k (int): Количество кандидатов на наименование
+
+        Returns:
+            tuple: (indices, scores) - массивы формы (len(names), k) с индексами записей
+                (-1, если кандидатов меньше k) и косинусным сходством, по убыванию сходства;
+                у наименований только из частых n-грамм кандидатов может не быть
+        """
+        count = len(names)
+        k = max(1, min(k, self.size)) if self.size else 1
+        indices = np.full((count, k), -1, dtype=np.int64)
+        scores = np.zeros((count, k), dtype=np.float32)
+        if not count or not self.size:
+            return indices, scores
+
+        queries = self.vectorize(names)
+        for start in range(0, count, QUERY_BLOCK_SIZE):
+            # Результат произведения - CSR без повторов, индексы внутри строки не отсортированы
+            block = (queries[start:start + QUERY_BLOCK_SIZE] @ self._matrix_t).tocsr()
+
+            # Частичная сортировка только ненулевых оценок строки: k лучших без полной сортировки
+            for row in range(block.shape[0]):
+                row_start, row_end = block.indptr[row], block.indptr[row + 1]
+                if row_start == row_end:
+                    continue
+                row_scores = block.data[row_start:row_end]
+                row_indices = block.indices[row_start:row_end]
+                if len(row_scores) > k:
+                    top = np.argpartition(-row_scores, k - 1)[:k]
+                    row_scores, row_indices = row_scores[top], row_indices[top]
+                order = np.lexsort((row_indices, -row_scores))
+                found = len(order)
+                indices[start + row, :found] = row_indices[order]
+                scores[start + row, :found] = row_scores[order]
+        return indices, scores
+
+
+# Матрицы по индексам базы знаний: после перезагрузки базы запросы, еще работающие
+# со старым индексом, пользуются его матрицей, пока новая строится при прогреве
+_shared_matchers = weakref.WeakKeyDictionary()
+_shared_matcher_lock = threading.Lock()
+
+
+def _rebuild_matcher(brain_index, version):
+    """Перестраивает матрицу в фоне и подменяет ее, если индекс не изменился снова"""
+    try:
+        matcher = TfidfMatcher(list(brain_index.items.names))
+        with _shared_matcher_lock:
+            entry = _shared_matchers.get(brain_index)
+            if entry is not None and brain_index.version == version:
+                entry['matcher'], entry['version'] = matcher, version
+    except Exception as e:
+        logger.error(f"Ошибка перестроения TF-IDF матрицы: {e}")
+    finally:
+        with _shared_matcher_lock:
+            entry = _shared_matchers.get(brain_index)
+            if entry is not None:
+                entry['building'] = None
+
+
+def get_tfidf_matcher(brain_index):
+    """
+    Возвращает TF-IDF матрицу для индекса базы знаний (строится один раз на версию индекса).
+    После точечной правки индекса матрица перестраивается в фоне, а до окончания
+    перестроения используется прежняя: номера записей в индексе не сдвигаются,
+    удаленные и измененные записи отсеиваются при проверке кандидатов.
+    """
+    version = brain_index.version
+    with _shared_matcher_lock:
+        entry = _shared_matchers.get(brain_index)
+        if entry is not None:
+            if entry['version'] != version and entry['building'] != version:
+                entry['building'] = version
+                threading.Thread(target=_rebuild_matcher, args=(brain_index, version), daemon=True).start()
+            return entry['matcher']
+
+    # Первая матрица индекса строится без блокировки: запросы к другим индексам не ждут
+    matcher = TfidfMatcher(list(brain_index.items.names))
+    with _shared_matcher_lock:
+        entry = _shared_matchers.setdefault(brain_index, {'matcher': matcher, 'version': version, 'building': None})
+        return entry['matcher']
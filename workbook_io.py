@@ -0,0 +1,118 @@
+"""
+Чтение и запись книг Excel для расчета смет.
+Запись выполняется прямо в копию исходной книги: меняются только ячейки цен,
+а форматирование, объединенные ячейки и формулы клиента сохраняются.
+"""
+
+import logging
+import numbers
+
+import openpyxl
+import pandas as pd
+from openpyxl.cell.cell import MergedCell
+
+logger = logging.getLogger(__name__)
+
+
+def _header_names(header):
+    """Формирует уникальные имена колонок по строке заголовка (как pandas)"""
+    names = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = str(value).strip() if value is not None and str(value).strip() else f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def read_workbook(file_path):
+    """
+    Читает все листы книги Excel в DataFrame.
+    Заголовок - первая непустая строка листа, индекс DataFrame - номера строк листа,
+    чтобы найденные цены можно было записать обратно в те же ячейки.
+    """
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for ws in wb.worksheets:
+            header = None
+            rows = []
+            row_numbers = []
+            for row_number, values in enumerate(ws.iter_rows(values_only=True), 1):
+                if header is None:
+                    if any(v is not None for v in values):
+                        header = values
+                    continue
+                rows.append(values)
+                row_numbers.append(row_number)
+
+            if header is None:
+                sheets[ws.title] = pd.DataFrame()
+                continue
+
+            width = max([len(header)] + [len(r) for r in rows])
+            columns = _header_names(list(header) + [None] * (width - len(header)))
+            rows = [list(r) + [None] * (width - len(r)) for r in rows]
+            sheets[ws.title] = pd.DataFrame(rows, columns=columns, index=pd.Index(row_numbers, dtype='int64'))
+        return sheets
+    finally:
+        wb.close()
+
+
+def _find_or_add_column(ws, header_row, title):
+    """Возвращает номер колонки с заголовком title, при отсутствии добавляет ее справа"""
+    for cell in ws[header_row]:
+        if cell.value is not None and str(cell.value).strip() == title:
+            return cell.column
+    column = ws.max_column + 1
+    ws.cell(row=header_row, column=column, value=title)
+    return column
+
+
+def write_prices_inplace(source_path, output_path, sheets):
+    """
+    Записывает цены в копию исходной книги и сохраняет ее как output_path.
+
+    Args:
+        source_path: Путь к исходной книге
+        output_path: Путь для сохранения результата
+        sheets (dict): Имя листа -> DataFrame с колонками цен (и, по настройке, способа сопоставления), индекс - номера строк листа
+            (как у read_workbook: первая строка данных идет сразу после заголовка)
+
+    Returns:
+        int: Количество измененных ячеек
+    """
+    wb = openpyxl.load_workbook(source_path)
+    changed = 0
+    for sheet_name, prices in sheets.items():
+        if prices.empty or sheet_name not in wb.sheetnames:
+            continue
+        ws = wb[sheet_name]
+        header_row = int(prices.index[0]) - 1
+
+        for title in prices.columns:
+            column = None
+            for row_number, value in prices[title].items():
+                # Пишем только найденные цены и подписи; пустые и нулевые значения не трогают лист
+                if isinstance(value, str):
+                    if not value.strip():
+                        continue
+                elif not isinstance(value, numbers.Real) or isinstance(value, bool) or pd.isna(value) or value <= 0:
+                    continue
+                else:
+                    value = float(value)
+                if column is None:
+                    column = _find_or_add_column(ws, header_row, title)
+                cell = ws.cell(row=int(row_number), column=column)
+                if isinstance(cell, MergedCell) or cell.value == value:
+                    continue
+                cell.value = value
+                changed += 1
+
+    wb.save(output_path)
+    logger.info(f"Записано {changed} ячеек цен в {output_path}")
+    return changed